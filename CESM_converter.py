@@ -1,53 +1,55 @@
 # NB: the input files here are large, and there are only a few, so we take advantage of parallelism by letting each process handle several columns from each file
-# specifically, there are 1200 timesteps in each file, and we divide those among 30 processes 
+# specifically, there are 1200 timesteps in each file, and the timesteps of all the files are divided evenly among however many processes are used
 #
 # NB: we are converting two datasets in different sets of files, but need the columns of each to correspond to matching timesteps. to ensure this, we sort
 # the filenames for both before assigning them to processes so the same timesteps will show up on the same processes
+#
+# with --concurrentQ true, the two datasets are converted at the same time by two groups of processes, sized by the bytes of their input files;
+# every process still takes part in creating both datasets in the output, but then only writes its own group's, independently of the other group
 
 from mpi4py import MPI
 from netCDF4 import Dataset
-import h5py
 import numpy as np
 from os import listdir
-from os.path import isfile, join
-import time, math, sys, re
+from os.path import getsize, join, splitext
+import sys, re, hashlib
+
+from conversionHelpers import configure, configureEngine, report, reportBarrier, flushLogs, timedPhase, reportPhaseTimes, nodeLayout, \
+        assignWriters, chunkIdxToWriter, applyCommandLine, planColumnRanges, mpiInfo, readManifest, newFilesToAppend, numTimeSlicesInFile, \
+        createFile, createDataset, reportClippedValues, rowIndex, writeMetadataGroup, writeColumnMetadata, createChecksumDatasets, verifyMask, \
+        convertLevels, conversionPlan, ConversionJournal
 
 
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
-mpiInfo = MPI.Info.Create()
 numProcs = comm.Get_size()
 procsList = np.arange(numProcs)
+# the processes that open the output file together; with concurrentQ, comm, rank and numProcs are narrowed to the group converting one variable
+fileComm = comm
 
 ### Helper functions and class
 
-def status(message, ranks=procsList):
-    """prints a message for each process in the ranks argument"""
-
-    messageToSend = "%s, process %d: %s" % (time.asctime(time.localtime()), rank, message)
-    messages = comm.gather(messageToSend, root=0)
+def splitByVariable(dataInPaths):
+    """splits the processes into one group per variable, converting the files in dataInPaths[groupIdx], each with a number of
+    processes (at least one) in proportion to the bytes of its input files, and consecutive ranks so that the groups share as few
+    nodes as possible; returns the index of this process's group and the group's communicator"""
+    inputBytes = None
     if rank == 0:
-        for (idx, messageToPrint) in enumerate(messages):
-            if idx in ranks:
-                print messageToPrint
-
-def report(message):
-    """print a message from the root process"""
-    status(message, [0])
-
-def reportBarrier(message):
-    """synchronize all processes, then print a message from the root process"""
-    comm.Barrier()
-    report(message)
-
-def chunkIdxToWriter(chunkIdx):
-    """maps the chunkIdx (0...numWriters) to the rank of the process that should write it out"""
-    machineNumber = (chunkIdx % numNodes)
-    offsetOnMachine = chunkIdx/numNodes
-    return machineNumber*numProcessesPerNode + offsetOnMachine
-
-def loadFiles(dir, varName, timevarName, procInfo):
-    """gets the list of all filenames in the data directory, divides them among the processes, opens them, populates some metadata"""
+        inputBytes = [sum([getsize(join(dataInPath, fname)) for fname in listdir(dataInPath) if fname.endswith(".nc")]) for dataInPath in dataInPaths]
+    inputBytes = comm.bcast(inputBytes, root=0)
+    if numProcs < len(dataInPaths):
+        report("Error: converting %d variables concurrently takes at least as many processes" % len(dataInPaths))
+        sys.exit(1)
+    groupSizes = np.maximum(1, np.rint(numProcs*np.array(inputBytes, dtype=np.float64)/max(1, sum(inputBytes)))).astype(np.int)
+    groupSizes[np.argmax(groupSizes)] -= np.sum(groupSizes) - numProcs
+    groupIdx = int(np.searchsorted(np.cumsum(groupSizes), rank, side="right"))
+    report("Splitting the processes by variable into groups of " + ", ".join(map(str, groupSizes)))
+    return (groupIdx, comm.Split(groupIdx, rank))
+
+@timedPhase("loadFiles")
+def loadFiles(dir, varName, timevarName, procInfo, manifest=None):
+    """gets the list of all filenames in the data directory (or with a manifest of the existing output, the ones missing from it),
+    divides them among the processes, opens them, populates some metadata"""
 
     # NB: this only makes sense for the CESM dataset and the particular naming convention used
     def CESMkeyfunction(fname):
@@ -57,61 +59,114 @@ def loadFiles(dir, varName, timevarName, procInfo):
     if (DEBUGFLAG):
         fileNameList = fileNameList[:65]
         report("DEBUGGING! LIMITING NUMBER OF FILES CONVERTED")
+    # the columns of the files converted in this run start at firstOutputCol of the output
+    procInfo.firstOutputCol = 0
+    if manifest is not None:
+        fileNameList = newFilesToAppend(manifest, fileNameList, CESMkeyfunction)
+        procInfo.firstOutputCol = manifest["numCols"]
     report("Found %d input files, starting to open" % len(fileNameList))
 
-    procInfo.fileNameList = [fileNameList[rank/fileProcessMultiplier]]
+    # the columns are the timesteps of the sorted files, in order; each process gets a contiguous range of nearly the same number of them,
+    # which can span the end of one file and the start of the next, and reads them as one hyperslab per file
+    numTimeSlicesPerFile = np.empty((len(fileNameList),), dtype=np.int)
+    localNumTimeSlices = [numTimeSlicesInFile(join(dir, fname), varName) for fname in fileNameList[rank::numProcs]]
+    for (otherRank, otherNumTimeSlices) in enumerate(comm.allgather(localNumTimeSlices)):
+        numTimeSlicesPerFile[otherRank::numProcs] = otherNumTimeSlices
+    if np.sum(numTimeSlicesPerFile) < numProcs:
+        report("Error: there are only %d timesteps in the input files, fewer than the %d processes; run on fewer processes" % (np.sum(numTimeSlicesPerFile), numProcs))
+        sys.exit(1)
+    fileRanges = planColumnRanges(numTimeSlicesPerFile, numProcs)[rank]
+
+    procInfo.fileNameList = [fileNameList[fileIdx] for (fileIdx, firstTimeSlice, numTimeSlices) in fileRanges]
     procInfo.numFiles = len(procInfo.fileNameList)
     procInfo.fileHandleList = map( lambda fname: Dataset(join(dir, fname), "r"), procInfo.fileNameList)
-    procInfo.numTimeSlices = map( lambda fh: fh[varName].shape[0]/fileProcessMultiplier, procInfo.fileHandleList)
+    procInfo.firstTimeSlices = [firstTimeSlice for (fileIdx, firstTimeSlice, numTimeSlices) in fileRanges]
+    procInfo.numTimeSlices = [numTimeSlices for (fileIdx, firstTimeSlice, numTimeSlices) in fileRanges]
     procInfo.numLocalCols = np.sum(procInfo.numTimeSlices)
-    procInfo.timeSliceOffsets = range(procInfo.numLocalCols * (rank % fileProcessMultiplier), procInfo.numLocalCols * (rank % fileProcessMultiplier + 1))
+    procInfo.timeSliceOffsets = list(np.concatenate([range(firstTimeSlice, firstTimeSlice + numTimeSlices)
+        for (firstTimeSlice, numTimeSlices) in zip(procInfo.firstTimeSlices, procInfo.numTimeSlices)]))
 
     procInfo.colsPerProcess = np.empty((numProcs,), dtype=np.int)
     comm.Allgather(procInfo.numLocalCols, procInfo.colsPerProcess)
     procInfo.numCols = sum(procInfo.colsPerProcess)
     procInfo.outputColOffsets = np.hstack([[0], np.cumsum(procInfo.colsPerProcess[:-1])])
-    procInfo.timeStamps = procInfo.fileHandleList[0][timevarName][procInfo.timeSliceOffsets]
+    # newer netCDF4 modules return masked arrays even when nothing is masked, which np.savez can't store
+    procInfo.timeStamps = np.concatenate(map(lambda (fh, firstTimeSlice, numTimeSlices): np.ma.getdata(fh[timevarName][firstTimeSlice:(firstTimeSlice + numTimeSlices)]),
+        zip(procInfo.fileHandleList, procInfo.firstTimeSlices, procInfo.numTimeSlices)))
     procInfo.repeatedFileNames = np.concatenate( map(lambda idx: [procInfo.fileNameList[idx]]*procInfo.numTimeSlices[idx], xrange(procInfo.numFiles)))
+    procInfo.columnTimeStamps = columnTimeStamps(procInfo)
+
+    # assumes the missing masks for observations are the same across timeslices;
+    # rank 0 reads the (level x lat x lon) mask once and shares it, rather than every process reading it
+    missingMask = None
+    if rank == 0:
+        missingMask = np.ma.getmaskarray(procInfo.fileHandleList[0][varName][0, ...])
+    gridShape = comm.bcast(None if missingMask is None else missingMask.shape, root=0)
+    if rank != 0:
+        missingMask = np.empty(gridShape, dtype=np.bool_)
+    comm.Bcast([missingMask.view(np.uint8), MPI.BYTE], root=0)
+    procInfo.missingLocations = np.nonzero(missingMask.flatten())[0]
+    procInfo.observedLocations = np.nonzero(np.logical_not(missingMask.flatten()))[0]
+    procInfo.numRows = len(procInfo.observedLocations)
+    procInfo.gridSize = missingMask.size
+    levelSize = np.prod(missingMask.shape[1:])
+    procInfo.numObservationsPerLevel = np.bincount(procInfo.observedLocations/levelSize, minlength=missingMask.shape[0])
+    if manifest is not None and hashlib.md5(procInfo.observedLocations.astype(np.int64).tostring()).hexdigest() != manifest["observedLocationsHash"]:
+        report("Error: the new input files are not missing the same grid points as the converted ones, so their rows would not line up")
+        sys.exit(1)
+
+    # the levels the conversion engine converts into rows (see convertLevels), all of the one variable, and the compression plan
+    # used by loadLevel: for each level, the flat indices of the observed grid points
+    procInfo.levels = [(0, curLev) for curLev in xrange(missingMask.shape[0])]
+    procInfo.variableHandles = [[fh[varName]] for fh in procInfo.fileHandleList]
+    procInfo.gridShapes = [missingMask.shape[1:]]
+    procInfo.levelObservedIndices = map(lambda levelMask: np.nonzero(np.logical_not(levelMask.flatten()))[0], missingMask)
+
+    # the per-row metadata is only needed by rank 0, which writes it out (also in the output's metadata group, see writeMetadataGroup);
+    # np.nonzero lists the observed points in the same (level, lat, lon) order as the rows
+    procInfo.observedLatCoords = None
+    procInfo.observedLevelDepths = None
+    procInfo.observedTareas = None
+    procInfo.observedThickness = None
+    procInfo.metadataRootQ = rank == 0
+    if rank == 0:
+        (observedLevels, observedLatIndices, observedLonIndices) = np.nonzero(np.logical_not(missingMask))
+        # for CESM, the lat and lon coords are stored as (lat-by-lon) grids
+        latCoordGrid = np.ma.getdata(procInfo.fileHandleList[0]["ULAT"][:])
+        levelDepths = np.ma.getdata(procInfo.fileHandleList[0]["z_t"][:])
+        Tareas = np.ma.getdata(procInfo.fileHandleList[0]["TAREA"][:])
+        thickness = np.ma.getdata(procInfo.fileHandleList[0]["dz"][:])
+        procInfo.observedLatCoords = latCoordGrid[observedLatIndices, observedLonIndices].astype(np.float64)
+        procInfo.observedLevelDepths = levelDepths[observedLevels].astype(np.float64)
+        procInfo.observedTareas = Tareas[observedLatIndices, observedLonIndices].astype(np.float64)
+        procInfo.observedThickness = thickness[observedLevels].astype(np.float64)
+    # from here on the variables are read raw, and loadLevel picks out the observed points using the compression plan;
+    # with verifyMaskQ it also checks that each timeslice is missing the same points as the shared mask, recognizing them by the rule netCDF4 masks values by (see conversionHelpers.maskingRule)
+    map(lambda fh: fh.set_auto_mask(False), procInfo.fileHandleList)
+    procInfo.levelMissingMasks = missingMask.reshape(missingMask.shape[0], -1)
 
-    # assumes the missing masks for observations are the same across timeslices
-    procInfo.missingLocations = np.nonzero(procInfo.fileHandleList[0][varName][0, ...].mask.flatten())[0]
-    procInfo.observedLocations = np.nonzero(np.logical_not(procInfo.fileHandleList[0][varName][0, ...].mask.flatten()))[0]
-    procInfo.numRows = len(np.nonzero(np.logical_not(procInfo.fileHandleList[0][varName][0, ...].mask.flatten()))[0])
-
-    # for CESM, the lat and lon coords are stored as (lat-by-lon) grids
-    latCoordGrid = procInfo.fileHandleList[0]["ULAT"][:]
-    lonCoordGrid = procInfo.fileHandleList[0]["ULONG"][:]
-    levelDepths = procInfo.fileHandleList[0]["z_t"][:]
-    Tareas = procInfo.fileHandleList[0]["TAREA"][:]
-    thickness = procInfo.fileHandleList[0]["dz"][:]
-    observedLatCoords = []
-    observedLevelDepths = []
-    observedTareas = []
-    observedThickness = []
-    for levNum in xrange(procInfo.fileHandleList[0][varName].shape[1]):
-        observedLatMask = np.logical_not(procInfo.fileHandleList[0][varName][0, levNum, ...].mask)
-        observedLatCoords = np.concatenate([observedLatCoords, latCoordGrid[observedLatMask]])
-        observedLevelDepths = np.concatenate([observedLevelDepths, [levelDepths[levNum]]*np.count_nonzero(observedLatMask)])
-        observedThickness = np.concatenate([observedThickness, [thickness[levNum]]*np.count_nonzero(observedLatMask)])
-        observedTareas = np.concatenate([observedTareas, Tareas[observedLatMask]])
-
-    procInfo.observedLatCoords = observedLatCoords
-    procInfo.observedLevelDepths = observedLevelDepths
-    procInfo.observedTareas = observedTareas
-    procInfo.observedThickness = observedThickness
     return fileNameList
 
+@timedPhase("writeMetadata")
 def writeMetadata(foutName, procInfo):
-    """writes metadata for the converted dataset to a numpy file"""
+    """writes metadata for the converted dataset to a numpy file (the same metadata also goes in the output file, see writeMetadataGroup)"""
     # THERE'S A WEIRD ISSUE W/ TIMESLICEOFFSETS HAVING NONETYPE, SO CANT CONCATENATE IT HERE, NEED TO DO SO MANUALLY WHEN USING IT
     timeStamps = comm.gather(procInfo.timeStamps, root=0)
     timeSliceOffsets = comm.gather(procInfo.timeSliceOffsets, root=0)
     fileNames = comm.gather(procInfo.repeatedFileNames, root=0)
-    latList = procInfo.fileHandleList[0]["ULAT"][:,0]
-    lonList = procInfo.fileHandleList[0]["ULONG"][0,:]
-    depthList = procInfo.fileHandleList[0]["dz"][:]
 
     if rank == 0:
+        latList = procInfo.fileHandleList[0]["ULAT"][:,0]
+        lonList = procInfo.fileHandleList[0]["ULONG"][0,:]
+        # the depths of the levels (z_t), as in the metadata group; this used to hold their thicknesses (dz), which are in observedThickness
+        depthList = procInfo.fileHandleList[0]["z_t"][:]
+        if appendQ:
+            # keep the columns converted by the earlier runs
+            with np.load(foutName, allow_pickle=True) as previousMetadata:
+                timeStamps = list(previousMetadata["timeStamps"]) + timeStamps
+                timeSliceOffsets = list(previousMetadata["timeSliceOffsets"]) + timeSliceOffsets
+                fileNames = list(previousMetadata["fileNames"]) + fileNames
+        (levelRowOffsets, gridRowIndex) = rowIndex(procInfo)
         np.savez(foutName,
                 missingLocations=np.array(procInfo.missingLocations),
                 timeStamps=timeStamps, timeSliceOffsets=timeSliceOffsets,
@@ -121,176 +176,116 @@ def writeMetadata(foutName, procInfo):
                 latList=latList, lonList=lonList, depthList=depthList,
                 observedLocations=procInfo.observedLocations,
                 numLevels=numLevels, numLats=numLats, numLongs=numLongs,
-                observedTareas = procInfo.observedTareas, observedThickness = procInfo.observedThickness)
-
-def verifyMask(procInfo):
-    """checks that the missing masks are the same for each set of observations"""
-    reportBarrier("Verifying that the missing mask is the same for all observations")
-    reportBarrier("... checking equality of masks on each process")
-    missingLocations = set(np.nonzero(procInfo.fileHandleList[0][varname][0, ...].mask.flatten())[0])
-    for (fhIdx, fh) in enumerate(procInfo.fileHandleList):
-        for timeslice in xrange(procInfo.numTimeSlices[fhIdx]):
-            curMissingLocations = set(np.nonzero(fh[varname][timeslice, ...].mask.flatten())[0])
-            if curMissingLocations != missingLocations:
-                status("The missing masks do not match for some of my files")
-                sys.exit()
-    # would like to use reduce, but apparently this does a gather first, which would cause an issue
-    # (tree reduce is NOT implemented)
-    reportBarrier("... checking equality of masks across processes")
-    for sender in xrange(1, numProcs):
-        if rank == sender:
-            comm.send(missingLocations, dest=0, tag=0)
-        elif rank == 0:
-            curMissingLocations = comm.recv(source=sender, tag=0)
-            if curMissingLocations != missingLocations:
-                status("The missing masks do not match for some of the files")
-                sys.exit(1)
-
-def chunkIt(length, num):
-    """breaks xrange(length) into num roughly equally sized pieces, returns arrays of start and end indices"""
-    smallChunkSize = length/num
-    bigChunkSize = length/num + 1
-    numBigChunks = length - (length/num)*num
-    numSmallChunks = num - numBigChunks
-
-    startIndices = [0]
-    endIndices = []
-    numChunks = 0
-    while numChunks < numSmallChunks:
-        endIndices.append(startIndices[-1] + smallChunkSize)
-        startIndices.append(endIndices[-1])
-        numChunks = numChunks + 1
-    numChunks = 0
-    while numChunks < numBigChunks:
-        endIndices.append(startIndices[-1] + bigChunkSize)
-        startIndices.append(endIndices[-1])
-        numChunks = numChunks + 1
-    startIndices = startIndices[:-1]
-
-    return (startIndices, endIndices)
-
-def loadLevel(procInfo, varname, numLats, numLongs, curLev):
-    """loads all the observations from the files assigned to this process at level curLev, and returns as a 
-    numObservationsPerTimeStepPerLevel * (numColsInMyFiles) matrix"""
-
-    curLevMask = np.logical_not(procInfo.fileHandleList[0][varname][0, curLev, ...].mask.flatten())
-    procInfo.numObservationsPerTimeStepPerLevel = len(np.nonzero(curLevMask)[0])
-    curLevData = np.empty((procInfo.numObservationsPerTimeStepPerLevel, procInfo.numLocalCols), dtype=np.float32)
-    colOffset = 0
-    for (fhidx, fh) in enumerate(procInfo.fileHandleList):
-        numTimeSlices = procInfo.numTimeSlices[fhidx]
-        timeSliceOffsets = procInfo.timeSliceOffsets
-        observedMask = np.logical_not(fh[varname][timeSliceOffsets, curLev, ...].mask)
-        observedValues = fh[varname][timeSliceOffsets, curLev, ...].data[observedMask]
-        curLevData[:, colOffset:(colOffset + numTimeSlices)] = \
-                observedValues.reshape(numTimeSlices, procInfo.numObservationsPerTimeStepPerLevel).transpose()
-        colOffset = colOffset + numTimeSlices
-
-    return curLevData
-
-# TODO: make return chunk a global variable
-def gatherDataAtWriter(curLevData, procInfo):
-    """Gathers all the row chunks of a given level of observations at the writer processes"""
-
-    chunkStartIndices, chunkEndIndices = chunkIt(procInfo.numObservationsPerTimeStepPerLevel, numWriters)
-    chunkSizes = map(lambda chunkIdx: chunkEndIndices[chunkIdx] - chunkStartIndices[chunkIdx], xrange(numWriters))
-    outputStartRows = np.hstack([[0], np.cumsum(chunkSizes)[:-1]])
-    returnChunk = [-1]
-    returnRowChunkSize = -1
-    returnOutputRowOffset = -1
-
-    for chunkIdx in xrange(numWriters):
-        writerRank = chunkIdxToWriter(chunkIdx)
-        curRowChunkSize = chunkSizes[chunkIdx]
-        chunkToTransfer = curLevData[chunkStartIndices[chunkIdx]:chunkEndIndices[chunkIdx], :].flatten()
-
-        processChunkSizes = curRowChunkSize*procInfo.colsPerProcess
-        processChunkDisplacements = np.hstack([[0], np.cumsum(processChunkSizes[:-1])])
-        collectedChunk = None
-        if rank == writerRank:
-            collectedChunk = np.empty((curRowChunkSize*procInfo.numCols), dtype=np.float32)
-        comm.Gatherv(sendbuf=[chunkToTransfer, MPI.FLOAT], \
-                     recvbuf=[collectedChunk, processChunkSizes, processChunkDisplacements, MPI.FLOAT], \
-                     root=writerRank)
-        if rank == writerRank:
-            returnChunk = collectedChunk
-            returnRowChunkSize = curRowChunkSize
-            returnOutputRowOffset = outputStartRows[chunkIdx]
-
-    return (returnChunk, returnRowChunkSize, returnOutputRowOffset)
-
-def writeOutputRowChunks(rowChunk, numRowsInChunk, outputRowOffset, rows, procInfo):
-    """On writer processes, writes out the stored chunk of rows"""
-    chunkStartIndices, chunkEndIndices = chunkIt(procInfo.numObservationsPerTimeStepPerLevel, numWriters)
-
-    for chunkIdx in xrange(numWriters):
-        if rank == chunkIdxToWriter(chunkIdx):
-            assert(len(rowChunk)== numRowsInChunk*procInfo.numCols)
-            processChunkSizes = numRowsInChunk*procInfo.colsPerProcess
-            processChunkDisplacements = np.hstack([[0], np.cumsum(processChunkSizes[:-1])])
-            chunkToWrite = np.empty((numRowsInChunk, procInfo.numCols), dtype=np.float32)
-
-            for processNum in np.arange(numProcs):
-                outputStartCol = procInfo.outputColOffsets[processNum]
-                outputEndCol = outputStartCol + procInfo.colsPerProcess[processNum]
-                startChunkOffset = processChunkDisplacements[processNum]
-                endChunkOffset = startChunkOffset + numRowsInChunk*procInfo.colsPerProcess[processNum]
-                chunkToWrite[:, outputStartCol:outputEndCol] = np.reshape(rowChunk[startChunkOffset:endChunkOffset], \
-                        (numRowsInChunk, procInfo.colsPerProcess[processNum]))
-
-            startOutputRow = outputRowOffset
-            endOutputRow = outputRowOffset + numRowsInChunk
-            rows[startOutputRow:endOutputRow, :] = chunkToWrite
-
-def createFile(fnameOut):
-    propfaid = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
-    propfaid.set_fapl_mpio(comm, mpiInfo)
-    fid = h5py.h5f.create(fnameOut, flags=h5py.h5f.ACC_TRUNC, fapl=propfaid)
-    return h5py.File(fid)
-
-def createDataset(fout, procInfo, varName): 
-    spaceid = h5py.h5s.create_simple((procInfo.numRows, procInfo.numCols))
-    plist = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
-    plist.set_fill_time(h5py.h5d.FILL_TIME_NEVER)
-    datasetid = h5py.h5d.create(fout.id, varName, h5py.h5t.NATIVE_DOUBLE, spaceid, plist)
-    return h5py.Dataset(datasetid)
+                observedTareas = procInfo.observedTareas, observedThickness = procInfo.observedThickness,
+                levelRowOffsets=levelRowOffsets, gridRowIndex=gridRowIndex)
+
+
+def columnTimeStamps(procInfo):
+    """the time stamps of this process's columns, as stored in the metadata group"""
+    return procInfo.timeStamps.astype(np.float64)
+
+def timeStampChecksum(procInfo):
+    """the first column and number of columns of the dataset converted in this run, and an order-sensitive checksum of their time stamps:
+    the sum over the columns c of (2c + 1) times the bits of the float64 time stamp, modulo 2**64; collective"""
+    firstCol = procInfo.outputColOffsets[rank]
+    colWeights = np.uint64(2)*np.arange(firstCol, firstCol + procInfo.numLocalCols, dtype=np.uint64) + np.uint64(1)
+    localChecksum = np.dot(colWeights, procInfo.timeStamps.astype(np.float64).view(np.uint64))
+    return (procInfo.firstOutputCol, procInfo.numCols, comm.allreduce(int(localChecksum), op=MPI.SUM) % 2**64)
+
+def checkColumnsAligned(procInfos):
+    """checks that the same columns of all the datasets are from the same times, by comparing the checksums of their time stamps
+    rather than gathering the time stamps; collective over all the processes, whichever datasets they convert (see concurrentQ)"""
+    timeStampChecksums = sum(fileComm.allgather([timeStampChecksum(procInfo) for procInfo in procInfos]), [])
+    if len(set(timeStampChecksums)) > 1:
+        report("Error: the columns of the temperature and density datasets are from observations at differing times")
+        sys.exit(1)
+
+def shareLayouts(datasetNames, procInfos, fileNameLists):
+    """with concurrentQ, every process still has to take part in creating all the datasets in the output, so for each dataset converted
+    by another group, gets from that group's rank 0 what creating it, its metadata group and its checksums takes, and stands in for its
+    ProcessInformation with that, writing none of the values; returns the ProcessInformation and file list of each dataset; collective"""
+    layouts = {}
+    if rank == 0:
+        for (datasetName, procInfo) in procInfos.items():
+            layouts[datasetName] = ({"numRows": procInfo.numRows, "numCols": procInfo.numCols, "firstOutputCol": procInfo.firstOutputCol,
+                    "gridSize": procInfo.gridSize, "numObservationsPerLevel": procInfo.numObservationsPerLevel}, fileNameLists[datasetName])
+    for groupLayouts in fileComm.allgather(layouts):
+        layouts.update(groupLayouts)
+
+    layoutProcInfos = dict(procInfos)
+    layoutFileNameLists = dict(fileNameLists)
+    for datasetName in datasetNames:
+        if datasetName in procInfos:
+            continue
+        (layout, layoutFileNameLists[datasetName]) = layouts[datasetName]
+        standIn = ProcessInformation()
+        standIn.__dict__.update(layout)
+        standIn.metadataRootQ = False
+        standIn.numLocalCols = 0
+        standIn.outputColOffsets = np.zeros((numProcs,), dtype=np.int)
+        (standIn.columnTimeStamps, standIn.timeSliceOffsets, standIn.repeatedFileNames) = (np.empty((0,)), [], [])
+        for fieldName in ["observedLocations", "observedLatCoords", "observedLevelDepths", "observedTareas", "observedThickness"]:
+            setattr(standIn, fieldName, None)
+        layoutProcInfos[datasetName] = standIn
+    return (layoutProcInfos, layoutFileNameLists)
+
+def createOutputDataset(datasetName, procInfo, fileNameList):
+    """creates (or on resume or append, reopens) datasetName in the output file, with its metadata group and checksums; collective"""
+    rows = createDataset(fout, procInfo, datasetName, outputPrecision[datasetName])
+    # the per-row metadata and the coordinate lists are only on the metadata root (rank 0, or with concurrentQ, rank 0 of the
+    # group converting the dataset); for CESM, the lat and lon coords are stored as (lat-by-lon) grids
+    writeMetadataGroup(fout, datasetName, procInfo, fileNameList, [("numLevels", numLevels), ("numLats", numLats), ("numLongs", numLongs)],
+            ["observedLatCoords", "observedLevelDepths", "observedTareas", "observedThickness"],
+            [("latList", numLats, lambda fh: fh["ULAT"][:, 0]), ("lonList", numLongs, lambda fh: fh["ULONG"][0, :]),
+             ("depthList", numLevels, lambda fh: fh["z_t"][:])],
+            np.float64)
+    if checksumsQ:
+        createChecksumDatasets(fout, datasetName, procInfo)
+    return rows
 
 ### Write the data to the output file
-def writeDataset(datasetName, procInfo, varname):
-    report("Creating the dataset in the file; this may take time")
-    rows = createDataset(fout, procInfo, datasetName)
-    chunkToWrite = None
-    levelStartRow = 0
-    writersList = map(chunkIdxToWriter, xrange(numWriters))
-    for curLev in xrange(numLevels):
-        reportBarrier("Loading data for level %d/%d" % (curLev + 1, numLevels))
-        curLevData = loadLevel(procInfo, varname, numLats, numLongs, curLev)
-        reportBarrier("Done loading data for this level")
-        reportBarrier("this level data shape: %d x %d " % (curLevData.shape[0], curLevData.shape[1]))
-        reportBarrier("There are %d observed grid points on this level" % procInfo.numObservationsPerTimeStepPerLevel)
-
-        reportBarrier("Gathering data for this level from processes to writers")
-        (curOutputRowChunk, curNumOutputRows, curOutputRowOffset) = gatherDataAtWriter(curLevData, procInfo)
-        reportBarrier("Done gathering")
-
-        reportBarrier("Writing data for this level on writers")
-        writeOutputRowChunks(curOutputRowChunk, curNumOutputRows, levelStartRow + curOutputRowOffset, rows, procInfo)
-        levelStartRow = levelStartRow + procInfo.numObservationsPerTimeStepPerLevel
+def writeDataset(datasetName, procInfo, fileNameList, rows):
+    # each append is journaled as a dataset of its own, named after its first column
+    journalName = datasetName if procInfo.firstOutputCol == 0 else "%s@%d" % (datasetName, procInfo.firstOutputCol)
+    journal.startDataset(journalName, conversionPlan(procInfo, fileNameList))
+    if concurrentQ:
+        journal.shareFlushes(journalName)
+    convertLevels(procInfo, rows, journalName, journal)
+    if concurrentQ:
+        journal.finishSharedFlushes()
 
     reportBarrier("Done writing")
+    reportClippedValues(procInfo)
+    procInfo.masksMatchQ = verifyMask(procInfo) if verifyMaskQ else True
 
 class ProcessInformation(object):
     def __init__(self):
         pass
 
-# Variables that should really be command-line settings
+# Settings; any of them can be overridden with --config settings.json and --settingName value on the command line
+namesBeforeSettings = set(globals().keys())
 DEBUGFLAG = False
-numNodes = 18 # number of physical nodes
-numProcessesPerNode = 30 # only used in the calculation of which processes to write from
-numWriters = 18 # a good choice is one per physical node (probably up to the number of OSTs used)
-fileProcessMultiplier = 30  #this many processes work on each file
-
-verifyMaskQ = False
+numWriters = None # None for one per physical node, which is a good choice (probably up to the number of OSTs used)
+redistributionMode = "alltoallv" # how levels move from readers to writers: "alltoallv" (one collective per level), "igatherv" (concurrent nonblocking gathers), or "gatherv" (one blocking gather per writer)
+pipelineDepth = 2 # number of levels read ahead of the one being redistributed and written (always with Ialltoallv); 0 converts the levels one step at a time
+threadSafeHDF5 = False # set if the HDF5 library is thread-safe, so reads of NETCDF4-format inputs can overlap the HDF5 writes
+outputPrecision = {"temp": "float32", "rho": "float32"} # on-disk type of each dataset: "float64", "float32", "float16", or ("int16", scaleFactor, addOffset) to pack the values with an absolute error of at most scaleFactor/2
+outputChunkShape = None # None for a contiguous output dataset, "auto" for square chunks of about autoChunkBytes, or a (rows, columns) chunk shape
+autoChunkBytes = 1024*1024
+outputCompression = None # None, or a deflate level (1-9) to shuffle and deflate the chunks (auto-chunked if no chunk shape is given); needs parallel HDF5 >= 1.10.2, and makes all writes collective
+journalQ = True # record the converted (dataset, level, row chunk) units in a journal next to the output, so an interrupted run can be resumed
+resumeQ = False # set by --resume: reopen the output of an interrupted run and convert only the units missing from its journal
+appendQ = False # set by --append: convert only the input files missing from the output's manifest, into new columns of the existing output
+resizableOutputQ = False # create the output with an unlimited (and so chunked) column dimension, so later runs can --append to it
+outputMode = "writers" # "writers" funnels each level through the writer processes; "collective" has every process write its own columns with collective MPI-IO
+concurrentQ = False # convert temp and rho at the same time, each on its own group of processes (with its own writers) sized by the bytes of its input files; needs outputMode "writers" and no outputCompression
+
+syncReportsQ = False # put a barrier in front of each progress report, so its timestamp marks when all the processes got there
+traceFnameOut = "/global/cscratch1/sd/gittens/conversion-code/CESM_conversion/output/cesmTrace.json" # None, or where to write the JSON trace of the time and bytes moved by each process in each step
+logDir = None # None, or a directory where each process writes its own log at the end of the run (otherwise the root process prints them)
+memoryBudget = None # None converts each level whole; otherwise the bytes each process may use for the buffers and temporaries of the conversion, and the levels are converted in blocks of latitudes that fit (see conversionHelpers.blockBytes)
+verifyMaskQ = True # check, as the levels are read, that every timeslice is missing the same grid points as the first one
+checksumsQ = True # compute the checksum, sum and sum of squares of each column on each level as it is read, and store them in /checksums for verifyConversion.py
 
 # CESM TEMP data
 tempDataInPath = "/global/cscratch1/sd/nrcavana/CESM_LE/TEMP"
@@ -314,35 +309,87 @@ numLevels = 60
 numLats = 384
 numLongs = 320
 
+applyCommandLine(globals(), sorted(set(globals().keys()) - namesBeforeSettings - set(["namesBeforeSettings"])), "converts the CESM dataset to HDF5",
+        [("resume", "resumeQ", "reopen the output of an interrupted run and convert only what its journal is missing"),
+         ("append", "appendQ", "convert only the input files that are new since the output was written, into new columns")])
+configure(syncReportsQ=syncReportsQ, logDir=logDir)
+configureEngine(globals())
+
 ### Setup the processes for reading and writing
+datasets = [("temp", tempDataInPath, tempVarName, tempTimeVarname, tempMetadataFnameOut),
+        ("rho", rhoDataInPath, rhoVarName, rhoTimeVarname, rhoMetadataFnameOut)]
+datasetNames = [datasetName for (datasetName, dataInPath, varName, timeVarName, metadataFnameOut) in datasets]
+groupSuffix = ""
+if concurrentQ:
+    if outputMode != "writers" or outputCompression is not None:
+        report("Error: concurrentQ needs outputMode \"writers\" and no outputCompression, as the groups can't take part in each other's collective writes")
+        sys.exit(1)
+    # from here on comm, rank and numProcs are those of the group converting this process's variable, which has its own writers
+    (groupIdx, comm) = splitByVariable([dataInPath for (datasetName, dataInPath, varName, timeVarName, metadataFnameOut) in datasets])
+    if numWriters is not None:
+        numWriters = max(1, int(round(numWriters*float(comm.Get_size())/fileComm.Get_size())))
+    rank = comm.Get_rank()
+    numProcs = comm.Get_size()
+    procsList = np.arange(numProcs)
+    configure(comm=comm)
+    datasets = [datasets[groupIdx]]
+    groupSuffix = "." + datasetNames[groupIdx]
+    report("Converting %s" % datasetNames[groupIdx])
+
+# the writers are spread over the physical nodes, however the launcher laid out the ranks
+ranksOnNodes = nodeLayout()
+if numWriters is None:
+    numWriters = len(ranksOnNodes)
+numWriters = min(numWriters, numProcs)
+writerRanks = assignWriters(ranksOnNodes, numWriters)
+configure(writerRanks=writerRanks, numWriters=numWriters)
+report("Running on %d nodes with %d to %d processes each" % (len(ranksOnNodes), min(map(len, ranksOnNodes)), max(map(len, ranksOnNodes))))
 report("Using %d processes" % numProcs)
-tempProcInfo = ProcessInformation()
-rhoProcInfo = ProcessInformation()
-tempFileNameList = loadFiles(tempDataInPath, tempVarName, tempTimeVarname, tempProcInfo)
-rhoFileNameList = loadFiles(rhoDataInPath, rhoVarName, rhoTimeVarname, rhoProcInfo)
-
-# expensive, but worth doing once to sanity check each dataset being converted
-if (verifyMaskQ):
-    verifyMask(procInfo)
-
-# write out the metadata  (NEED TO CHECK THAT THE SAME COLUMNS IN EACH DATASET CORRESPOND TO THE SAME TIMES!)
-if (rank == 0):
-    if (not np.all([tempProcInfo.timeStamps[r] == rhoProcInfo.timeStamps[r] for r in range(len(tempProcInfo.timeStamps))])):
-        print "Error: the columns of the temperature and density datasets are from observations at differing times"
-
-writeMetadata(tempMetadataFnameOut, tempProcInfo)
-writeMetadata(rhoMetadataFnameOut, rhoProcInfo)
-
+procInfos = {}
+fileNameLists = {}
+for (datasetName, dataInPath, varName, timeVarName, metadataFnameOut) in datasets:
+    procInfos[datasetName] = ProcessInformation()
+    # with --append, only the input files missing from the output's manifest are converted, into columns after the converted ones
+    manifest = readManifest(outFname, datasetName) if appendQ else None
+    fileNameLists[datasetName] = loadFiles(dataInPath, varName, timeVarName, procInfos[datasetName], manifest)
+checkColumnsAligned([procInfos[datasetName] for datasetName in datasetNames if datasetName in procInfos])
+
+if outputMode == "collective":
+    # have ROMIO aggregate the column blocks (collective buffering) rather than let every process hit the file system
+    mpiInfo.Set("romio_cb_write", "enable")
 report("Writer ranks : " + " ".join(map(lambda idx: str(chunkIdxToWriter(idx)), xrange(numWriters))))
 
 report("Creating the output file (this may take time)")
 fout = createFile(outFname)
-report("Writing temperatures")
-writeDataset("temp", tempProcInfo, tempVarName)
-report("Writing densities")
-writeDataset("rho", rhoProcInfo, rhoVarName)
+(layoutProcInfos, layoutFileNameLists) = (procInfos, fileNameLists)
+if concurrentQ:
+    (layoutProcInfos, layoutFileNameLists) = shareLayouts(datasetNames, procInfos, fileNameLists)
+rows = {}
+for datasetName in datasetNames:
+    rows[datasetName] = createOutputDataset(datasetName, layoutProcInfos[datasetName], layoutFileNameLists[datasetName])
+if concurrentQ:
+    if any([procInfo.collectiveWritesQ for procInfo in procInfos.values()]):
+        report("Error: concurrentQ can't append to a compressed output, as the groups can't take part in each other's collective writes")
+        sys.exit(1)
+    # only all the processes together can flush the file, so the datasets go to disk before the groups go their own ways;
+    # each group keeps its own journal, and the groups meet to flush the file as they record their levels (see shareFlushes)
+    fout.flush()
+journal = ConversionJournal(outFname + groupSuffix + ".journal" if journalQ else None, fout, resumeQ)
+for (datasetName, dataInPath, varName, timeVarName, metadataFnameOut) in datasets:
+    report("Writing %s" % varName)
+    writeDataset(datasetName, procInfos[datasetName], fileNameLists[datasetName], rows[datasetName])
+if appendQ:
+    # the new files only enter the manifests once all their columns are written, so an interrupted append can be run again
+    for datasetName in datasetNames:
+        writeColumnMetadata(fout["metadata/" + datasetName], layoutProcInfos[datasetName], layoutFileNameLists[datasetName])
+for (datasetName, dataInPath, varName, timeVarName, metadataFnameOut) in datasets:
+    writeMetadata(metadataFnameOut, procInfos[datasetName])
 
 # close the open files
-map(lambda fh: fh.close(), tempProcInfo.fileHandleList)
-map(lambda fh: fh.close(), rhoProcInfo.fileHandleList)
+for procInfo in procInfos.values():
+    map(lambda fh: fh.close(), procInfo.fileHandleList)
 fout.close()
+reportPhaseTimes(None if traceFnameOut is None else "%s%s%s" % (splitext(traceFnameOut)[0], groupSuffix, splitext(traceFnameOut)[1]))
+flushLogs()
+if not all([procInfo.masksMatchQ for procInfo in procInfos.values()]):
+    sys.exit(1)
\ No newline at end of file
@@ -3,269 +3,189 @@
 #
 """
 Test settings:
-ensure DEBUGFLAG = True
 module load h5py-parallel mpi4py netcdf4-python python
- srun -c 3 -n 200 -u python-mpi -u ./CFSRO_converter.py 
+ srun -c 3 -n 200 -u python-mpi -u ./CFSRO_converter.py --DEBUGFLAG true
 
-Full run settings:
-ensure DEBUGFLAG = False
+Full run settings (see the end of this file for the other settings, e.g. --dataInPath, --dataOutFname, --numWriters):
 salloc -N 100 -t 150 -p regular --qos=premium
 module load h5py-parallel mpi4py netcdf4-python python
-srun -c 3 -n 1000 -u python-mpi -u ./CFSRO_converter.py 
+srun -c 3 -n 1000 -u python-mpi -u ./CFSRO_converter.py --resizableOutputQ true
+
+Daily ingest of new files into an output created with --resizableOutputQ true (converts only the files missing from it):
+srun -c 3 -n 64 -u python-mpi -u ./CFSRO_converter.py --append
 """
 
 from mpi4py import MPI
 from netCDF4 import Dataset
-import h5py
 import numpy as np
 from os import listdir
-from os.path import isfile, join
-import time, math, sys
+from os.path import join
+import sys, hashlib
+
+from conversionHelpers import configure, configureEngine, status, report, reportBarrier, flushLogs, timedPhase, reportPhaseTimes, \
+        nodeLayout, assignWriters, chunkIdxToWriter, applyCommandLine, planColumnRanges, mpiInfo, readManifest, newFilesToAppend, \
+        numTimeSlicesInFile, createFile, createDataset, reportClippedValues, rowIndex, writeMetadataGroup, writeColumnMetadata, \
+        createChecksumDatasets, verifyMask, convertLevels, conversionPlan, ConversionJournal
 
 
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
-mpiInfo = MPI.Info.Create()
 numProcs = comm.Get_size()
 procsList = np.arange(numProcs)
 
 ### Helper functions and class
 
-def status(message, ranks=procsList):
-    """prints a message for each process in the ranks argument"""
-
-    messageToSend = "%s, process %d: %s" % (time.asctime(time.localtime()), rank, message)
-    messages = comm.gather(messageToSend, root=0)
-    if rank == 0:
-        for (idx, messageToPrint) in enumerate(messages):
-            if idx in ranks:
-                print messageToPrint
-
-def report(message):
-    """print a message from the root process"""
-    status(message, [0])
-
-def reportBarrier(message):
-    """synchronize all processes, then print a message from the root process"""
-    comm.Barrier()
-    report(message)
-
-def chunkIdxToWriter(chunkIdx):
-    """maps the chunkIdx (0...numWriters) to the rank of the process that should write it out"""
-    machineNumber = (chunkIdx % numNodes)
-    offsetOnMachine = chunkIdx/numNodes
-    return machineNumber*numProcessesPerNode + offsetOnMachine
-
-def loadFiles(dir, varName, timevarName, procInfo):
-    """gets the list of all filenames in the data directory, divides them among the processes, opens them, populates some metadata"""
-    fileNameList = [fname for fname in listdir(dir) if fname.endswith(".nc")]
+@timedPhase("loadFiles")
+def loadFiles(dir, varName, timevarName, procInfo, manifest=None):
+    """gets the list of all filenames in the data directory (or with a manifest of the existing output, the ones missing from it),
+    divides them among the processes, opens them, populates some metadata"""
+    fileNameList = sorted([fname for fname in listdir(dir) if fname.endswith(".nc")])
     if (DEBUGFLAG):
         fileNameList = fileNameList[:400]
         report("DEBUGGING! LIMITING NUMBER OF FILES CONVERTED")
+    # the columns of the files converted in this run start at firstOutputCol of the output
+    procInfo.firstOutputCol = 0
+    if manifest is not None:
+        fileNameList = newFilesToAppend(manifest, fileNameList, lambda fname: fname)
+        procInfo.firstOutputCol = manifest["numCols"]
     report("Found %d input files, starting to open" % len(fileNameList))
 
-    procInfo.fileNameList = [fname for (index, fname) in enumerate(fileNameList) if (index % numProcs == rank)]
+    # the columns are the time slices of the files in sorted order; each process gets a contiguous range of nearly the same number of them,
+    # which can start and end partway through a file, so the files need their number of time slices, read once (by one process each) and shared
+    numTimeSlicesPerFile = np.empty((len(fileNameList),), dtype=np.int)
+    localNumTimeSlices = [numTimeSlicesInFile(join(dir, fname), varName) for fname in fileNameList[rank::numProcs]]
+    for (otherRank, otherNumTimeSlices) in enumerate(comm.allgather(localNumTimeSlices)):
+        numTimeSlicesPerFile[otherRank::numProcs] = otherNumTimeSlices
+    if np.sum(numTimeSlicesPerFile) < numProcs:
+        report("Error: there are only %d time slices in the input files, fewer than the %d processes; run on fewer processes" % (np.sum(numTimeSlicesPerFile), numProcs))
+        sys.exit(1)
+    fileRanges = planColumnRanges(numTimeSlicesPerFile, numProcs)[rank]
+
+    procInfo.fileNameList = [fileNameList[fileIdx] for (fileIdx, firstTimeSlice, numTimeSlices) in fileRanges]
     procInfo.numFiles = len(procInfo.fileNameList)
     procInfo.fileHandleList = map( lambda fname: Dataset(join(dir, fname), "r"), procInfo.fileNameList)
-    procInfo.numTimeSlices = map( lambda fh: fh[varName].shape[0], procInfo.fileHandleList)
+    procInfo.firstTimeSlices = [firstTimeSlice for (fileIdx, firstTimeSlice, numTimeSlices) in fileRanges]
+    procInfo.numTimeSlices = [numTimeSlices for (fileIdx, firstTimeSlice, numTimeSlices) in fileRanges]
     procInfo.numLocalCols = np.sum(procInfo.numTimeSlices)
 
     procInfo.colsPerProcess = np.empty((numProcs,), dtype=np.int)
     comm.Allgather(procInfo.numLocalCols, procInfo.colsPerProcess)
     procInfo.numCols = sum(procInfo.colsPerProcess)
     procInfo.outputColOffsets = np.hstack([[0], np.cumsum(procInfo.colsPerProcess[:-1])])
-    procInfo.timeStamps = np.concatenate(map(lambda fh: fh[timevarName][:], procInfo.fileHandleList))
-    procInfo.timeSliceOffsets = list(np.concatenate([ [idx for idx in xrange(numslices)] for numslices in procInfo.numTimeSlices]))
+    # newer netCDF4 modules return masked arrays even when nothing is masked, which np.savez can't store
+    procInfo.timeStamps = np.concatenate(map(lambda (fh, firstTimeSlice, numTimeSlices): np.ma.getdata(fh[timevarName][firstTimeSlice:(firstTimeSlice + numTimeSlices)]),
+        zip(procInfo.fileHandleList, procInfo.firstTimeSlices, procInfo.numTimeSlices)))
+    procInfo.timeSliceOffsets = list(np.concatenate([range(firstTimeSlice, firstTimeSlice + numTimeSlices)
+        for (firstTimeSlice, numTimeSlices) in zip(procInfo.firstTimeSlices, procInfo.numTimeSlices)]))
     procInfo.repeatedFileNames = np.concatenate( map(lambda idx: [procInfo.fileNameList[idx]]*procInfo.numTimeSlices[idx], xrange(procInfo.numFiles)))
 
-    # assumes the missing masks for observations are the same across timeslices
-    procInfo.missingLocations = np.nonzero(procInfo.fileHandleList[0][varName][0, ...].mask.flatten())[0]
-    procInfo.observedLocations = np.nonzero(np.logical_not(procInfo.fileHandleList[0][varName][0, ...].mask.flatten()))[0]
-    procInfo.numRows = len(np.nonzero(np.logical_not(procInfo.fileHandleList[0][varName][0, ...].mask.flatten()))[0])
-
-    latList = procInfo.fileHandleList[0]["lat"][:]
-    lonList = procInfo.fileHandleList[0]["lon"][:]
-    lonCoordGrid, latCoordGrid = np.meshgrid(lonList, latList)
-    observedLatCoords = []
-    observedLonCoords = []
-    observedLevelNumbers = []
-    for levNum in xrange(procInfo.fileHandleList[0][varName].shape[1]):
-        observedLatMask = np.logical_not(procInfo.fileHandleList[0][varName][0, levNum, ...].mask)
-        observedLatCoords = np.concatenate([observedLatCoords, latCoordGrid[observedLatMask]])
-        observedLonCoords = np.concatenate([observedLonCoords, lonCoordGrid[observedLatMask]])
-        observedLevelNumbers = np.concatenate([observedLevelNumbers, [levNum]*np.count_nonzero(observedLatMask)])
-    procInfo.observedLatCoords = observedLatCoords
-    procInfo.observedLonCoords = observedLonCoords
-    procInfo.observedLevelNumbers = observedLevelNumbers
+    # assumes the missing masks for observations are the same across timeslices;
+    # rank 0 reads the (level x lat x lon) mask once and shares it, rather than every process reading it
+    missingMask = None
+    if rank == 0:
+        missingMask = np.ma.getmaskarray(procInfo.fileHandleList[0][varName][0, ...])
+    gridShape = comm.bcast(None if missingMask is None else missingMask.shape, root=0)
+    if rank != 0:
+        missingMask = np.empty(gridShape, dtype=np.bool_)
+    comm.Bcast([missingMask.view(np.uint8), MPI.BYTE], root=0)
+    procInfo.missingLocations = np.nonzero(missingMask.flatten())[0]
+    procInfo.observedLocations = np.nonzero(np.logical_not(missingMask.flatten()))[0]
+    procInfo.numRows = len(procInfo.observedLocations)
+    levelSize = np.prod(missingMask.shape[1:])
+    procInfo.numObservationsPerLevel = np.bincount(procInfo.observedLocations/levelSize, minlength=missingMask.shape[0])
+    if manifest is not None and hashlib.md5(procInfo.observedLocations.astype(np.int64).tostring()).hexdigest() != manifest["observedLocationsHash"]:
+        report("Error: the new input files are not missing the same grid points as the converted ones, so their rows would not line up")
+        sys.exit(1)
+
+    # the levels the conversion engine converts into rows (see convertLevels), all of the one variable, and the compression plan
+    # used by loadLevel: for each level, the flat indices of the observed grid points
+    procInfo.levels = [(0, curLev) for curLev in xrange(missingMask.shape[0])]
+    procInfo.variableHandles = [[fh[varName]] for fh in procInfo.fileHandleList]
+    procInfo.gridShapes = [missingMask.shape[1:]]
+    procInfo.gridSize = missingMask.size
+    procInfo.levelObservedIndices = map(lambda levelMask: np.nonzero(np.logical_not(levelMask.flatten()))[0], missingMask)
+
+    procInfo.columnTimeStamps = columnTimeStamps(procInfo)
+
+    # the coordinates of each row are only needed for the metadata, which rank 0 writes;
+    # np.nonzero lists the observed points in the same (level, lat, lon) order as the rows
+    procInfo.observedLatCoords = None
+    procInfo.observedLonCoords = None
+    procInfo.observedLevelNumbers = None
+    procInfo.metadataRootQ = rank == 0
+    if rank == 0:
+        (observedLevels, observedLatIndices, observedLonIndices) = np.nonzero(np.logical_not(missingMask))
+        latList = np.ma.getdata(procInfo.fileHandleList[0]["lat"][:])
+        lonList = np.ma.getdata(procInfo.fileHandleList[0]["lon"][:])
+        procInfo.observedLatCoords = latList[observedLatIndices].astype(np.float64)
+        procInfo.observedLonCoords = lonList[observedLonIndices].astype(np.float64)
+        procInfo.observedLevelNumbers = observedLevels.astype(np.float64)
+
+    # from here on the variables are read raw, and loadLevel picks out the observed points using the compression plan;
+    # with verifyMaskQ it also checks that each timeslice is missing the same points as the shared mask, recognizing them by the rule netCDF4 masks values by (see conversionHelpers.maskingRule)
+    map(lambda fh: fh.set_auto_mask(False), procInfo.fileHandleList)
+    procInfo.levelMissingMasks = missingMask.reshape(missingMask.shape[0], -1)
 
     return fileNameList
 
+@timedPhase("writeMetadata")
 def writeMetadata(foutName, procInfo):
-    """writes metadata for the converted dataset to a numpy file"""
+    """writes metadata for the converted dataset to a numpy file (the same metadata also goes in the output file, see writeMetadataGroup)"""
     # THERE'S A WEIRD ISSUE W/ TIMESLICEOFFSETS HAVING NONETYPE, SO CANT CONCATENATE IT HERE, NEED TO DO SO MANUALLY WHEN USING IT
     timeStamps = comm.gather(procInfo.timeStamps, root=0)
     timeSliceOffsets = comm.gather(procInfo.timeSliceOffsets, root=0)
     fileNames = comm.gather(procInfo.repeatedFileNames, root=0)
-    latList = procInfo.fileHandleList[0]["lat"][:]
-    lonList = procInfo.fileHandleList[0]["lon"][:]
-    depthList = procInfo.fileHandleList[0]["level0"][:]
 
     if rank == 0:
+        latList = procInfo.fileHandleList[0]["lat"][:]
+        lonList = procInfo.fileHandleList[0]["lon"][:]
+        depthList = procInfo.fileHandleList[0]["level0"][:]
         timeStamps = np.concatenate(timeStamps)
+        if appendQ:
+            # keep the columns converted by the earlier runs
+            with np.load(foutName, allow_pickle=True) as previousMetadata:
+                timeStamps = np.concatenate([previousMetadata["timeStamps"], timeStamps])
+                timeSliceOffsets = list(previousMetadata["timeSliceOffsets"]) + timeSliceOffsets
+                fileNames = list(previousMetadata["fileNames"]) + fileNames
+        (levelRowOffsets, gridRowIndex) = rowIndex(procInfo)
         np.savez(foutName, missingLocations=np.array(procInfo.missingLocations), timeStamps=timeStamps,
                 timeSliceOffsets=timeSliceOffsets, fileNames=fileNames, observedLatCoords=procInfo.observedLatCoords, 
                 observedLonCoords=procInfo.observedLonCoords, observedLevelNumbers=procInfo.observedLevelNumbers, latList=latList, lonList=lonList, depthList=depthList,
-                observedLocations=procInfo.observedLocations, numLevels=numLevels, numLats=numLats, numLongs=numLongs)
-
-def createDataset(fnameOut, procInfo):
-    propfaid = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
-    propfaid.set_fapl_mpio(comm, mpiInfo)
-    fid = h5py.h5f.create(fnameOut, flags=h5py.h5f.ACC_TRUNC, fapl=propfaid)
-    fout = h5py.File(fid)
-
-    spaceid = h5py.h5s.create_simple((procInfo.numRows, procInfo.numCols))
-    plist = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
-    plist.set_fill_time(h5py.h5d.FILL_TIME_NEVER)
-    datasetid = h5py.h5d.create(fout.id, "rows", h5py.h5t.NATIVE_DOUBLE, spaceid, plist)
-    rows = h5py.Dataset(datasetid)
-
-    return (fout, rows)
-
-def verifyMask(procInfo):
-    """checks that the missing masks are the same for each set of observations"""
-    reportBarrier("Verifying that the missing mask is the same for all observations")
-    reportBarrier("... checking equality of masks on each process")
-    missingLocations = set(np.nonzero(procInfo.fileHandleList[0][varname][0, ...].mask.flatten())[0])
-    for (fhIdx, fh) in enumerate(procInfo.fileHandleList):
-        for timeslice in xrange(procInfo.numTimeSlices[fhIdx]):
-            curMissingLocations = set(np.nonzero(fh[varname][timeslice, ...].mask.flatten())[0])
-            if curMissingLocations != missingLocations:
-                status("The missing masks do not match for some of my files")
-                sys.exit()
-    # would like to use reduce, but apparently this does a gather first, which would cause and issue
-    # (tree reduce is NOT implemented)
-    reportBarrier("... checking equality of masks across processes")
-    for sender in xrange(1, numProcs):
-        if rank == sender:
-            comm.send(missingLocations, dest=0, tag=0)
-        elif rank == 0:
-            curMissingLocations = comm.recv(source=sender, tag=0)
-            if curMissingLocations != missingLocations:
-                status("The missing masks do not match for some of the files")
-                sys.exit(1)
-
-def chunkIt(length, num):
-    """breaks xrange(length) into num roughly equally sized pieces, returns arrays of start and end indices"""
-    smallChunkSize = length/num
-    bigChunkSize = length/num + 1
-    numBigChunks = length - (length/num)*num
-    numSmallChunks = num - numBigChunks
-
-    startIndices = [0]
-    endIndices = []
-    numChunks = 0
-    while numChunks < numSmallChunks:
-        endIndices.append(startIndices[-1] + smallChunkSize)
-        startIndices.append(endIndices[-1])
-        numChunks = numChunks + 1
-    numChunks = 0
-    while numChunks < numBigChunks:
-        endIndices.append(startIndices[-1] + bigChunkSize)
-        startIndices.append(endIndices[-1])
-        numChunks = numChunks + 1
-    startIndices = startIndices[:-1]
-
-    return (startIndices, endIndices)
-
-def loadLevel(procInfo, varname, numLats, numLongs, curLev):
-    """loads all the observations from the files assigned to this process at level curLev, and returns as a 
-    numObservationsPerTimeStepPerLevel * (numColsInMyFiles) matrix"""
-
-    curLevMask = np.logical_not(procInfo.fileHandleList[0][varname][0, curLev, ...].mask.flatten())
-    procInfo.numObservationsPerTimeStepPerLevel = len(np.nonzero(curLevMask)[0])
-    curLevData = np.empty((procInfo.numObservationsPerTimeStepPerLevel, procInfo.numLocalCols), dtype=np.float32)
-    colOffset = 0
-    for (fhidx, fh) in enumerate(procInfo.fileHandleList):
-        numTimeSlices = procInfo.numTimeSlices[fhidx]
-        observedMask = np.logical_not(fh[varname][:, curLev, ...].mask)
-        observedValues = fh[varname][:, curLev, ...].data[observedMask]
-        curLevData[:, colOffset:(colOffset + numTimeSlices)] = \
-                observedValues.reshape(numTimeSlices, procInfo.numObservationsPerTimeStepPerLevel).transpose()
-        colOffset = colOffset + numTimeSlices
-
-    return curLevData
-
-# TODO: make return chunk a global variable
-def gatherDataAtWriter(curLevData, procInfo):
-    """Gathers all the row chunks of a given level of observations at the writer processes"""
-
-    chunkStartIndices, chunkEndIndices = chunkIt(procInfo.numObservationsPerTimeStepPerLevel, numWriters)
-    chunkSizes = map(lambda chunkIdx: chunkEndIndices[chunkIdx] - chunkStartIndices[chunkIdx], xrange(numWriters))
-    outputStartRows = np.hstack([[0], np.cumsum(chunkSizes)[:-1]])
-    returnChunk = [-1]
-    returnRowChunkSize = -1
-    returnOutputRowOffset = -1
-
-    for chunkIdx in xrange(numWriters):
-        writerRank = chunkIdxToWriter(chunkIdx)
-        curRowChunkSize = chunkSizes[chunkIdx]
-        chunkToTransfer = curLevData[chunkStartIndices[chunkIdx]:chunkEndIndices[chunkIdx], :].flatten()
-
-        processChunkSizes = curRowChunkSize*procInfo.colsPerProcess
-        processChunkDisplacements = np.hstack([[0], np.cumsum(processChunkSizes[:-1])])
-        collectedChunk = None
-        if rank == writerRank:
-            collectedChunk = np.empty((curRowChunkSize*procInfo.numCols), dtype=np.float32)
-        comm.Gatherv(sendbuf=[chunkToTransfer, MPI.FLOAT], \
-                     recvbuf=[collectedChunk, processChunkSizes, processChunkDisplacements, MPI.FLOAT], \
-                     root=writerRank)
-        if rank == writerRank:
-            returnChunk = collectedChunk
-            returnRowChunkSize = curRowChunkSize
-            returnOutputRowOffset = outputStartRows[chunkIdx]
-
-    #status("this chunk has %d rows and will be written starting at row %d" % \
-    #            (returnRowChunkSize, returnOutputRowOffset), ranks=writersList)
-    return (returnChunk, returnRowChunkSize, returnOutputRowOffset)
-
-def writeOutputRowChunks(rowChunk, numRowsInChunk, outputRowOffset, rows, procInfo):
-    """On writer processes, writes out the stored chunk of rows"""
-    chunkStartIndices, chunkEndIndices = chunkIt(procInfo.numObservationsPerTimeStepPerLevel, numWriters)
-
-    for chunkIdx in xrange(numWriters):
-        if rank == chunkIdxToWriter(chunkIdx):
-            assert(len(rowChunk)== numRowsInChunk*procInfo.numCols)
-            processChunkSizes = numRowsInChunk*procInfo.colsPerProcess
-            processChunkDisplacements = np.hstack([[0], np.cumsum(processChunkSizes[:-1])])
-            chunkToWrite = np.empty((numRowsInChunk, procInfo.numCols), dtype=np.float32)
-
-            for processNum in np.arange(numProcs):
-                outputStartCol = procInfo.outputColOffsets[processNum]
-                outputEndCol = outputStartCol + procInfo.colsPerProcess[processNum]
-                startChunkOffset = processChunkDisplacements[processNum]
-                endChunkOffset = startChunkOffset + numRowsInChunk*procInfo.colsPerProcess[processNum]
-                chunkToWrite[:, outputStartCol:outputEndCol] = np.reshape(rowChunk[startChunkOffset:endChunkOffset], \
-                        (numRowsInChunk, procInfo.colsPerProcess[processNum]))
-
-            startOutputRow = outputRowOffset
-            endOutputRow = outputRowOffset + numRowsInChunk
-            rows[startOutputRow:endOutputRow, :] = chunkToWrite
+                observedLocations=procInfo.observedLocations, numLevels=numLevels, numLats=numLats, numLongs=numLongs,
+                levelRowOffsets=levelRowOffsets, gridRowIndex=gridRowIndex)
+
+def columnTimeStamps(procInfo):
+    """the time stamps of this process's columns, as stored in the metadata group; they are rows of characters in the input files"""
+    return np.array(map("".join, procInfo.timeStamps))
+
 
 class ProcessInformation(object):
     def __init__(self):
         pass
 
-# Variables that should really be command-line settings
-#DEBUGFLAG = True
-#numNodes = 20
-#numProcessesPerNode = 10
-#numWriters = 20
+# Settings; any of them can be overridden with --config settings.json and --settingName value on the command line
+namesBeforeSettings = set(globals().keys())
 DEBUGFLAG = False
-numNodes = 100 # number of physical nodes
-numProcessesPerNode = 10
-numWriters = 60 # a good choice is one per physical node (probably up to the number of OSTs used)
-
-verifyMaskQ = False
+numWriters = 60 # None for one per physical node, which is a good choice (probably up to the number of OSTs used)
+redistributionMode = "alltoallv" # how levels move from readers to writers: "alltoallv" (one collective per level), "igatherv" (concurrent nonblocking gathers), or "gatherv" (one blocking gather per writer)
+pipelineDepth = 2 # number of levels read ahead of the one being redistributed and written (always with Ialltoallv); 0 converts the levels one step at a time
+threadSafeHDF5 = False # set if the HDF5 library is thread-safe, so reads of NETCDF4-format inputs can overlap the HDF5 writes
+outputPrecision = "float32" # on-disk type of the rows: "float64", "float32", "float16", or ("int16", scaleFactor, addOffset) to pack the values with an absolute error of at most scaleFactor/2
+outputChunkShape = None # None for a contiguous output dataset, "auto" for square chunks of about autoChunkBytes, or a (rows, columns) chunk shape
+autoChunkBytes = 1024*1024
+outputCompression = None # None, or a deflate level (1-9) to shuffle and deflate the chunks (auto-chunked if no chunk shape is given); needs parallel HDF5 >= 1.10.2, and makes all writes collective
+journalQ = True # record the converted (level, row chunk) units in a journal next to the output, so an interrupted run can be resumed
+resumeQ = False # set by --resume: reopen the output of an interrupted run and convert only the units missing from its journal
+appendQ = False # set by --append: convert only the input files missing from the output's manifest, into new columns of the existing output
+resizableOutputQ = False # create the output with an unlimited (and so chunked) column dimension, so later runs can --append to it
+outputMode = "writers" # "writers" funnels each level through the writer processes; "collective" has every process write its own columns with collective MPI-IO
+
+syncReportsQ = False # put a barrier in front of each progress report, so its timestamp marks when all the processes got there
+traceFnameOut = "/global/cscratch1/sd/gittens/conversion-code/CFSRO_conversion/output/oceanTrace.json" # None, or where to write the JSON trace of the time and bytes moved by each process in each step
+logDir = None # None, or a directory where each process writes its own log at the end of the run (otherwise the root process prints them)
+memoryBudget = None # None converts each level whole; otherwise the bytes each process may use for the buffers and temporaries of the conversion, and the levels are converted in blocks of latitudes that fit (see conversionHelpers.blockBytes)
+verifyMaskQ = True # check, as the levels are read, that every timeslice is missing the same grid points as the first one
+checksumsQ = True # compute the checksum, sum and sum of squares of each column on each level as it is read, and store them in /checksums for verifyConversion.py
 dataInPath = "/global/cscratch1/sd/nrcavana/CFSR_OCEAN/"
 dataOutFname = "/global/cscratch1/sd/gittens/conversion-code/CFSRO_conversion/output/ocean.h5"
 varname = "POT_L160_Avg_1"
@@ -276,45 +196,64 @@ numLevels = 40
 numLats = 360
 numLongs = 720
 
+applyCommandLine(globals(), sorted(set(globals().keys()) - namesBeforeSettings - set(["namesBeforeSettings"])), "converts the CFSRO dataset to HDF5",
+        [("resume", "resumeQ", "reopen the output of an interrupted run and convert only what its journal is missing"),
+         ("append", "appendQ", "convert only the input files that are new since the output was written, into new columns")])
+configure(syncReportsQ=syncReportsQ, logDir=logDir)
+configureEngine(globals())
+
 ### Setup the processes for reading and writing
+# the writers are spread over the physical nodes, however the launcher laid out the ranks
+ranksOnNodes = nodeLayout()
+if numWriters is None:
+    numWriters = len(ranksOnNodes)
+numWriters = min(numWriters, numProcs)
+writerRanks = assignWriters(ranksOnNodes, numWriters)
+configure(writerRanks=writerRanks, numWriters=numWriters)
+report("Running on %d nodes with %d to %d processes each" % (len(ranksOnNodes), min(map(len, ranksOnNodes)), max(map(len, ranksOnNodes))))
 
 report("Using %d processes" % numProcs)
 report("Writing variable %s " % varname)
 procInfo = ProcessInformation()
-fileNameList = loadFiles(dataInPath, varname, timevarname, procInfo)
-
-# expensive, but worth doing once to sanity check each dataset being converted
-if (verifyMaskQ):
-    verifyMask(procInfo)
-writeMetadata(metadataFnameOut, procInfo)
+# with --append, only the input files missing from the output's manifest are converted, into columns after the converted ones
+manifest = readManifest(dataOutFname, "rows") if appendQ else None
+fileNameList = loadFiles(dataInPath, varname, timevarname, procInfo, manifest)
 
+if outputMode == "collective":
+    # have ROMIO aggregate the column blocks (collective buffering) rather than let every process hit the file system
+    mpiInfo.Set("romio_cb_write", "enable")
 report("Writer ranks : " + " ".join(map(lambda idx: str(chunkIdxToWriter(idx)), xrange(numWriters))))
 reportBarrier("Creating output file and dataset")
-fout, rows = createDataset(dataOutFname, procInfo)
+fout = createFile(dataOutFname)
+rows = createDataset(fout, procInfo, "rows", outputPrecision)
+journal = ConversionJournal(dataOutFname + ".journal" if journalQ else None, fout, resumeQ)
+# each append is journaled as a dataset of its own, named after its first column
+journalName = "rows" if procInfo.firstOutputCol == 0 else "rows@%d" % procInfo.firstOutputCol
+journal.startDataset(journalName, conversionPlan(procInfo, fileNameList))
+writeMetadataGroup(fout, "rows", procInfo, fileNameList, [("numLevels", numLevels), ("numLats", numLats), ("numLongs", numLongs)],
+        ["observedLatCoords", "observedLonCoords", "observedLevelNumbers"],
+        [("latList", numLats, lambda fh: fh["lat"][:]), ("lonList", numLongs, lambda fh: fh["lon"][:]), ("depthList", numLevels, lambda fh: fh["level0"][:])],
+        comm.bcast(procInfo.columnTimeStamps.dtype, root=0))
+if checksumsQ:
+    createChecksumDatasets(fout, "rows", procInfo)
 reportBarrier("Finished creating output file and dataset")
 
 ### Write the data to the output file
 reportBarrier("Writing %s to file" % varname)
-
-chunkToWrite = None
-levelStartRow = 0
-writersList = map(chunkIdxToWriter, xrange(numWriters))
-for curLev in xrange(numLevels):
-    reportBarrier("Loading data for level %d/%d" % (curLev + 1, numLevels))
-    curLevData = loadLevel(procInfo, varname, numLats, numLongs, curLev)
-    reportBarrier("Done loading data for this level")
-    reportBarrier("There are %d observed grid points on this level" % procInfo.numObservationsPerTimeStepPerLevel)
-
-    reportBarrier("Gathering data for this level from processes to writers")
-    (curOutputRowChunk, curNumOutputRows, curOutputRowOffset) = gatherDataAtWriter(curLevData, procInfo)
-    reportBarrier("Done gathering")
-
-    reportBarrier("Writing data for this level on writers")
-    writeOutputRowChunks(curOutputRowChunk, curNumOutputRows, levelStartRow + curOutputRowOffset, rows, procInfo)
-    levelStartRow = levelStartRow + procInfo.numObservationsPerTimeStepPerLevel
+convertLevels(procInfo, rows, journalName, journal)
 
 reportBarrier("Done writing")
+reportClippedValues(procInfo)
+masksMatchQ = verifyMask(procInfo) if verifyMaskQ else True
+if appendQ:
+    # the new files only enter the manifest once all their columns are written, so an interrupted append can be run again
+    writeColumnMetadata(fout["metadata/rows"], procInfo, fileNameList)
+writeMetadata(metadataFnameOut, procInfo)
 
 # close the open files
 map(lambda fh: fh.close(), procInfo.fileHandleList)
 fout.close()
+reportPhaseTimes(traceFnameOut)
+flushLogs()
+if not masksMatchQ:
+    sys.exit(1)
\ No newline at end of file
@@ -1,215 +1,282 @@
 # TODO:
-#  -- processes should be able to handle uneven number of files
 #  -- should check that all time steps have the same mask of unobserved entries before proceeding
-#  -- should write out observation mask
-#  -- should write out column to date mapping
-
-# production run settings (took 19 minutes before w/ 100 nodes):
-# salloc -N 100 -t 25 -p regular --qos=premium
-# bash
-# module load h5py-parallel mpi4py netcdf4-python
-# srun -c 3 -n 1000 -u python-mpi -u ./fname.py variablename
-#
-# Optimizations:
-# - turn off fill at allocation in hdf5
-# - use an output directory that has 140 OSTs
-# - turn on alignment with striping (use output from lfs getstripe to set alignment)
-#
-# Note: apparently, the number of aggregator processes is set to the number of OSTs
+"""
+Converts several variables of the atmosphere NetCDF files into the rows of one HDF5 matrix: the rows are the grid points of
+each (variable, level) in turn, in the order of varNames, and the columns are the time slices, timeSlicesPerFile of them
+from each file in sorted order. Short files repeat their first time slice, and files without the variable hold missingFileFillValue.
+
+It runs the conversion engine of the ocean converters (see conversionHelpers.py), converting in blocks of latitudes the same way,
+reading its files through its own readFileBlock hook; but it doesn't have their verifyMaskQ check, checksums, journal (so no --resume
+or --append), outputPrecision or collective output mode: the rows are written by the writers as float32.
+
+Production run settings (took 19 minutes before w/ 100 nodes; see the end of this file for the other settings):
+salloc -N 100 -t 25 -p regular --qos=premium
+module load h5py-parallel mpi4py netcdf4-python python
+srun -c 3 -n 1000 -u python-mpi -u ./atmosphere_converter.py --dataInPath /path/to/atmosphere/ --varNames '["TMP_L100", "R_H_L100"]'
+
+Optimizations:
+- turn off fill at allocation in hdf5
+- use an output directory that has 140 OSTs
+- turn on alignment with striping (use output from lfs getstripe to set alignment)
+
+Note: apparently, the number of aggregator processes is set to the number of OSTs
+"""
 
 from mpi4py import MPI
 from netCDF4 import Dataset
-import h5py
 import numpy as np
 from os import listdir
-from os.path import isfile, join
-import time
-import math, sys
+from os.path import join
+import sys
+
+from conversionHelpers import configure, configureEngine, status, report, reportBarrier, flushLogs, timedPhase, reportPhaseTimes, \
+        nodeLayout, assignWriters, chunkIdxToWriter, applyCommandLine, planColumnRanges, createFile, createDataset, readTimeSlices, \
+        extractObserved, convertLevels, conversionPlan, ConversionJournal
+
+
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+numProcs = comm.Get_size()
+procsList = np.arange(numProcs)
+
+### Helper functions and class
+
+def variableMasks(dir, fileNameList, varNames):
+    """the (level x lat*lon) mask of the missing grid points of each variable, taken from the first time slice of the first file
+    that has one; without maskCompressionQ nothing is masked. Rank 0 reads them and shares them with the other processes"""
+    masks = [None]*len(varNames)
+    if rank == 0:
+        gridShapes = [None]*len(varNames)
+        for fname in fileNameList:
+            fh = Dataset(join(dir, fname), "r")
+            for (varIdx, varName) in enumerate(varNames):
+                variable = fh[varName]
+                # the time slices of a 3D (time, lat, lon) variable form a single level
+                gridShapes[varIdx] = gridShapes[varIdx] or ((variable.shape[1] if variable.ndim == 4 else 1), np.prod(variable.shape[-2:]))
+                if masks[varIdx] is None and maskCompressionQ and variable.shape[0] > 0:
+                    masks[varIdx] = np.ma.getmaskarray(variable[0, ...]).reshape(gridShapes[varIdx])
+            fh.close()
+            if not maskCompressionQ or all([mask is not None for mask in masks]):
+                break
+        for (varIdx, gridShape) in enumerate(gridShapes):
+            if masks[varIdx] is None:
+                masks[varIdx] = np.zeros(gridShape, dtype=np.bool_)
+    maskShapes = comm.bcast(None if rank != 0 else [mask.shape for mask in masks], root=0)
+    for (varIdx, maskShape) in enumerate(maskShapes):
+        if rank != 0:
+            masks[varIdx] = np.empty(maskShape, dtype=np.bool_)
+        comm.Bcast([masks[varIdx].view(np.uint8), MPI.BYTE], root=0)
+    return masks
+
+def columnTimeStamps(fh, firstTimeSlice, numTimeSlices):
+    """the time stamps of the columns of time slices firstTimeSlice... of the file, repeating its first one past its end as readFileBlock
+    does with the values (an empty string, or NaN for numeric time stamps, when it has none); time stamps stored as rows of characters
+    are joined"""
+    timeStamps = np.ma.getdata(fh[timeVarName][:])
+    if timeStamps.ndim == 2:
+        # keeps the string type even for a file without time slices, so its columns get empty time stamps
+        timeStamps = np.array(map("".join, timeStamps), dtype="S%d" % timeStamps.shape[1])
+    elif timeStamps.dtype.kind not in "SU":
+        timeStamps = timeStamps.astype(np.float64)
+    timeSlices = np.arange(firstTimeSlice, firstTimeSlice + numTimeSlices)
+    timeSlices[timeSlices >= len(timeStamps)] = 0 if len(timeStamps) > 0 else -1
+    # index -1 picks out the blank appended at the end
+    blank = np.array(["" if timeStamps.dtype.kind in "SU" else np.nan], dtype=timeStamps.dtype)
+    return np.concatenate([timeStamps, blank])[timeSlices]
+
+@timedPhase("loadFiles")
+def loadFiles(dir, varNames, procInfo):
+    """gets the sorted list of all the filenames in the data directory, divides their columns among the processes, opens the files,
+    and works out the rows: for each (variable, level), the grid points kept (all of them, or with maskCompressionQ the observed ones)"""
+    fileNameList = sorted([fname for fname in listdir(dir) if fname.endswith(".nc")])
+    if (DEBUGFLAG):
+        fileNameList = fileNameList[:40]
+        report("DEBUGGING! LIMITING NUMBER OF FILES CONVERTED")
+    report("Found %d input files, starting to open" % len(fileNameList))
+
+    # every file fills timeSlicesPerFile columns, however many time slices it has of each variable,
+    # so each process gets a contiguous range of nearly the same number of columns without reading the files first
+    if len(fileNameList)*timeSlicesPerFile < numProcs:
+        report("Error: there are only %d columns in the input files, fewer than the %d processes; run on fewer processes" % (len(fileNameList)*timeSlicesPerFile, numProcs))
+        sys.exit(1)
+    fileRanges = planColumnRanges([timeSlicesPerFile]*len(fileNameList), numProcs)[rank]
 
-rank = MPI.COMM_WORLD.Get_rank()
-mpi_info = MPI.Info.Create()
-numProcs = MPI.COMM_WORLD.Get_size()
+    procInfo.fileIndices = [fileIdx for (fileIdx, firstTimeSlice, numTimeSlices) in fileRanges]
+    procInfo.fileNameList = [fileNameList[fileIdx] for fileIdx in procInfo.fileIndices]
+    procInfo.numFiles = len(procInfo.fileNameList)
+    procInfo.fileHandleList = map( lambda fname: Dataset(join(dir, fname), "r"), procInfo.fileNameList)
+    procInfo.firstTimeSlices = [firstTimeSlice for (fileIdx, firstTimeSlice, numTimeSlices) in fileRanges]
+    procInfo.numTimeSlices = [numTimeSlices for (fileIdx, firstTimeSlice, numTimeSlices) in fileRanges]
+    procInfo.numLocalCols = np.sum(procInfo.numTimeSlices)
+    procInfo.firstOutputCol = 0
 
-numProcessesPerNode = 10
+    procInfo.colsPerProcess = np.empty((numProcs,), dtype=np.int)
+    comm.Allgather(procInfo.numLocalCols, procInfo.colsPerProcess)
+    procInfo.numCols = sum(procInfo.colsPerProcess)
+    procInfo.outputColOffsets = np.hstack([[0], np.cumsum(procInfo.colsPerProcess[:-1])])
+    procInfo.timeStamps = np.concatenate(map(lambda (fh, firstTimeSlice, numTimeSlices): columnTimeStamps(fh, firstTimeSlice, numTimeSlices),
+        zip(procInfo.fileHandleList, procInfo.firstTimeSlices, procInfo.numTimeSlices)))
 
-procslist = np.arange(numProcs)
+    # the number of time slices each of my files actually has of each variable
+    procInfo.variableHandles = [[fh[varName] for varName in varNames] for fh in procInfo.fileHandleList]
+    procInfo.fileLengths = [[variable.shape[0] for variable in variables] for variables in procInfo.variableHandles]
+    for (fhidx, fileLengths) in enumerate(procInfo.fileLengths):
+        if procInfo.firstTimeSlices[fhidx] > 0:
+            continue # reported by the process with the start of the file
+        for (varIdx, fileLength) in enumerate(fileLengths):
+            if fileLength == 0:
+                status("File %s has no timesteps for variable %s, filling its columns with %g" % (procInfo.fileNameList[fhidx], varNames[varIdx], missingFileFillValue))
+            elif fileLength < timeSlicesPerFile:
+                status("File %s has only %d timesteps for variable %s, simply repeating the first timestep" % (procInfo.fileNameList[fhidx], fileLength, varNames[varIdx]))
+            elif fileLength > timeSlicesPerFile:
+                status("File %s has %d timesteps for variable %s, only converting the first %d" % (procInfo.fileNameList[fhidx], fileLength, varNames[varIdx], timeSlicesPerFile))
 
-def status(message, ranks=procslist):
-    if rank in ranks:
-        print "%s, process %d: %s" % (time.asctime(time.localtime()), rank, message)
+    # the rows, in order: the kept grid points of each level of each variable
+    procInfo.masks = variableMasks(dir, fileNameList, varNames)
+    procInfo.levels = []
+    procInfo.levelObservedIndices = []
+    for (varIdx, mask) in enumerate(procInfo.masks):
+        for (curLev, levelMask) in enumerate(mask):
+            procInfo.levels.append((varIdx, None if procInfo.variableHandles[0][varIdx].ndim == 3 else curLev))
+            # None keeps every grid point, which saves picking them all out one by one
+            procInfo.levelObservedIndices.append(np.nonzero(np.logical_not(levelMask))[0] if levelMask.any() else None)
+    procInfo.numObservationsPerLevel = np.array([np.count_nonzero(np.logical_not(levelMask)) for mask in procInfo.masks for levelMask in mask])
+    procInfo.numRows = np.sum(procInfo.numObservationsPerLevel)
 
-def report(message):
-    status(message, [0])
+    # from here on the variables are read raw, and readFileBlock picks out the kept points; the levels are converted in blocks of
+    # latitudes, see conversionHelpers.planBlocks
+    map(lambda fh: fh.set_auto_mask(False), procInfo.fileHandleList)
+    procInfo.gridShapes = [variable.shape[-2:] for variable in procInfo.variableHandles[0]]
 
-def reportbarrier(message):
-    MPI.COMM_WORLD.Barrier()
-    report(message)
+    return fileNameList
 
-# maps the chunkidx (0...numlevdivs=numWriters) to the rank of the process that should write it out
-def chunkidxToWriter(chunkidx):
-   return (chunkidx*numProcessesPerNode)%numProcs # should always write from different nodes
+@timedPhase("writeMetadata")
+def writeMetadata(foutName, procInfo, fileNameList, varNames):
+    """writes the metadata of the output matrix to a numpy file: for the rows, the (variable, level) of each block of rows
+    (levelVarIndices, levelNumbers, with -1 for variables without levels, and levelRowOffsets) and the mask of the grid points each
+    variable is missing (observedMask_<varName>, the rows are its other points in order); for the columns, the time stamp of each
+    one (empty, or NaN for numeric time stamps, for a file without time slices), the input files (column c comes from file
+    c/timeSlicesPerFile) and the number of time slices each has of each variable"""
+    timeStamps = comm.gather(procInfo.timeStamps, root=0)
+    fileLengths = comm.gather(zip(procInfo.fileIndices, procInfo.fileLengths), root=0)
 
-datapath = "/global/cscratch1/sd/nrcavana/CFSR_OCEAN/"
-metadataFname = "/global/cscratch1/sd/gittens/conversion-code/ocean_conversion/ocean_metadata.npz"
-filelist = [fname for fname in listdir(datapath) if fname.endswith(".nc")]
-varname = "POT_L160_Avg_1"
-timevarname = "ref_date_time"
+    if rank == 0:
+        fileLengthsTable = np.zeros((len(fileNameList), len(varNames)), dtype=np.int)
+        for (fileIdx, lengths) in sum(fileLengths, []):
+            fileLengthsTable[fileIdx] = lengths
+        latList = np.ma.getdata(procInfo.fileHandleList[0][latVarName][:])
+        lonList = np.ma.getdata(procInfo.fileHandleList[0][lonVarName][:])
+        masks = dict([("observedMask_" + varName, np.logical_not(mask)) for (varName, mask) in zip(varNames, procInfo.masks)])
+        np.savez(foutName, varNames=np.array(varNames), timeStamps=np.concatenate(timeStamps), fileNames=np.array(fileNameList),
+                timeSlicesPerFile=timeSlicesPerFile, fileLengths=fileLengthsTable, missingFileFillValue=missingFileFillValue,
+                levelVarIndices=np.array([varIdx for (varIdx, curLev) in procInfo.levels]),
+                levelNumbers=np.array([-1 if curLev is None else curLev for (varIdx, curLev) in procInfo.levels]),
+                levelRowOffsets=np.hstack([[0], np.cumsum(procInfo.numObservationsPerLevel)]).astype(np.int64),
+                latList=latList, lonList=lonList, **masks)
 
-# FOR TESTING ONLY: REMOVE WHEN RUNNING FINAL JOB
-#filelist = [fname for fname in filelist[:1000]]
+def readFileBlock(procInfo, fhidx, levelIdx, startLat, endLat, observedIndices, observedValues):
+    """the conversion engine's hook for reading a block of a (variable, level) from one of my files (see conversionHelpers.readFileBlock):
+    the time slices of my range past the end of a short file repeat its first one, and a file without the variable gives
+    missingFileFillValue, filled in by broadcasting. There is no mask check to feed, so it returns None"""
+    (varIdx, curLev) = procInfo.levels[levelIdx]
+    variable = procInfo.variableHandles[fhidx][varIdx]
+    numTimeSlices = procInfo.numTimeSlices[fhidx]
+    firstTimeSlice = procInfo.firstTimeSlices[fhidx]
+    fileLength = procInfo.fileLengths[fhidx][varIdx]
+
+    # the time slices of my range that the file has
+    numReadSlices = max(0, min(firstTimeSlice + numTimeSlices, fileLength) - firstTimeSlice)
+    if numReadSlices > 0:
+        rawValues = readTimeSlices(variable, curLev, firstTimeSlice, numReadSlices, startLat, endLat)
+        extractObserved(rawValues, observedIndices, observedValues[:numReadSlices])
+    if numReadSlices < numTimeSlices:
+        if fileLength == 0:
+            observedValues[numReadSlices:] = missingFileFillValue
+        else:
+            firstSliceRow = 0
+            if firstTimeSlice > 0 or numReadSlices == 0:
+                # my range doesn't start with the first time slice, so it goes after the ones read
+                rawValues = readTimeSlices(variable, curLev, 0, 1, startLat, endLat)
+                extractObserved(rawValues, observedIndices, observedValues[numReadSlices:(numReadSlices + 1)])
+                firstSliceRow = numReadSlices
+                numReadSlices = numReadSlices + 1
+            observedValues[numReadSlices:] = observedValues[firstSliceRow]
+    return None
+
+def levelName(procInfo, levelIdx, varNames):
+    """names the (variable, level) levelIdx in the progress reports"""
+    (varIdx, curLev) = procInfo.levels[levelIdx]
+    return "%s level %d (%d/%d)" % (varNames[varIdx], 0 if curLev is None else curLev, levelIdx + 1, len(procInfo.levels))
+
+class ProcessInformation(object):
+    def __init__(self):
+        pass
+
+# Settings; any of them can be overridden with --config settings.json and --settingName value on the command line
+namesBeforeSettings = set(globals().keys())
+DEBUGFLAG = False
+numWriters = 60 # None for one per physical node, which is a good choice (probably up to the number of OSTs used)
+pipelineDepth = 2 # number of blocks of latitudes (whole levels, without a memoryBudget) read ahead of the one being redistributed and written; 0 converts the blocks one step at a time
+threadSafeHDF5 = False # set if the HDF5 library is thread-safe, so reads of NETCDF4-format inputs can overlap the HDF5 writes
+maskCompressionQ = True # keep only the grid points observed in the first time slice of each variable as rows; otherwise every grid point is a row
+timeSlicesPerFile = 4 # the number of columns taken from each file; shorter files repeat their first time slice, the time slices of longer ones past this are ignored
+missingFileFillValue = 0.0 # the value of the columns of a file that has no time slices of a variable
+memoryBudget = None # None converts each level whole; otherwise the bytes each process may use for the buffers and temporaries of the conversion, and the levels are converted in blocks of latitudes that fit (see conversionHelpers.blockBytes)
+
+syncReportsQ = False # put a barrier in front of each progress report, so its timestamp marks when all the processes got there
+traceFnameOut = None # None, or where to write the JSON trace of the time and bytes moved by each process in each step
+logDir = None # None, or a directory where each process writes its own log at the end of the run (otherwise the root process prints them)
+dataInPath = None # the directory of the atmosphere NetCDF files
+dataOutFname = None # None to write atmosphere.h5 in dataInPath
+metadataFnameOut = None # None to write atmosphereMetadata.npz in dataInPath
+varNames = [] # the variables to convert, in the order their rows are laid out
+timeVarName = "ref_date_time"
+latVarName = "lat"
+lonVarName = "lon"
+
+applyCommandLine(globals(), sorted(set(globals().keys()) - namesBeforeSettings - set(["namesBeforeSettings"])), "converts atmosphere variables to HDF5")
+configure(syncReportsQ=syncReportsQ, logDir=logDir)
+configureEngine(globals())
+if dataInPath is None or len(varNames) == 0:
+    report("Error: give the input directory and the variables to convert with --dataInPath and --varNames")
+    sys.exit(1)
+if dataOutFname is None:
+    dataOutFname = join(dataInPath, "atmosphere.h5")
+if metadataFnameOut is None:
+    metadataFnameOut = join(dataInPath, "atmosphereMetadata.npz")
+
+### Setup the processes for reading and writing
+# the writers are spread over the physical nodes, however the launcher laid out the ranks
+ranksOnNodes = nodeLayout()
+if numWriters is None:
+    numWriters = len(ranksOnNodes)
+numWriters = min(numWriters, numProcs)
+writerRanks = assignWriters(ranksOnNodes, numWriters)
+configure(writerRanks=writerRanks, numWriters=numWriters)
+report("Running on %d nodes with %d to %d processes each" % (len(ranksOnNodes), min(map(len, ranksOnNodes)), max(map(len, ranksOnNodes))))
 
 report("Using %d processes" % numProcs)
-report("Writing variable %s" % varname)
-report("Found %d input files, starting to open" % len(filelist))
-
-# open all the files associated with this process and keep handles around (avoid metadata costs)
-myfiles = [fname for (index, fname) in enumerate(filelist) if (index % numProcs == rank)]
-numLocalFiles = len(myfiles)
-myhandles = [None]*numLocalFiles
-numLocalTimeSlices = [] # some files have different number of time slices
-for (idx, fname) in enumerate(myfiles):
-    myhandles[idx] = Dataset(join(datapath, fname), "r") 
-    numLocalTimeSlices.append(myhandles[idx][varname].shape[0])
-
-# send the number of time slices in each file to the root
-timeSlicesPerProcess = MPI.COMM_WORLD.gather(numLocalTimeSlices, root=0)
-numColsPerProcess = map(np.sum, timeSlicesPerProcess)
-
-reportbarrier("Finished opening all files")
-
-numlevels = 40
-numlats = 360
-numlongs = 720
-
-verifymask = False
-if verifymask:
-    # Optionally check that all the missing masks are the same
-    reportbarrier("Verifying that the missing mask is the same for all observations")
-    reportbarrier("Checking equality of masks on each process")
-    missingLocations = set(np.nonzero(myhandles[0][varname][0, ...].mask.flatten())[0])
-    for (fhidx, fh) in enumerate(myhandles):
-        for timeslice in xrange(numLocalTimeSlices[fhidx]):
-            curMissingLocations = set(np.nonzero(fh[varname][timeslice, ...].mask.flatten())[0])
-            if curMissingLocations != missingLocations:
-                status("The missing masks do not match for some of my files")
-                sys.exit(1)
-
-    # would like to use reduce, but apparently this does a gather first, which
-    # would cause an issue (why isn't tree reduce implemented?)
-    reportbarrier("Checking equality of masks across processes")
-    for sender in xrange(1, numProcs):
-        if rank == sender:
-            MPI.COMM_WORLD.send(missingLocations, dest=0, tag=0)
-        elif rank == 0:
-            curMissingLocations = MPI.COMM_WORLD.recv(source=sender, tag=0)
-            if curMissingLocations != missingLocations:
-                status("The missing masks do not match for some of my files")
-                sys.exit(1)
-else:
-    # Assuming the missing masks are all the same
-    missingLocations = set(np.nonzero(myhandles[0][varname][0, ...].mask.flatten())[0])
-    
-# Store the indices of missing values for future use
-# and the time-date stamps corresponding to each column of the matrix
-reportbarrier("Storing the locations of missing values and the time-date stamps for each column of the output matrix")
-timeStampsList = [None]*numLocalFiles
-for (idx, fh) in enumerate(myhandles):
-    timeStampsList[idx] = fh[timevarname][:]
-timeStamps = np.concatenate(timeStampsList)
-timeStamps = MPI.COMM_WORLD.gather(timeStamps, root=0)
-if rank == 0:
-    timeStamps = np.concatenate(timeStamps)
-    numpy.savez(metadataFname, missingLocations=np.array(missingLocations), 
-                               timeStamps=timeStamps)
-
-relevantLocations = np.nonzero(np.logical_not(myhandles[0][varname][0, ...].mask.flatten()))[0] # indices of the locations that were observed
-numdivs = 2 # number of chunks to write out each level of observations in
-numRows = len(relevantLocations)
-numCols = np.sum(numColsPerProcess)
-
-numWriters = numlevdivs 
-foutname = varname
-
-reportbarrier("Creating output file and dataset")
-#Ask for alignment with the stripe size (use lfs getstripe on target directory to determine)
-propfaid = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
-propfaid.set_fapl_mpio(MPI.COMM_WORLD, mpi_info)
-#propfaid.set_alignment(1024, 1024*1024)
-#driver='mpio', comm=MPI.COMM_WORLD
-
-fid = h5py.h5f.create(join(datapath, foutname + ".h5"), flags=h5py.h5f.ACC_TRUNC, fapl=propfaid)
-fout = h5py.File(fid)
-
-# Don't use filling 
-spaceid = h5py.h5s.create_simple((numRows, numCols))
-plist = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
-plist.set_fill_time(h5py.h5d.FILL_TIME_NEVER)
-datasetid = h5py.h5d.create(fout.id, "rows", h5py.h5t.NATIVE_FLOAT, spaceid, plist)
-rows = h5py.Dataset(datasetid)
-reportbarrier("Finished creating output file and dataset")
-
-localcolumncount = np.sum(numLocalTimeSlices)
-curlevdata = np.empty((numlats*numlongs, localcolumncount), dtype=np.float32)
-chunktotransfer = np.empty((rowChunkSize*localcolumncount,), dtype=np.float32)
-
-listwriter = map(chunkidxToWriter, np.arange(numWriters))
-if rank in listwriter:
-    collectedchunk = np.ascontiguousarray(np.empty((numCols*rowChunkSize,), \
-            dtype=np.float32))
-    chunktowrite = np.ascontiguousarray(np.empty((rowChunkSize, numCols), \
-            dtype=np.float32))
-else:
-    collectedchunk = None
-curlevdatatemp=np.ascontiguousarray(np.zeros((numlats*numlongs*numtimeslices), \
-            dtype=np.float32))
-#currowoffset = 0
-for (varidx,curvar) in enumerate(varnames): 
-    reportbarrier("Writing variable %d/%d: %s" % (varidx + 1, numvars, curvar))
-
-    for curlev in np.arange(numlevels):
-
-        # load the data for this level from my files
-        reportbarrier("Loading data for level %d/%d" % (curlev + 1, numlevels))
-        for (fhidx, fh) in enumerate(myhandles):
-            if fh[curvar].shape[0] < numtimeslices and fh[curvar].shape[0] >0:
-                status("File %s has only %d timesteps for variable %s, simply repeating the first timestep" % (myfiles[fhidx], fh[curvar].shape[0], curvar))
-                for idx in np.arange(numtimeslices):
-                    curlevdatatemp[numlats*numlongs*idx:numlats*numlongs*(idx+1)] = fh[curvar][0, curlev, ...].flatten()
-                curlevdata[:, fhidx*numtimeslices: (fhidx + 1)*numtimeslices]=curlevdatatemp.reshape(numlats*numlongs, numtimeslices)
-                curlevdatatemp=np.ascontiguousarray(np.zeros((numlats*numlongs*numtimeslices), dtype=np.float32)) 
-            elif fh[curvar].shape[0] ==0:
-                status("File %s has only %d timesteps for variable %s, simply repeating the first timestep" % (myfiles[fhidx], fh[curvar].shape[0], curvar))
-                curlevdata[:, fhidx*numtimeslices: (fhidx + 1)*numtimeslices] = \
-                        curlevdatatemp.reshape(numlats*numlongs, numtimeslices)
-            else:
-                curlevdata[:, fhidx*numtimeslices: (fhidx + 1)*numtimeslices] = \
-                    fh[curvar][:, curlev, ...].reshape(numlats*numlongs, numtimeslices)
-        reportbarrier("Done loading data for this level")
-        
-        # write out this level in several chunks of rows
-        reportbarrier("Gathering data for this level from processes to writers")
-        for chunkidx in np.arange(numlevdivs):
-            startrow = chunkidx*rowChunkSize
-            endrow = startrow + rowChunkSize
-            chunktotransfer[:] = curlevdata[startrow:endrow, :].flatten()
-            MPI.COMM_WORLD.Gather(chunktotransfer, collectedchunk, root = chunkidxToWriter(chunkidx))
-        reportbarrier("Done gathering")
-        reportbarrier("Writing data for this level on writers")
-        for chunkidx in np.arange(numlevdivs):
-            if rank == chunkidxToWriter(chunkidx):
-                for processnum in np.arange(numProcs):
-                    startcol = processnum*localcolumncount
-                    endcol = (processnum+1)*localcolumncount
-                    startidx = processnum*(localcolumncount * rowChunkSize)
-                    endidx = (processnum + 1)*(localcolumncount *rowChunkSize)
-                    chunktowrite[:, startcol:endcol] = np.reshape(collectedchunk[startidx:endidx], \
-                            (rowChunkSize, localcolumncount))
-                start_rows = varidx*numlevels*numlats*numlongs+curlev*numlats*numlongs+rowChunkSize*chunkidx
-                end_rows = start_rows+rowChunkSize
-                rows[start_rows:end_rows, :] = chunktowrite
-        reportbarrier("Done writing")
-
-for fh in myhandles:
-    fh.close()
-fout.close()
+report("Writing variables %s" % ", ".join(varNames))
+procInfo = ProcessInformation()
+fileNameList = loadFiles(dataInPath, varNames, procInfo)
+report("The output has %d rows and %d columns" % (procInfo.numRows, procInfo.numCols))
+
+report("Writer ranks : " + " ".join(map(lambda idx: str(chunkIdxToWriter(idx)), xrange(numWriters))))
+reportBarrier("Creating output file and dataset")
+fout = createFile(dataOutFname)
+rows = createDataset(fout, procInfo, "rows", "float32")
+# without a journal file every level is converted
+journal = ConversionJournal(None, fout, False)
+journal.startDataset("rows", conversionPlan(procInfo, fileNameList))
+reportBarrier("Finished creating output file and dataset")
 
+### Write the data to the output file
+convertLevels(procInfo, rows, "rows", journal, readFileBlock, lambda procInfo, levelIdx: levelName(procInfo, levelIdx, varNames))
+reportBarrier("Done writing")
+writeMetadata(metadataFnameOut, procInfo, fileNameList, varNames)
+
+# close the open files
+map(lambda fh: fh.close(), procInfo.fileHandleList)
+fout.close()
+reportPhaseTimes(traceFnameOut)
+flushLogs()
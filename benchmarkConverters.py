@@ -0,0 +1,206 @@
+# Runs the converters on synthetic data (see generateSyntheticData.py) under a local mpirun, for several numbers of processes,
+# reports the throughput of each phase from the timing traces, and checks every converted column against the input files
+#
+# The input check only covers the values of the rows; with --reference, the whole output (the rows, the metadata group and the
+# checksums, with their types and attributes) is also compared with the stored output of a trusted run on the same synthetic data,
+# which --save-reference stores from the first run of each converter that matches its inputs
+#
+# To run (needs mpi4py, netCDF4 and a parallel build of h5py):
+#  python benchmarkConverters.py workDir --ranks 2 4 8 16 --mpirun-args "--oversubscribe" --reference referenceDir [--save-reference]
+# exits with a nonzero status if any conversion fails, does not match its inputs, or differs from its reference output
+
+from netCDF4 import Dataset
+import h5py
+import numpy as np
+from os import makedirs
+from os.path import abspath, dirname, isdir, isfile, join
+import argparse, json, shlex, shutil, subprocess, sys, time
+from generateSyntheticData import generateCFSRO, generateCESM
+
+scriptDir = dirname(abspath(__file__))
+reportedPhases = ["loadFiles", "loadLevel", "redistribute", "writeRows"]
+
+def phaseThroughputs(traceFname):
+    """the MB/s of each phase in a timing trace, over the summed time of the slowest process in each step"""
+    with open(traceFname, "r") as traceFile:
+        trace = json.load(traceFile)
+    phaseTotals = {}
+    for step in trace["steps"]:
+        (numBytes, seconds) = phaseTotals.get(step["phase"], (0, 0.0))
+        phaseTotals[step["phase"]] = (numBytes + step["totalBytes"], seconds + step["maxSeconds"])
+    return dict([(phaseName, numBytes/1e6/seconds if seconds > 0 else 0.0) for (phaseName, (numBytes, seconds)) in phaseTotals.items()])
+
+def verifyOutput(outputFname, datasetName, metadataFname, dataDir, varName):
+    """compares every column of the converted dataset with the observed values of the time slice it was taken from,
+    and returns the number of columns that differ"""
+    metadata = np.load(metadataFname, allow_pickle=True)
+    fileNames = np.concatenate([np.array(item) for item in metadata["fileNames"]])
+    timeSliceOffsets = np.concatenate([np.array(item) for item in metadata["timeSliceOffsets"]]).astype(np.int)
+    fin = h5py.File(outputFname, "r")
+    rows = fin[datasetName][:]
+    fin.close()
+    if rows.shape[1] != len(fileNames):
+        return max(rows.shape[1], len(fileNames))
+
+    numMismatches = 0
+    for fname in np.unique(fileNames):
+        rawFin = Dataset(join(dataDir, fname), "r")
+        rawValues = rawFin[varName][:]
+        for colIdx in np.nonzero(fileNames == fname)[0]:
+            if not np.array_equal(rows[:, colIdx], rawValues[timeSliceOffsets[colIdx]].compressed()):
+                numMismatches = numMismatches + 1
+        rawFin.close()
+    return numMismatches
+
+def datasetsOf(fin):
+    """every dataset of the open HDF5 file, by path"""
+    datasets = {}
+    fin.visititems(lambda name, item: datasets.__setitem__(name, item) if isinstance(item, h5py.Dataset) else None)
+    return datasets
+
+def sameAttributes(item, referenceItem):
+    if sorted(item.attrs.keys()) != sorted(referenceItem.attrs.keys()):
+        return False
+    return all([np.array_equal(np.asarray(item.attrs[name]), np.asarray(referenceItem.attrs[name])) for name in item.attrs.keys()])
+
+def compareWithReference(outputFname, referenceFname):
+    """compares the converted output with the stored output of a trusted run on the same synthetic data: every dataset must be
+    there, with the same shape, type, attributes and bytes (so NaNs and the packing of the values count); returns the paths of
+    the datasets that are missing, extra or differ"""
+    fin = h5py.File(outputFname, "r")
+    referenceFin = h5py.File(referenceFname, "r")
+    (datasets, referenceDatasets) = (datasetsOf(fin), datasetsOf(referenceFin))
+    differingPaths = sorted(set(datasets.keys()) ^ set(referenceDatasets.keys()))
+    for path in sorted(set(datasets.keys()) & set(referenceDatasets.keys())):
+        (dataset, referenceDataset) = (datasets[path], referenceDatasets[path])
+        if dataset.shape != referenceDataset.shape or dataset.dtype != referenceDataset.dtype or not sameAttributes(dataset, referenceDataset) or \
+                dataset[()].tostring() != referenceDataset[()].tostring():
+            differingPaths.append(path)
+    fin.close()
+    referenceFin.close()
+    return differingPaths
+
+def referenceFname(converter, args):
+    """where the reference output of the converter is stored, named after the synthetic data it was converted from"""
+    numFiles = args.cfsro_files if converter == "CFSRO" else "%dx%d" % (args.cesm_files, args.cesm_timesteps)
+    return join(args.reference, "%s_%dx%dx%d_%sfiles.h5" % (converter, args.levels, args.lats, args.longs, numFiles))
+
+def checkReference(converter, outputFname, numMismatches, args):
+    """compares the output with the reference output of the converter, first storing it as the reference with --save-reference
+    if there is none yet and it matches its inputs; returns the number of datasets that differ from the reference (or None without
+    a reference)"""
+    if args.reference is None:
+        return 0
+    fname = referenceFname(converter, args)
+    if args.save_reference and not isfile(fname) and numMismatches == 0:
+        if not isdir(args.reference):
+            makedirs(args.reference)
+        shutil.copyfile(outputFname, fname)
+        print "Stored %s as the reference output" % fname
+    if not isfile(fname):
+        return None
+    differingPaths = compareWithReference(outputFname, fname)
+    if len(differingPaths) > 0:
+        print "The %s output differs from %s in %s" % (converter, fname, ", ".join(differingPaths[:10]))
+    return len(differingPaths)
+
+def runConverter(converterName, numRanks, settings, runDir, args):
+    """runs one conversion with the given settings overrides, returning whether it exited cleanly and its wall time"""
+    configFname = join(runDir, "config.json")
+    with open(configFname, "w") as configFile:
+        json.dump(settings, configFile, indent=1)
+    command = [args.mpirun] + shlex.split(args.mpirun_args) + ["-n", str(numRanks), args.python,
+            join(scriptDir, converterName), "--config", configFname]
+    startTime = time.time()
+    with open(join(runDir, "run.log"), "w") as logFile:
+        exitCode = subprocess.call(command, stdout=logFile, stderr=subprocess.STDOUT)
+    return (exitCode == 0, time.time() - startTime)
+
+def commonSettings(numRanks, runDir, args):
+    return {"DEBUGFLAG": False, "numWriters": min(args.writers, numRanks),
+            "numLevels": args.levels, "numLats": args.lats, "numLongs": args.longs,
+            "traceFnameOut": join(runDir, "trace.json"), "logDir": None, "resumeQ": False}
+
+def benchmarkCFSRO(numRanks, dataDir, runDir, args):
+    settings = commonSettings(numRanks, runDir, args)
+    settings.update({"dataInPath": dataDir, "dataOutFname": join(runDir, "ocean.h5"), "metadataFnameOut": join(runDir, "oceanMetadata.npz"),
+            "outputPrecision": "float32"})
+    (successQ, wallTime) = runConverter("CFSRO_converter.py", numRanks, settings, runDir, args)
+    (numMismatches, numDifferences) = (None, None)
+    if successQ:
+        numMismatches = verifyOutput(settings["dataOutFname"], "rows", settings["metadataFnameOut"], dataDir, "POT_L160_Avg_1")
+        numDifferences = checkReference("CFSRO", settings["dataOutFname"], numMismatches, args)
+    return (successQ, wallTime, numMismatches, numDifferences)
+
+def benchmarkCESM(numRanks, dataDir, runDir, args):
+    settings = commonSettings(numRanks, runDir, args)
+    settings.update({"outFname": join(runDir, "cesm.h5"),
+            "tempDataInPath": join(dataDir, "TEMP"), "tempMetadataFnameOut": join(runDir, "tempCESMMetadata.npz"),
+            "rhoDataInPath": join(dataDir, "RHO"), "rhoMetadataFnameOut": join(runDir, "rhoCESMMetadata.npz"),
+            "outputPrecision": {"temp": "float32", "rho": "float32"}})
+    (successQ, wallTime) = runConverter("CESM_converter.py", numRanks, settings, runDir, args)
+    (numMismatches, numDifferences) = (None, None)
+    if successQ:
+        numMismatches = verifyOutput(settings["outFname"], "temp", settings["tempMetadataFnameOut"], settings["tempDataInPath"], "TEMP") + \
+                verifyOutput(settings["outFname"], "rho", settings["rhoMetadataFnameOut"], settings["rhoDataInPath"], "RHO")
+        numDifferences = checkReference("CESM", settings["outFname"], numMismatches, args)
+    return (successQ, wallTime, numMismatches, numDifferences)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmarks the converters on synthetic data under a local mpirun")
+    parser.add_argument("workDir")
+    parser.add_argument("--ranks", type=int, nargs="+", default=[2, 4, 8, 16])
+    parser.add_argument("--converters", nargs="+", choices=["CFSRO", "CESM"], default=["CFSRO", "CESM"])
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--levels", type=int, default=10)
+    parser.add_argument("--lats", type=int, default=90)
+    parser.add_argument("--longs", type=int, default=180)
+    parser.add_argument("--cfsro-files", type=int, default=64)
+    parser.add_argument("--cesm-files", type=int, default=3)
+    parser.add_argument("--cesm-timesteps", type=int, default=20)
+    parser.add_argument("--python", default=sys.executable)
+    parser.add_argument("--mpirun", default="mpirun")
+    parser.add_argument("--mpirun-args", default="")
+    parser.add_argument("--reference", default=None, help="a directory of reference outputs of trusted runs, which every output is compared with")
+    parser.add_argument("--save-reference", action="store_true", help="store the first output of each converter that matches its inputs as its reference, if it has none")
+    args = parser.parse_args()
+
+    results = []
+    for converter in args.converters:
+        dataDir = join(args.workDir, "%s_data" % converter)
+        if converter == "CFSRO":
+            print "Generating %d CFSRO-like files in %s" % (args.cfsro_files, dataDir)
+            generateCFSRO(dataDir, args.cfsro_files, args.levels, args.lats, args.longs)
+        else:
+            print "Generating %d CESM-like files in %s" % (args.cesm_files, dataDir)
+            generateCESM(dataDir, args.cesm_files, args.cesm_timesteps, args.levels, args.lats, args.longs)
+        for numRanks in args.ranks:
+            runDir = join(args.workDir, "%s_%dranks" % (converter, numRanks))
+            if not isdir(runDir):
+                makedirs(runDir)
+            print "Running the %s converter on %d processes" % (converter, numRanks)
+            if converter == "CFSRO":
+                (successQ, wallTime, numMismatches, numDifferences) = benchmarkCFSRO(numRanks, dataDir, runDir, args)
+            else:
+                (successQ, wallTime, numMismatches, numDifferences) = benchmarkCESM(numRanks, dataDir, runDir, args)
+            throughputs = phaseThroughputs(join(runDir, "trace.json")) if successQ else {}
+            results.append((converter, numRanks, successQ, wallTime, numMismatches, numDifferences, throughputs))
+
+    print
+    print "%-6s %6s %9s " % ("data", "ranks", "wall (s)") + " ".join(["%14s" % (phaseName + " MB/s") for phaseName in reportedPhases]) + "  check"
+    failedQ = False
+    for (converter, numRanks, successQ, wallTime, numMismatches, numDifferences, throughputs) in results:
+        if not successQ:
+            check = "FAILED (see run.log)"
+        elif numMismatches > 0:
+            check = "%d MISMATCHED COLUMNS" % numMismatches
+        elif numDifferences is None:
+            check = "NO REFERENCE OUTPUT (store one with --save-reference)"
+        elif numDifferences > 0:
+            check = "%d DATASETS DIFFER FROM THE REFERENCE" % numDifferences
+        else:
+            check = "ok"
+        failedQ = failedQ or check != "ok"
+        print "%-6s %6d %9.2f " % (converter, numRanks, wallTime) + \
+                " ".join(["%14.1f" % throughputs.get(phaseName, 0.0) for phaseName in reportedPhases]) + "  " + check
+    sys.exit(1 if failedQ else 0)
@@ -0,0 +1,1202 @@
+# The helpers the converters (CFSRO_converter.py, CESM_converter.py and atmosphere_converter.py) share: buffered logging and
+# the timing of each step, laying out the processes and their writers, the command line settings, splitting the columns among
+# the processes, the Ialltoallv that moves a block of rows to the writers, and the background reads of the pipelined conversion;
+# and the conversion engine they all run: the output file and its datasets, the blocks the levels are converted in, the reads of
+# the levels, their redistribution to the writers and their writes, the precision of the stored values, the checksums and the journal
+#
+# They work on the processes of comm, and chunkIdxToWriter and alltoallvPlan on the writers in writerRanks: each converter sets
+# these, and the settings the logging and the engine follow, with configure once it has parsed its command line and picked its writers.
+# The engine converts the levels a converter's loadFiles describes on its ProcessInformation (see convertLevels), reading them
+# through the converter's readFileBlock hook; the converters open their own input files and write their own metadata
+
+from mpi4py import MPI
+from netCDF4 import Dataset, default_fillvals
+import h5py
+import numpy as np
+from os import fsync
+from os.path import isfile, join
+import time, math, sys, argparse, threading, traceback, Queue, json, hashlib
+
+comm = MPI.COMM_WORLD # the processes converting together (CESM_converter.py's concurrentQ gives each variable its own)
+rank = comm.Get_rank()
+numProcs = comm.Get_size()
+worldRank = MPI.COMM_WORLD.Get_rank() # names this process in the logs, whatever its group
+writerRanks = [] # the ranks (in comm) of the processes that write out the row chunks, see assignWriters
+numWriters = 0
+syncReportsQ = False # put a barrier in front of each progress report, so its timestamp marks when all the processes got there
+logDir = None # None, or a directory where each process writes its own log at the end of the run (otherwise the root process prints them)
+fileComm = MPI.COMM_WORLD # the processes that open the output file together, which stay all of them when comm is narrowed to a group
+mpiInfo = MPI.Info.Create() # the MPI-IO hints the output file is opened with
+
+# the settings of the conversion engine, which the converters pass on from theirs with configureEngine (see the converters for what they do);
+# the ones a converter doesn't have keep these defaults
+pipelineDepth = 2
+redistributionMode = "alltoallv"
+threadSafeHDF5 = False
+outputMode = "writers"
+memoryBudget = None
+verifyMaskQ = False
+checksumsQ = False
+outputChunkShape = None
+autoChunkBytes = 1024*1024
+outputCompression = None
+resizableOutputQ = False
+resumeQ = False
+appendQ = False
+engineSettingNames = ["pipelineDepth", "redistributionMode", "threadSafeHDF5", "outputMode", "memoryBudget", "verifyMaskQ", "checksumsQ",
+        "outputChunkShape", "autoChunkBytes", "outputCompression", "resizableOutputQ", "resumeQ", "appendQ"]
+
+def configure(**settings):
+    """sets the module-level state above (comm, fileComm, writerRanks, numWriters, syncReportsQ, logDir and the engine settings)
+    that the helpers work with; rank and numProcs follow comm"""
+    global rank, numProcs
+    unknownSettings = sorted(set(settings.keys()) - set(["comm", "fileComm", "writerRanks", "numWriters", "syncReportsQ", "logDir"] + engineSettingNames))
+    if len(unknownSettings) > 0:
+        raise ValueError("unknown helper settings: " + ", ".join(unknownSettings))
+    globals().update(settings)
+    rank = comm.Get_rank()
+    numProcs = comm.Get_size()
+
+def configureEngine(settings):
+    """passes the engine settings among the settings of a converter (its globals()) on to configure"""
+    configure(**dict([(settingName, settings[settingName]) for settingName in engineSettingNames if settingName in settings]))
+
+### Logging and timing
+
+logEvents = [] # the timestamped messages logged by this process since the last flushLogs, with whether they were already printed
+
+def logMessage(message, printQ, printedQ):
+    """timestamps message and buffers it on this process, printing it now if printQ; printedQ marks messages
+    that flushLogs shouldn't print again"""
+    messageToLog = "%s, process %d: %s" % (time.asctime(time.localtime()), worldRank, message)
+    if printQ:
+        print messageToLog
+        sys.stdout.flush()
+    logEvents.append((messageToLog, printedQ))
+
+def status(message, printQ=False):
+    """logs a message on this process, without communicating; the root process prints it right away, and so does
+    any other process if printQ (e.g. just before it exits), otherwise it is printed by the next flushLogs"""
+    printQ = printQ or rank == 0
+    logMessage(message, printQ, printQ)
+
+def report(message):
+    """logs a message on every process that calls this, and prints it once, from the root process"""
+    logMessage(message, rank == 0, True)
+
+def reportBarrier(message):
+    """logs and prints a message like report; only if syncReportsQ are the processes first synchronized,
+    so that the timestamps mark when every process reached this point"""
+    if syncReportsQ:
+        comm.Barrier()
+    report(message)
+
+def flushLogs():
+    """writes out the messages buffered on each process: with a logDir, each process appends them to its own
+    file there without communicating; otherwise they are gathered (collectively) and the root process prints the
+    ones that haven't been printed yet"""
+    global logEvents
+    if logDir is not None:
+        with open(join(logDir, "process%05d.log" % worldRank), "a") as logFile:
+            logFile.writelines([messageToLog + "\n" for (messageToLog, printQ) in logEvents])
+    else:
+        unprintedMessages = comm.gather([messageToLog for (messageToLog, printQ) in logEvents if not printQ], root=0)
+        if rank == 0:
+            for messageToPrint in sum(unprintedMessages, []):
+                print messageToPrint
+    logEvents = []
+
+phaseTimes = [] # (phase, call number, seconds, bytes moved) for each timed step taken on this process
+phaseCallCounts = {}
+
+def recordPhase(phaseName, seconds, numBytes):
+    """records one step of phaseName on this process; the n-th steps of a phase on the different processes
+    are the same piece of work (e.g. the n-th level converted), since every process takes the same steps"""
+    callNumber = phaseCallCounts.get(phaseName, 0)
+    phaseCallCounts[phaseName] = callNumber + 1
+    phaseTimes.append((phaseName, callNumber, seconds, int(numBytes)))
+
+def timedPhase(phaseName, bytesMoved=lambda args, result: 0):
+    """decorates a function so that each call is recorded as a step of phaseName, with the bytes
+    computed by bytesMoved from its arguments and result"""
+    def decorate(function):
+        def timedFunction(*args, **kwargs):
+            startTime = time.time()
+            result = function(*args, **kwargs)
+            recordPhase(phaseName, time.time() - startTime, bytesMoved(args, result))
+            return result
+        timedFunction.__doc__ = function.__doc__
+        return timedFunction
+    return decorate
+
+def reportPhaseTimes(traceFname):
+    """collects the steps timed on all the processes, writes them to traceFname (unless it is None) as JSON, along with
+    their min/median/max time across processes, and reports a per-phase summary; collective"""
+    allPhaseTimes = comm.gather(phaseTimes, root=0)
+    if rank != 0:
+        return
+
+    stepTimes = {}
+    phaseOrder = []
+    for (processNum, processPhaseTimes) in enumerate(allPhaseTimes):
+        for (phaseName, callNumber, seconds, numBytes) in processPhaseTimes:
+            if phaseName not in phaseOrder:
+                phaseOrder.append(phaseName)
+            stepTimes.setdefault((phaseName, callNumber), []).append((processNum, seconds, numBytes))
+
+    trace = {"numProcs": numProcs, "steps": []}
+    phaseSummaries = dict([(phaseName, [0, 0.0, 0.0, 0]) for phaseName in phaseOrder])
+    for (phaseName, callNumber) in sorted(stepTimes.keys(), key=lambda step: (phaseOrder.index(step[0]), step[1])):
+        (processNums, seconds, numBytes) = map(list, zip(*stepTimes[(phaseName, callNumber)]))
+        step = {"phase": phaseName, "call": callNumber, "processes": processNums, "seconds": seconds, "bytes": numBytes,
+                "minSeconds": min(seconds), "medianSeconds": float(np.median(seconds)), "maxSeconds": max(seconds),
+                "totalBytes": sum(numBytes)}
+        trace["steps"].append(step)
+        phaseSummary = phaseSummaries[phaseName]
+        phaseSummary[0] = phaseSummary[0] + 1
+        phaseSummary[1] = phaseSummary[1] + step["medianSeconds"]
+        phaseSummary[2] = phaseSummary[2] + step["maxSeconds"]
+        phaseSummary[3] = phaseSummary[3] + step["totalBytes"]
+    if traceFname is not None:
+        with open(traceFname, "w") as traceFile:
+            json.dump(trace, traceFile)
+
+    # the slowest process holds up each step, so the throughput is over the sum of the maximum times
+    report("%-20s %6s %12s %12s %12s %10s" % ("phase", "steps", "median (s)", "max (s)", "MB moved", "MB/s"))
+    for phaseName in phaseOrder:
+        (numSteps, medianSeconds, maxSeconds, numBytes) = phaseSummaries[phaseName]
+        throughput = numBytes/1e6/maxSeconds if maxSeconds > 0 else 0.0
+        report("%-20s %6d %12.2f %12.2f %12.1f %10.1f" % (phaseName, numSteps, medianSeconds, maxSeconds, numBytes/1e6, throughput))
+
+### Laying out the processes and the settings
+
+def nodeLayout():
+    """groups the ranks by the physical node they run on (the processes that can share memory with each other),
+    whatever order the launcher placed them in; returns the list of ranks on each node, with the nodes ordered by their lowest rank"""
+    nodeComm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=rank)
+    nodeLeader = nodeComm.bcast(rank, root=0)
+    nodeComm.Free()
+    nodeLeaders = comm.allgather(nodeLeader)
+    return [[otherRank for otherRank in xrange(numProcs) if nodeLeaders[otherRank] == leader] for leader in sorted(set(nodeLeaders))]
+
+def assignWriters(ranksOnNodes, numWriters):
+    """picks numWriters distinct writer ranks, dealing them out one node at a time so they are spread evenly over the physical nodes"""
+    writerRanks = []
+    for offsetOnNode in xrange(max(map(len, ranksOnNodes))):
+        writerRanks.extend([nodeRanks[offsetOnNode] for nodeRanks in ranksOnNodes if offsetOnNode < len(nodeRanks)])
+    return writerRanks[:numWriters]
+
+def chunkIdxToWriter(chunkIdx):
+    """maps the chunkIdx (0...numWriters) to the rank of the process that should write it out"""
+    return writerRanks[chunkIdx]
+
+def plainStrings(value):
+    """the JSON value with its unicode strings (also inside lists and objects) turned into str, since h5py can't
+    store unicode file names or variable names in the fixed-length string datasets"""
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return map(plainStrings, value)
+    if isinstance(value, dict):
+        return dict([(plainStrings(key), plainStrings(item)) for (key, item) in value.items()])
+    return value
+
+def parseSettingValue(value):
+    """parses a setting given on the command line as JSON (numbers, true/false, null, lists, objects), or failing that as a string"""
+    try:
+        return plainStrings(json.loads(value))
+    except ValueError:
+        return value
+
+def applyCommandLine(settings, settingNames, description, runFlags=()):
+    """overrides the module-level settings of a converter (settings is its globals()) named in settingNames, first from the JSON file
+    of {"settingName": value} given with --config, then from the options --settingName value; each (flag, settingName, help) of
+    runFlags is an option --flag that sets settingName to True (e.g. --resume sets resumeQ)"""
+    parser = argparse.ArgumentParser(description=description + "; every setting can be given as --settingName value")
+    parser.add_argument("--config", help="a JSON file of {\"settingName\": value} overrides")
+    for (flag, flagSettingName, flagHelp) in runFlags:
+        parser.add_argument("--" + flag, action="store_true", help=flagHelp)
+    for settingName in settingNames:
+        parser.add_argument("--" + settingName, type=parseSettingValue, default=argparse.SUPPRESS, metavar="VALUE")
+    args = vars(parser.parse_args())
+
+    configFname = args.pop("config")
+    if configFname is not None:
+        with open(configFname, "r") as configFile:
+            configSettings = plainStrings(json.load(configFile))
+        unknownSettings = sorted(set(configSettings.keys()) - set(settingNames))
+        if len(unknownSettings) > 0:
+            parser.error("unknown settings in %s: %s" % (configFname, ", ".join(unknownSettings)))
+        settings.update(configSettings)
+    for (flag, flagSettingName, flagHelp) in runFlags:
+        if args.pop(flag):
+            settings[flagSettingName] = True
+    settings.update(args)
+
+### Splitting up the conversion
+
+def planColumnRanges(numTimeSlicesPerFile, numProcs):
+    """splits the columns, i.e. the time slices of all the files in order, into numProcs contiguous ranges whose sizes differ by
+    at most one; returns, for each process, the list of (file index, first time slice, number of time slices) that make up its range"""
+    fileStartCols = np.hstack([[0], np.cumsum(numTimeSlicesPerFile)])
+    (startCols, endCols) = chunkIt(fileStartCols[-1], numProcs)
+    fileRanges = []
+    for (startCol, endCol) in zip(startCols, endCols):
+        processFileRanges = []
+        fileIdx = np.searchsorted(fileStartCols, startCol, side="right") - 1
+        while startCol < endCol:
+            numTimeSlices = min(endCol, fileStartCols[fileIdx + 1]) - startCol
+            processFileRanges.append((int(fileIdx), int(startCol - fileStartCols[fileIdx]), int(numTimeSlices)))
+            startCol = startCol + numTimeSlices
+            fileIdx = fileIdx + 1
+        fileRanges.append(processFileRanges)
+    return fileRanges
+
+def chunkIt(length, num):
+    """breaks xrange(length) into num roughly equally sized pieces, returns arrays of start and end indices"""
+    smallChunkSize = length/num
+    bigChunkSize = length/num + 1
+    numBigChunks = length - (length/num)*num
+    numSmallChunks = num - numBigChunks
+
+    startIndices = [0]
+    endIndices = []
+    numChunks = 0
+    while numChunks < numSmallChunks:
+        endIndices.append(startIndices[-1] + smallChunkSize)
+        startIndices.append(endIndices[-1])
+        numChunks = numChunks + 1
+    numChunks = 0
+    while numChunks < numBigChunks:
+        endIndices.append(startIndices[-1] + bigChunkSize)
+        startIndices.append(endIndices[-1])
+        numChunks = numChunks + 1
+    startIndices = startIndices[:-1]
+
+    return (startIndices, endIndices)
+
+def latitudeBlocks(latStartRows, memoryBudget, fixedBytes, rowBytes, latBytes, levelName):
+    """splits the latitudes of a level, given the number of its rows before each latitude (and after the last) in latStartRows, into
+    blocks of whole latitudes that each fit in memoryBudget bytes (all of them in one block if that is None), where a block takes
+    fixedBytes, rowBytes per row and latBytes per latitude; returns the (first latitude, end latitude) of each block"""
+    numLevelLats = len(latStartRows) - 1
+    if memoryBudget is None:
+        return [(0, numLevelLats)]
+    # the block of latitudes [startLat, endLat) takes fixedBytes + latEndBytes[endLat] - latEndBytes[startLat]
+    latEndBytes = rowBytes*np.asarray(latStartRows) + latBytes*np.arange(numLevelLats + 1)
+    latBoundaries = [0]
+    while latBoundaries[-1] < numLevelLats:
+        startLat = latBoundaries[-1]
+        endLat = np.searchsorted(latEndBytes, latEndBytes[startLat] + memoryBudget - fixedBytes, side="right") - 1
+        if endLat <= startLat:
+            report("Error: a memoryBudget of %d bytes can't hold a block of one latitude (%d bytes on %s); raise it or run on more processes" %
+                    (memoryBudget, fixedBytes + latEndBytes[startLat + 1] - latEndBytes[startLat], levelName))
+            sys.exit(1)
+        latBoundaries.append(int(endLat))
+    return zip(latBoundaries[:-1], latBoundaries[1:])
+
+def alltoallvPlan(numLevelRows, procInfo):
+    """computes the Alltoallv counts and displacements that move the row chunks of a level with numLevelRows rows to the writers,
+    along with the number of rows and the level row offset of the chunk this process receives (-1 if it is not a writer)"""
+
+    chunkStartIndices, chunkEndIndices = chunkIt(numLevelRows, numWriters)
+    sendCounts = np.zeros((numProcs,), dtype=np.int)
+    sendDisplacements = np.zeros((numProcs,), dtype=np.int)
+    recvCounts = np.zeros((numProcs,), dtype=np.int)
+    recvDisplacements = np.zeros((numProcs,), dtype=np.int)
+    recvRowChunkSize = -1
+    recvRowOffset = -1
+
+    # the row chunks are contiguous in the level array, so the level itself serves as the send buffer
+    for chunkIdx in xrange(numWriters):
+        writerRank = chunkIdxToWriter(chunkIdx)
+        curRowChunkSize = chunkEndIndices[chunkIdx] - chunkStartIndices[chunkIdx]
+        sendCounts[writerRank] = curRowChunkSize*procInfo.numLocalCols
+        sendDisplacements[writerRank] = chunkStartIndices[chunkIdx]*procInfo.numLocalCols
+        if rank == writerRank:
+            recvCounts = curRowChunkSize*procInfo.colsPerProcess
+            recvDisplacements = np.hstack([[0], np.cumsum(recvCounts[:-1])])
+            recvRowChunkSize = curRowChunkSize
+            recvRowOffset = chunkStartIndices[chunkIdx]
+
+    return (sendCounts, sendDisplacements, recvCounts, recvDisplacements, recvRowChunkSize, recvRowOffset)
+
+def startRedistribution(curLevData, procInfo, recvBuffer):
+    """nonblocking counterpart of redistributeLevelAlltoallv below: starts an Ialltoallv of the level that receives into the front of
+    recvBuffer on the writers, and returns the request along with the (chunk, rows in chunk, row offset) triple that is valid once it completes;
+    curLevData must be contiguous and left untouched until the request completes"""
+
+    (sendCounts, sendDisplacements, recvCounts, recvDisplacements, returnRowChunkSize, returnOutputRowOffset) = \
+            alltoallvPlan(curLevData.shape[0], procInfo)
+    collectedChunk = recvBuffer[:0]
+    returnChunk = [-1]
+    if returnRowChunkSize >= 0:
+        collectedChunk = recvBuffer[:returnRowChunkSize*procInfo.numCols]
+        returnChunk = collectedChunk
+
+    request = comm.Ialltoallv([curLevData.reshape(-1), sendCounts, sendDisplacements, MPI.FLOAT], \
+                              [collectedChunk, recvCounts, recvDisplacements, MPI.FLOAT])
+
+    return (request, returnChunk, returnRowChunkSize, returnOutputRowOffset)
+
+### The pipelined conversion
+
+class NoLock(object):
+    """stands in for a threading.Lock when the reader thread and the writes do not need to take turns"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exceptionInfo):
+        return False
+
+class LevelReader(threading.Thread):
+    """loads the blocks of rows of the levels (see the converters' levelBlocks) on a background thread into a pool of preallocated
+    buffers, staying up to depth blocks ahead of the block being redistributed and written; each block is a tuple that starts with
+    its (level, first row, end row), and loadBlock(block, levelBuffer) loads it into the leading rows of levelBuffer"""
+
+    def __init__(self, blocks, numLocalCols, loadBlock, depth, ioLock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.blocks = blocks
+        self.loadBlock = loadBlock
+        self.ioLock = ioLock
+        maxBlockRows = max([block[2] - block[1] for block in blocks])
+        self.freeBuffers = Queue.Queue()
+        for bufferIdx in xrange(depth + 1):
+            self.freeBuffers.put(np.empty((maxBlockRows, numLocalCols), dtype=np.float32))
+        self.loadedBlocks = Queue.Queue()
+
+    def run(self):
+        try:
+            for block in self.blocks:
+                levelBuffer = self.freeBuffers.get()
+                with self.ioLock:
+                    curLevData = self.loadBlock(block, levelBuffer)
+                self.loadedBlocks.put((block, levelBuffer, curLevData))
+        except Exception:
+            self.loadedBlocks.put((None, None, sys.exc_info()))
+
+### The conversion engine: the output file
+#
+# The converters describe what they convert on their ProcessInformation (procInfo) in their loadFiles: the open input files
+# (fileHandleList, variableHandles[file][variable]) and the range of time slices of each that this process converts into its columns
+# (firstTimeSlices, numTimeSlices, numLocalCols; colsPerProcess, outputColOffsets and numCols over all the processes), and the levels,
+# each the grid points of one level of one variable that become rows: levels[levelIdx] = (variable index, level in the variable, or None
+# for a variable without levels), gridShapes[variable] = (latitudes, longitudes), levelObservedIndices[levelIdx], the flat grid indices of
+# its rows (None for all of the grid points), numObservationsPerLevel and numRows; with verifyMaskQ also levelMissingMasks[levelIdx], the
+# (latitudes*longitudes) mask of its missing grid points
+
+def readManifest(fnameOut, datasetName):
+    """reads what --append needs to know about datasetName in the existing output, from its metadata group: the input files
+    already converted, the number of columns, a hash of the observed grid points, and whether the columns can be extended; collective"""
+    propfaid = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+    propfaid.set_fapl_mpio(comm, mpiInfo)
+    fout = h5py.File(h5py.h5f.open(fnameOut, flags=h5py.h5f.ACC_RDONLY, fapl=propfaid))
+    manifest = None
+    if rank == 0 and ("metadata/" + datasetName) in fout:
+        group = fout["metadata/" + datasetName]
+        manifest = {"fileNames": list(group["fileNames"][:]), "fileNameLength": group["fileNames"].dtype.itemsize,
+                "numCols": group["fileIndices"].shape[0],
+                "observedLocationsHash": hashlib.md5(group["observedLocations"][:].astype(np.int64).tostring()).hexdigest(),
+                "resizableQ": fout[datasetName].maxshape[1] is None}
+    manifest = comm.bcast(manifest, root=0)
+    fout.close()
+    if manifest is None:
+        report("Error: %s has no metadata group for %s, so there is nothing to append to" % (fnameOut, datasetName))
+        sys.exit(1)
+    return manifest
+
+def newFilesToAppend(manifest, fileNameList, sortKey):
+    """the input files missing from the manifest of the existing output, which --append converts into columns after the
+    converted ones; exits if they can't be appended, e.g. if one of them comes before the last converted file in time order"""
+    convertedFileNames = set(manifest["fileNames"])
+    newFileNameList = [fname for fname in fileNameList if fname not in convertedFileNames]
+    if len(newFileNameList) == 0:
+        report("There are no new input files to append")
+        sys.exit(0)
+    if not manifest["resizableQ"]:
+        report("Error: the output was not created with resizableOutputQ set, so its columns can't be extended")
+        sys.exit(1)
+    if sortKey(newFileNameList[0]) <= sortKey(manifest["fileNames"][-1]):
+        report("Error: the new input file %s does not come after %s, the last one converted, so its columns would be out of time order" %
+                (newFileNameList[0], manifest["fileNames"][-1]))
+        sys.exit(1)
+    if max(map(len, newFileNameList)) > manifest["fileNameLength"]:
+        report("Error: the names of the new input files are longer than the %d characters the output's manifest holds" % manifest["fileNameLength"])
+        sys.exit(1)
+    report("Appending %d new input files after the %d columns already converted" % (len(newFileNameList), manifest["numCols"]))
+    return newFileNameList
+
+def numTimeSlicesInFile(fname, varName):
+    """the length of the time dimension of varName in the file"""
+    fh = Dataset(fname, "r")
+    numTimeSlices = fh[varName].shape[0]
+    fh.close()
+    return numTimeSlices
+
+def createFile(fnameOut):
+    """creates the output file, or with resumeQ or appendQ reopens it, on all the processes of fileComm; collective"""
+    propfaid = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+    propfaid.set_fapl_mpio(fileComm, mpiInfo)
+    if resumeQ or appendQ:
+        # pick up the output of the interrupted run (the journal checks that it was laid out the same way), or the output to append to
+        fid = h5py.h5f.open(fnameOut, flags=h5py.h5f.ACC_RDWR, fapl=propfaid)
+    else:
+        fid = h5py.h5f.create(fnameOut, flags=h5py.h5f.ACC_TRUNC, fapl=propfaid)
+    return h5py.File(fid)
+
+@timedPhase("createDataset")
+def createDataset(fout, procInfo, datasetName, precision):
+    """creates the (rows x columns) dataset datasetName in the output file, storing the values with the given output precision,
+    or with resumeQ or appendQ reopens it (and with appendQ extends it with the new columns); collective"""
+    procInfo.outputPrecision = precision
+    procInfo.numClippedValues = 0
+    # parallel HDF5 can only write filtered (compressed) datasets collectively
+    procInfo.collectiveWritesQ = outputCompression is not None
+    if (resumeQ or appendQ) and datasetName in fout:
+        rows = fout[datasetName]
+        procInfo.collectiveWritesQ = rows.compression is not None
+        if appendQ:
+            # the new columns go after the converted ones, stored the same way
+            procInfo.outputPrecision = storedPrecision(rows)
+            rows.resize(procInfo.firstOutputCol + procInfo.numCols, axis=1)
+        return rows
+
+    # a resizable dataset has an unlimited column dimension, so --append can extend it later
+    spaceid = h5py.h5s.create_simple((procInfo.numRows, procInfo.numCols), (procInfo.numRows, h5py.h5s.UNLIMITED) if resizableOutputQ else None)
+    plist = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+    plist.set_fill_time(h5py.h5d.FILL_TIME_NEVER)
+    (outputDtype, precisionAttributes) = outputTypeInfo(precision)
+    chunkShape = outputChunkShape
+    if chunkShape is None and (outputCompression is not None or resizableOutputQ):
+        chunkShape = "auto"
+    if chunkShape is not None:
+        plist.set_chunk(outputChunkDims(chunkShape, procInfo.numRows, procInfo.numCols, outputDtype.itemsize))
+        if outputCompression is not None:
+            plist.set_shuffle()
+            plist.set_deflate(outputCompression)
+    datasetid = h5py.h5d.create(fout.id, datasetName, h5py.h5t.py_create(outputDtype), spaceid, plist)
+    rows = h5py.Dataset(datasetid)
+    for (attrName, attrValue) in precisionAttributes.items():
+        rows.attrs[attrName] = attrValue
+    return rows
+
+def outputChunkDims(chunkShape, numRows, numCols, itemSize):
+    """returns the chunk dimensions of the output dataset: chunkShape clipped to the dataset, or for "auto", square chunks of about
+    autoChunkBytes, so that reading a whole column or a range of whole rows each touch a modest number of chunks"""
+    if chunkShape == "auto":
+        chunkSide = int(math.sqrt(autoChunkBytes/itemSize))
+        chunkShape = (chunkSide, chunkSide)
+    return (max(1, min(chunkShape[0], numRows)), max(1, min(chunkShape[1], numCols)))
+
+def outputTypeInfo(precision):
+    """returns the numpy dtype used to store rows with the given output precision, and the attributes that describe it in the output file"""
+    if precision == "float64":
+        return (np.dtype(np.float64), {"precision": "float64"})
+    elif precision == "float32":
+        return (np.dtype(np.float32), {"precision": "float32"})
+    elif precision == "float16":
+        return (np.dtype(np.float16), {"precision": "float16", "max_relative_error": 2.0**-11})
+    elif precision[0] == "int16":
+        (scaleFactor, addOffset) = precision[1:]
+        return (np.dtype(np.int16), {"precision": "int16", "scale_factor": scaleFactor, "add_offset": addOffset,
+                "max_abs_error": scaleFactor/2.0, "valid_min": addOffset - 32767*scaleFactor, "valid_max": addOffset + 32767*scaleFactor})
+    raise ValueError("unknown output precision %s" % str(precision))
+
+def storedPrecision(rows):
+    """the output precision an existing dataset was written with, read back from its attributes, so appended columns are stored the same way"""
+    precision = str(rows.attrs["precision"])
+    if precision == "int16":
+        return (precision, float(rows.attrs["scale_factor"]), float(rows.attrs["add_offset"]))
+    return precision
+
+def convertForOutput(values, procInfo, countClippedQ=True):
+    """converts float32 values to their on-disk representation, packing them as round((value - add_offset)/scale_factor)
+    for the int16 output precision; values outside the representable range are clipped, and counted if countClippedQ"""
+    precision = procInfo.outputPrecision
+    if precision == "float32":
+        return values
+    elif precision[0] != "int16":
+        return values.astype(outputTypeInfo(precision)[0])
+
+    (scaleFactor, addOffset) = precision[1:]
+    packedValues = np.rint((values.astype(np.float64) - addOffset)/scaleFactor)
+    if countClippedQ:
+        procInfo.numClippedValues = procInfo.numClippedValues + np.count_nonzero(np.abs(packedValues) > 32767)
+    np.clip(packedValues, -32767, 32767, out=packedValues)
+    return packedValues.astype(np.int16)
+
+def outputConversionBytes(precision):
+    """the bytes of temporaries convertForOutput holds per value it converts to precision"""
+    if precision == "float32":
+        return 0
+    elif precision[0] != "int16":
+        return outputTypeInfo(precision)[0].itemsize
+    # the float64 copy, the intermediate and packed values, and the int16 result
+    return 3*8 + 2
+
+def reportClippedValues(procInfo):
+    """reports how many values fell outside the range representable with the packed int16 output precision"""
+    numClippedValues = comm.allreduce(procInfo.numClippedValues, op=MPI.SUM)
+    if numClippedValues > 0:
+        report("WARNING: %d values were outside the range of the int16 output precision and were clipped" % numClippedValues)
+
+def rowIndex(procInfo):
+    """the index that turns region queries into ranges of rows: levelRowOffsets, the first row of each level (followed by the number
+    of rows), and gridRowIndex, for each point of the flattened (level, lat, lon) grid, the number of rows before it; so the rows of
+    any run of grid points (e.g. a range of longitudes at one lat and level) are rows gridRowIndex[first]:gridRowIndex[last + 1]"""
+    observedQ = np.ones((procInfo.numRows + len(procInfo.missingLocations),), dtype=np.bool_)
+    observedQ[procInfo.missingLocations] = False
+    gridRowIndex = np.hstack([[0], np.cumsum(observedQ)]).astype(np.int64)
+    levelRowOffsets = np.hstack([[0], np.cumsum(procInfo.numObservationsPerLevel)]).astype(np.int64)
+    return (levelRowOffsets, gridRowIndex)
+
+@timedPhase("writeMetadata")
+def writeMetadataGroup(fout, datasetName, procInfo, fileNameList, gridAttributes, rowFieldNames, gridLists, timeStampDtype):
+    """writes the metadata of datasetName as flat typed datasets in the group /metadata/datasetName of the output file, so readers
+    can slice it lazily: per row, the flat grid location and the float64 fields of procInfo named in rowFieldNames (e.g. the coordinates);
+    per column, the time stamp (procInfo.columnTimeStamps, stored as timeStampDtype), the index of the input file in the fileNames table and
+    the time slice in that file; the coordinate lists of the grid, each (fieldName, length, readList) of gridLists read from the first input
+    file by readList; the (attribute name, value) gridAttributes; and the row index (see rowIndex). The per-row metadata, the coordinate
+    lists and the row index are only on the metadata root (procInfo.metadataRootQ), but every process that opened the output takes part in
+    creating the datasets, and each process writes its own columns; collective"""
+    if (resumeQ or appendQ) and ("metadata/" + datasetName) in fout:
+        return
+    group = fout.require_group("metadata").create_group(datasetName)
+    for (attrName, attrValue) in gridAttributes:
+        group.attrs[attrName] = attrValue
+
+    rowDatasets = [("observedLocations", procInfo.observedLocations, np.int64)] + \
+            [(fieldName, getattr(procInfo, fieldName), np.float64) for fieldName in rowFieldNames]
+    for (fieldName, values, dtype) in rowDatasets:
+        rowDataset = group.create_dataset(fieldName, (procInfo.numRows,), dtype=dtype)
+        if procInfo.metadataRootQ:
+            rowDataset[:] = values
+    for (fieldName, length, readList) in gridLists:
+        gridDataset = group.create_dataset(fieldName, (length,), dtype=np.float64)
+        if procInfo.metadataRootQ:
+            gridDataset[:] = readList(procInfo.fileHandleList[0])
+    (levelRowOffsets, gridRowIndex) = rowIndex(procInfo) if procInfo.metadataRootQ else (None, None)
+    indexDatasets = [("levelRowOffsets", levelRowOffsets, len(procInfo.numObservationsPerLevel) + 1),
+            ("gridRowIndex", gridRowIndex, procInfo.gridSize + 1)]
+    for (fieldName, values, length) in indexDatasets:
+        indexDataset = group.create_dataset(fieldName, (length,), dtype=np.int64)
+        if procInfo.metadataRootQ:
+            indexDataset[:] = values
+    # with resizableOutputQ, the fileNames manifest and the per-column datasets grow with the columns appended later,
+    # whose file names may be longer than the current ones
+    resizable = {"maxshape": (None,)} if resizableOutputQ else {}
+    fileNameLength = max(map(len, fileNameList) + [256 if resizableOutputQ else 0])
+    group.create_dataset("fileNames", (len(fileNameList),), dtype="S%d" % fileNameLength, **resizable)
+    for (fieldName, dtype) in [("timeStamps", timeStampDtype), ("fileIndices", np.int32), ("timeSliceOffsets", np.int32)]:
+        group.create_dataset(fieldName, (procInfo.numCols,), dtype=dtype, **resizable)
+    writeColumnMetadata(group, procInfo, fileNameList)
+
+def writeColumnMetadata(group, procInfo, fileNameList):
+    """writes the per-column metadata of the columns converted in this run into the metadata group of their dataset: the time stamp,
+    the index of the input file in the fileNames manifest and the time slice in that file. With --append, first extends the manifest
+    with fileNameList and the per-column datasets with the new columns. Each process writes its own columns; collective"""
+    firstFileIdx = 0
+    if appendQ:
+        firstFileIdx = group["fileNames"].shape[0]
+        group["fileNames"].resize((firstFileIdx + len(fileNameList),))
+        for fieldName in ["timeStamps", "fileIndices", "timeSliceOffsets"]:
+            group[fieldName].resize((procInfo.firstOutputCol + procInfo.numCols,))
+    if procInfo.metadataRootQ:
+        group["fileNames"][firstFileIdx:] = np.array(fileNameList, dtype=group["fileNames"].dtype)
+    fileIndices = dict([(fname, firstFileIdx + fileIdx) for (fileIdx, fname) in enumerate(fileNameList)])
+    startCol = procInfo.firstOutputCol + procInfo.outputColOffsets[rank]
+    endCol = startCol + procInfo.numLocalCols
+    colValues = [("timeStamps", procInfo.columnTimeStamps),
+            ("fileIndices", np.array([fileIndices[fname] for fname in procInfo.repeatedFileNames])),
+            ("timeSliceOffsets", np.array(procInfo.timeSliceOffsets))]
+    for (fieldName, values) in colValues:
+        if endCol > startCol:
+            group[fieldName][startCol:endCol] = values
+
+def createChecksumDatasets(fout, datasetName, procInfo):
+    """creates (or on resume, reopens, and on append, reopens and extends) the (level x column) checksum, sum and sum of squares datasets of datasetName in the group
+    /checksums/datasetName, which verifyConversion.py checks the output against, and the buffers recordChecksums fills; collective"""
+    procInfo.levelRowOffsets = np.hstack([[0], np.cumsum(procInfo.numObservationsPerLevel)])
+    checksumShape = (len(procInfo.numObservationsPerLevel), procInfo.firstOutputCol + procInfo.numCols)
+    checksumFields = [("checksum", np.uint64), ("sum", np.float64), ("sumOfSquares", np.float64)]
+    (procInfo.levelChecksums, procInfo.levelSums, procInfo.levelSumSquares) = \
+            [np.zeros((checksumShape[0], procInfo.numLocalCols), dtype=dtype) for (fieldName, dtype) in checksumFields]
+    if (resumeQ or appendQ) and ("checksums/" + datasetName) in fout:
+        group = fout["checksums/" + datasetName]
+        if appendQ:
+            for (fieldName, dtype) in checksumFields:
+                group[fieldName].resize(checksumShape)
+    else:
+        group = fout.require_group("checksums").create_group(datasetName)
+        resizable = {"maxshape": (checksumShape[0], None)} if resizableOutputQ else {}
+        for (fieldName, dtype) in checksumFields:
+            group.create_dataset(fieldName, checksumShape, dtype=dtype, **resizable)
+    procInfo.checksumDatasets = [group[fieldName] for (fieldName, dtype) in checksumFields]
+
+def recordChecksums(procInfo, levelIdx, blockStartRow, colOffset, observedValues):
+    """records the checksum, sum and sum of squares on level levelIdx of the columns starting at colOffset (the rows of observedValues,
+    which start at row blockStartRow of the level, and are added to those of the level's earlier blocks),
+    computed on the values as they will be stored; the checksum is the sum over the rows r of (2r + 1) times the bits of the stored
+    value, modulo 2**64, so verifyConversion.py can add it up over any split of the rows, and misplaced values change it"""
+    storedValues = convertForOutput(observedValues, procInfo, False)
+    firstRow = procInfo.levelRowOffsets[levelIdx] + blockStartRow
+    rowWeights = np.uint64(2)*np.arange(firstRow, firstRow + storedValues.shape[1], dtype=np.uint64) + np.uint64(1)
+    storedBits = storedValues.view("u%d" % storedValues.dtype.itemsize).astype(np.uint64)
+    cols = slice(colOffset, colOffset + storedValues.shape[0])
+    blockTotals = [np.dot(storedBits, rowWeights), storedValues.sum(axis=1, dtype=np.float64),
+            np.einsum("ij,ij->i", storedValues, storedValues, dtype=np.float64)]
+    for (levelTotals, blockTotal) in zip([procInfo.levelChecksums, procInfo.levelSums, procInfo.levelSumSquares], blockTotals):
+        if blockStartRow == 0:
+            levelTotals[levelIdx, cols] = blockTotal
+        else:
+            levelTotals[levelIdx, cols] += blockTotal
+
+### The conversion engine: reading the levels
+
+def maskingRule(variable):
+    """the rule netCDF4 masks the values of variable by when it reads them (as loadFiles does for the shared missing mask), for checking
+    raw values with missingPoints: the values equal to its missing_value(s) or its _FillValue (without one, the default fill value of its
+    type), any NaN if one of those is NaN, and the values outside its valid_range, or without one, below its valid_min or above its
+    valid_max; as (missing values, NaN missing?, valid min, valid max), with None for a missing bound"""
+    attributes = dict([(attributeName, variable.getncattr(attributeName)) for attributeName in variable.ncattrs()])
+    missingValues = list(np.ravel(attributes.get("missing_value", [])))
+    missingValues.append(attributes.get("_FillValue", default_fillvals[variable.dtype.str[1:]]))
+    missingValues = np.array(missingValues, dtype=variable.dtype)
+    nanMissingQ = False
+    if variable.dtype.kind == "f":
+        nanMissingQ = bool(np.isnan(missingValues).any())
+        missingValues = missingValues[np.logical_not(np.isnan(missingValues))]
+
+    (validMin, validMax) = (attributes.get("valid_min"), attributes.get("valid_max"))
+    if np.size(attributes.get("valid_range", [])) == 2:
+        (validMin, validMax) = np.ravel(attributes["valid_range"])
+    (validMin, validMax) = [None if bound is None else np.array(bound, dtype=variable.dtype) for bound in (validMin, validMax)]
+    return (missingValues, nanMissingQ, validMin, validMax)
+
+def missingPoints(rawValues, rule):
+    """the mask of the raw values that netCDF4 would have masked by the maskingRule rule"""
+    (missingValues, nanMissingQ, validMin, validMax) = rule
+    missingQ = np.in1d(rawValues, missingValues).reshape(rawValues.shape)
+    if nanMissingQ:
+        missingQ |= np.isnan(rawValues)
+    # NaNs are never outside the valid range
+    with np.errstate(invalid="ignore"):
+        if validMin is not None:
+            missingQ |= rawValues < validMin
+        if validMax is not None:
+            missingQ |= rawValues > validMax
+    return missingQ
+
+def verifyMask(procInfo):
+    """checks that every timeslice converted on every process was missing exactly the grid points of the shared missing mask;
+    loadLevel compares the masks as it reads each level, so this only combines the per-column results, with a single Allreduce"""
+    mismatchedCols = np.zeros((procInfo.numCols,), dtype=np.uint8)
+    mismatchedCols[procInfo.outputColOffsets[rank]:(procInfo.outputColOffsets[rank] + procInfo.numLocalCols)] = procInfo.maskMismatchedCols
+    comm.Allreduce(MPI.IN_PLACE, mismatchedCols, op=MPI.MAX)
+    mismatchedColIndices = np.nonzero(mismatchedCols)[0]
+    if len(mismatchedColIndices) > 0:
+        report("Error: the missing masks of %d columns differ from the one assumed for all the observations; the first few are columns %s" %
+                (len(mismatchedColIndices), ", ".join(map(str, mismatchedColIndices[:10]))))
+        return False
+    report("Verified that the missing mask is the same for all the observations")
+    return True
+
+def levelName(procInfo, levelIdx):
+    """names the level levelIdx in the progress reports, as the ocean converters (with one variable) number their levels"""
+    return "level %d/%d" % (levelIdx + 1, len(procInfo.levels))
+
+def blockBytes(procInfo, varIdx):
+    """the bytes converting a block of a level of variable varIdx takes on the process that needs the most, as (bytes per block, bytes per
+    row, bytes per latitude): for each row, every process holds 4 bytes per local column in each of the pipelineDepth + 1 level buffers (and
+    the copy convertForOutput makes of them in the collective output mode), and per time slice of the file being read, the extracted value
+    and the copies recordChecksums makes of it; each writer holds its share of the rows, and one more, in its two receive buffers, the chunk
+    it reassembles and the converted chunk; and the file being read takes in every grid point of the block's latitudes, per time slice the
+    raw value and the four boolean masks of the verifyMaskQ comparison; collective"""
+    maxTimeSlices = comm.allreduce(max(procInfo.numTimeSlices + [0]), op=MPI.MAX)
+    rawValueBytes = comm.allreduce(max([variables[varIdx].dtype.itemsize for variables in procInfo.variableHandles] + [0]), op=MPI.MAX)
+    maxLocalCols = max(procInfo.colsPerProcess)
+    conversionBytes = outputConversionBytes(procInfo.outputPrecision)
+
+    fixedBytes = 0
+    rowBytes = 4*(pipelineDepth + 1)*maxLocalCols + maxTimeSlices*(4 + ((conversionBytes + 8) if checksumsQ else 0))
+    if outputMode == "writers":
+        writerRowBytes = (4*3 + conversionBytes)*procInfo.numCols
+        fixedBytes = writerRowBytes
+        rowBytes = rowBytes + writerRowBytes/float(numWriters)
+    else:
+        rowBytes = rowBytes + conversionBytes*maxLocalCols
+    latBytes = procInfo.gridShapes[varIdx][1]*maxTimeSlices*(rawValueBytes + (4 if verifyMaskQ else 0))
+    return (fixedBytes, rowBytes, latBytes)
+
+def planBlocks(procInfo, levelName=levelName):
+    """splits each level into blocks of whole latitudes, which are read, redistributed and written one at a time: without a memoryBudget
+    a block is the whole level, otherwise it takes as many latitudes as fit in memoryBudget (see blockBytes). Every latitude is read by
+    exactly one block, so verifyMaskQ checks the whole level, and the buffer loadLevel extracts the observed points of my files into is
+    sized for the largest block; collective"""
+    variableBlockBytes = [blockBytes(procInfo, varIdx) if memoryBudget is not None else (0, 0, 0) for varIdx in xrange(len(procInfo.gridShapes))]
+    procInfo.levelBlockPlans = []
+    for (levelIdx, (varIdx, curLev)) in enumerate(procInfo.levels):
+        (numLevelLats, rowLength) = procInfo.gridShapes[varIdx]
+        # the number of rows of the level before each latitude
+        latStartRows = rowLength*np.arange(numLevelLats + 1)
+        if procInfo.levelObservedIndices[levelIdx] is not None:
+            latStartRows = np.searchsorted(procInfo.levelObservedIndices[levelIdx], latStartRows)
+        (fixedBytes, rowBytes, latBytes) = variableBlockBytes[varIdx]
+        latRanges = latitudeBlocks(latStartRows, memoryBudget, fixedBytes, rowBytes, latBytes, levelName(procInfo, levelIdx))
+        procInfo.levelBlockPlans.append([(levelIdx, int(latStartRows[startLat]), int(latStartRows[endLat]), startLat, endLat)
+                for (startLat, endLat) in latRanges])
+    maxRows = max([endRow - startRow for levelBlockPlan in procInfo.levelBlockPlans for (levelIdx, startRow, endRow, startLat, endLat) in levelBlockPlan])
+    procInfo.observedValuesBuffer = np.empty((max(procInfo.numTimeSlices + [0])*maxRows,), dtype=np.float32)
+    if verifyMaskQ:
+        # loadLevel recognizes the missing points of each file by these rules, and marks the columns whose mask differs
+        procInfo.maskingRules = [map(maskingRule, variables) for variables in procInfo.variableHandles]
+        procInfo.maskMismatchedCols = np.zeros((procInfo.numLocalCols,), dtype=np.bool_)
+
+def levelBlocks(procInfo, levels):
+    """the blocks of the levels planned by planBlocks, in order; each is the (level index, first row, end row, first latitude,
+    end latitude), counting the rows within the level"""
+    return sum([procInfo.levelBlockPlans[levelIdx] for levelIdx in levels], [])
+
+def readTimeSlices(variable, curLev, firstTimeSlice, numTimeSlices, startLat, endLat):
+    """reads time slices firstTimeSlice... of latitudes startLat... of level curLev of variable (of all of it, if it has no levels)
+    as (time slice x grid point) rows"""
+    if curLev is None:
+        rawValues = variable[firstTimeSlice:(firstTimeSlice + numTimeSlices), startLat:endLat, ...]
+    else:
+        rawValues = variable[firstTimeSlice:(firstTimeSlice + numTimeSlices), curLev, startLat:endLat, ...]
+    return rawValues.reshape(numTimeSlices, -1)
+
+def extractObserved(rawValues, observedIndices, observedValues):
+    """picks the grid points observedIndices (an index array, or a slice when all of them are kept) out of the (time slice x grid
+    point) rawValues into observedValues"""
+    if isinstance(observedIndices, slice):
+        observedValues[...] = rawValues[:, observedIndices]
+    else:
+        np.take(rawValues, observedIndices, axis=1, out=observedValues)
+
+def readFileBlock(procInfo, fhidx, levelIdx, startLat, endLat, observedIndices, observedValues):
+    """the converters' hook for reading a block of a level from one of my files: extracts the grid points observedIndices (see
+    extractObserved) of latitudes startLat... of level levelIdx, in the time slices of my range of file fhidx, into observedValues, and
+    returns the raw values read, which the verifyMaskQ check looks for missing values in (or None to skip it for this file). This one
+    reads the whole range of time slices, which the ocean files always have"""
+    (varIdx, curLev) = procInfo.levels[levelIdx]
+    rawValues = readTimeSlices(procInfo.variableHandles[fhidx][varIdx], curLev, procInfo.firstTimeSlices[fhidx], procInfo.numTimeSlices[fhidx], startLat, endLat)
+    extractObserved(rawValues, observedIndices, observedValues)
+    return rawValues
+
+@timedPhase("loadLevel", lambda args, curLevData: curLevData.nbytes)
+def loadLevel(procInfo, levelIdx, levelBuffer=None, latRange=None, readFileBlock=readFileBlock):
+    """loads all the observations from the files assigned to this process at level levelIdx, or only those on the block of its latitudes
+    latRange = (first lat, end lat), and returns them as a (rows) * (numColsInMyFiles) matrix; if given, the leading rows of levelBuffer hold the result
+    each file is read once, unmasked, over those latitudes, by readFileBlock, which extracts the observed points with the compression plan from loadFiles"""
+
+    (varIdx, curLev) = procInfo.levels[levelIdx]
+    (numLevelLats, rowLength) = procInfo.gridShapes[varIdx]
+    (startLat, endLat) = (0, numLevelLats) if latRange is None else latRange
+    # the rows on those latitudes, and their grid points among the ones read
+    levelObservedIndices = procInfo.levelObservedIndices[levelIdx]
+    (startRow, endRow) = (startLat*rowLength, endLat*rowLength)
+    if levelObservedIndices is not None:
+        (startRow, endRow) = np.searchsorted(levelObservedIndices, [startRow, endRow])
+    numBlockRows = endRow - startRow
+    if levelBuffer is None:
+        curLevData = np.empty((numBlockRows, procInfo.numLocalCols), dtype=np.float32)
+    else:
+        curLevData = levelBuffer[:numBlockRows, :]
+    if levelObservedIndices is None:
+        observedIndices = slice(startRow - startLat*rowLength, endRow - startLat*rowLength)
+    else:
+        observedIndices = levelObservedIndices[startRow:endRow] - startLat*rowLength
+    if verifyMaskQ:
+        levelMissingMask = procInfo.levelMissingMasks[levelIdx][(startLat*rowLength):(endLat*rowLength)]
+    colOffset = 0
+    for fhidx in xrange(len(procInfo.fileHandleList)):
+        numTimeSlices = procInfo.numTimeSlices[fhidx]
+        observedValues = procInfo.observedValuesBuffer[:numTimeSlices*numBlockRows].reshape(numTimeSlices, numBlockRows)
+        rawValues = readFileBlock(procInfo, fhidx, levelIdx, startLat, endLat, observedIndices, observedValues)
+        if verifyMaskQ and rawValues is not None:
+            rawMissing = missingPoints(rawValues, procInfo.maskingRules[fhidx][varIdx])
+            procInfo.maskMismatchedCols[colOffset:(colOffset + numTimeSlices)] |= np.any(rawMissing != levelMissingMask, axis=1)
+        if checksumsQ:
+            recordChecksums(procInfo, levelIdx, startRow, colOffset, observedValues)
+        curLevData[:, colOffset:(colOffset + numTimeSlices)] = observedValues.transpose()
+        colOffset = colOffset + numTimeSlices
+
+    return curLevData
+
+### The conversion engine: redistributing and writing the levels
+
+def allocateWriteBuffers(procInfo, blocks, numRecvBuffers):
+    """allocates, on the writers, numRecvBuffers buffers to receive their chunk of any of the blocks into, and the
+    procInfo.chunkToWriteBuffer that writeOutputRowChunks reassembles the chunks in; returns the receive buffers"""
+    maxChunkRows = max([int(math.ceil(float(endRow - startRow)/numWriters)) for (levelIdx, startRow, endRow, startLat, endLat) in blocks] + [0])
+    recvBufferSize = 0
+    if outputMode == "writers" and rank in map(chunkIdxToWriter, xrange(numWriters)):
+        recvBufferSize = maxChunkRows*procInfo.numCols
+    procInfo.chunkToWriteBuffer = np.empty((recvBufferSize,), dtype=np.float32)
+    return [np.empty((recvBufferSize,), dtype=np.float32) for bufferIdx in xrange(numRecvBuffers)]
+
+@timedPhase("redistribute", lambda args, result: args[0].nbytes)
+def gatherDataAtWriter(curLevData, procInfo, recvBuffer):
+    """Gathers all the row chunks of a given level of observations at the writer processes, using the method chosen by redistributionMode;
+    each writer receives its chunk into the front of recvBuffer"""
+
+    if redistributionMode == "alltoallv":
+        return redistributeLevelAlltoallv(curLevData, procInfo, recvBuffer)
+    elif redistributionMode == "igatherv":
+        return redistributeLevelIgatherv(curLevData, procInfo, recvBuffer)
+    elif redistributionMode == "gatherv":
+        return redistributeLevelGatherv(curLevData, procInfo, recvBuffer)
+    raise ValueError("unknown redistributionMode %s, expected \"alltoallv\", \"igatherv\" or \"gatherv\"" % str(redistributionMode))
+
+def redistributeLevelGatherv(curLevData, procInfo, recvBuffer):
+    """Gathers all the row chunks of a given level of observations at the writer processes, with one blocking Gatherv
+    per writer; each writer receives its chunk into the front of recvBuffer"""
+
+    chunkStartIndices, chunkEndIndices = chunkIt(curLevData.shape[0], numWriters)
+    chunkSizes = map(lambda chunkIdx: chunkEndIndices[chunkIdx] - chunkStartIndices[chunkIdx], xrange(numWriters))
+    outputStartRows = np.hstack([[0], np.cumsum(chunkSizes)[:-1]])
+    returnChunk = [-1]
+    returnRowChunkSize = -1
+    returnOutputRowOffset = -1
+
+    for chunkIdx in xrange(numWriters):
+        writerRank = chunkIdxToWriter(chunkIdx)
+        curRowChunkSize = chunkSizes[chunkIdx]
+        chunkToTransfer = np.ascontiguousarray(curLevData[chunkStartIndices[chunkIdx]:chunkEndIndices[chunkIdx], :]).reshape(-1)
+
+        processChunkSizes = curRowChunkSize*procInfo.colsPerProcess
+        processChunkDisplacements = np.hstack([[0], np.cumsum(processChunkSizes[:-1])])
+        collectedChunk = None
+        if rank == writerRank:
+            collectedChunk = recvBuffer[:curRowChunkSize*procInfo.numCols]
+        comm.Gatherv(sendbuf=[chunkToTransfer, MPI.FLOAT], \
+                     recvbuf=[collectedChunk, processChunkSizes, processChunkDisplacements, MPI.FLOAT], \
+                     root=writerRank)
+        if rank == writerRank:
+            returnChunk = collectedChunk
+            returnRowChunkSize = curRowChunkSize
+            returnOutputRowOffset = outputStartRows[chunkIdx]
+
+    return (returnChunk, returnRowChunkSize, returnOutputRowOffset)
+
+def redistributeLevelAlltoallv(curLevData, procInfo, recvBuffer):
+    """Moves all the row chunks of a given level of observations to the writer processes in a single Alltoallv;
+    each writer receives its chunk into the front of recvBuffer, in exactly the layout produced by redistributeLevelGatherv"""
+
+    (sendCounts, sendDisplacements, recvCounts, recvDisplacements, returnRowChunkSize, returnOutputRowOffset) = \
+            alltoallvPlan(curLevData.shape[0], procInfo)
+    collectedChunk = recvBuffer[:0]
+    returnChunk = [-1]
+    if returnRowChunkSize >= 0:
+        collectedChunk = recvBuffer[:returnRowChunkSize*procInfo.numCols]
+        returnChunk = collectedChunk
+
+    sendBuffer = np.ascontiguousarray(curLevData, dtype=np.float32).reshape(-1)
+    comm.Alltoallv([sendBuffer, sendCounts, sendDisplacements, MPI.FLOAT], \
+                   [collectedChunk, recvCounts, recvDisplacements, MPI.FLOAT])
+
+    return (returnChunk, returnRowChunkSize, returnOutputRowOffset)
+
+def redistributeLevelIgatherv(curLevData, procInfo, recvBuffer):
+    """Gathers all the row chunks of a given level of observations at the writer processes, starting one nonblocking
+    Igatherv per writer so that all of them progress at the same time; each writer receives its chunk into the front of recvBuffer"""
+
+    chunkStartIndices, chunkEndIndices = chunkIt(curLevData.shape[0], numWriters)
+    requests = []
+    chunksToTransfer = []
+    returnChunk = [-1]
+    returnRowChunkSize = -1
+    returnOutputRowOffset = -1
+
+    for chunkIdx in xrange(numWriters):
+        writerRank = chunkIdxToWriter(chunkIdx)
+        curRowChunkSize = chunkEndIndices[chunkIdx] - chunkStartIndices[chunkIdx]
+        # the send buffers have to stay alive until the requests complete
+        chunksToTransfer.append(np.ascontiguousarray(curLevData[chunkStartIndices[chunkIdx]:chunkEndIndices[chunkIdx], :], dtype=np.float32).reshape(-1))
+
+        processChunkSizes = curRowChunkSize*procInfo.colsPerProcess
+        processChunkDisplacements = np.hstack([[0], np.cumsum(processChunkSizes[:-1])])
+        collectedChunk = None
+        if rank == writerRank:
+            collectedChunk = recvBuffer[:curRowChunkSize*procInfo.numCols]
+            returnChunk = collectedChunk
+            returnRowChunkSize = curRowChunkSize
+            returnOutputRowOffset = chunkStartIndices[chunkIdx]
+        requests.append(comm.Igatherv(sendbuf=[chunksToTransfer[-1], MPI.FLOAT], \
+                recvbuf=[collectedChunk, processChunkSizes, processChunkDisplacements, MPI.FLOAT], \
+                root=writerRank))
+    MPI.Request.Waitall(requests)
+
+    return (returnChunk, returnRowChunkSize, returnOutputRowOffset)
+
+@timedPhase("writeRows", lambda args, numBytesWritten: numBytesWritten)
+def writeOutputRowChunks(rowChunk, numRowsInChunk, outputRowOffset, rows, procInfo, writtenChunks=()):
+    """On writer processes, reassembles the stored chunk of rows from the blocks of columns sent by each process in the preallocated
+    procInfo.chunkToWriteBuffer (see allocateWriteBuffers), and writes it out, unless it is one of the writtenChunks of a resumed run;
+    if the writes have to be collective, the other processes take part with empty writes. Returns the number of bytes written"""
+
+    wroteChunkQ = False
+    numBytesWritten = 0
+    for chunkIdx in xrange(numWriters):
+        if rank == chunkIdxToWriter(chunkIdx) and chunkIdx not in writtenChunks:
+            assert(len(rowChunk)== numRowsInChunk*procInfo.numCols)
+            processChunkSizes = numRowsInChunk*procInfo.colsPerProcess
+            processChunkDisplacements = np.hstack([[0], np.cumsum(processChunkSizes[:-1])])
+            chunkToWrite = procInfo.chunkToWriteBuffer[:numRowsInChunk*procInfo.numCols].reshape(numRowsInChunk, procInfo.numCols)
+
+            for processNum in np.arange(numProcs):
+                outputStartCol = procInfo.outputColOffsets[processNum]
+                outputEndCol = outputStartCol + procInfo.colsPerProcess[processNum]
+                startChunkOffset = processChunkDisplacements[processNum]
+                endChunkOffset = startChunkOffset + numRowsInChunk*procInfo.colsPerProcess[processNum]
+                chunkToWrite[:, outputStartCol:outputEndCol] = np.reshape(rowChunk[startChunkOffset:endChunkOffset], \
+                        (numRowsInChunk, procInfo.colsPerProcess[processNum]))
+
+            startOutputRow = outputRowOffset
+            endOutputRow = outputRowOffset + numRowsInChunk
+            outputChunk = convertForOutput(chunkToWrite, procInfo)
+            if procInfo.collectiveWritesQ:
+                writeHyperslab(rows, outputChunk, (startOutputRow, procInfo.firstOutputCol), True)
+                wroteChunkQ = True
+            else:
+                rows[startOutputRow:endOutputRow, procInfo.firstOutputCol:(procInfo.firstOutputCol + procInfo.numCols)] = outputChunk
+            numBytesWritten = numBytesWritten + outputChunk.nbytes
+
+    if procInfo.collectiveWritesQ and not wroteChunkQ:
+        writeHyperslab(rows, np.empty((0, procInfo.numCols), dtype=outputTypeInfo(procInfo.outputPrecision)[0]), (0, 0), True)
+    return numBytesWritten
+
+def writeHyperslab(dataset, data, offsets, collectiveQ):
+    """writes the array data into dataset starting at the given offsets; with collectiveQ, every process has to call this
+    (with an empty array if it has nothing to write) and the transfer is done as one collective MPI-IO operation"""
+    filespace = dataset.id.get_space()
+    memspace = h5py.h5s.create_simple(data.shape)
+    if data.size > 0:
+        filespace.select_hyperslab(tuple(offsets), data.shape)
+    else:
+        filespace.select_none()
+        memspace.select_none()
+    dxpl = h5py.h5p.create(h5py.h5p.DATASET_XFER)
+    if collectiveQ:
+        dxpl.set_dxpl_mpio(h5py.h5fd.MPIO_COLLECTIVE)
+    dataset.id.write(memspace, filespace, np.ascontiguousarray(data), dxpl=dxpl)
+
+@timedPhase("writeRows", lambda args, numBytesWritten: numBytesWritten)
+def writeLevelColumns(curLevData, levelStartRow, rows, procInfo):
+    """writes this process's columns of the current level straight into the output dataset; the write is collective,
+    so HDF5/ROMIO aggregates the column blocks of all the processes into large contiguous writes. Returns the number of bytes written"""
+    outputColumns = convertForOutput(curLevData, procInfo)
+    writeHyperslab(rows, outputColumns, (levelStartRow, procInfo.firstOutputCol + procInfo.outputColOffsets[rank]), True)
+    return outputColumns.nbytes
+
+def recordLevel(procInfo, journal, datasetName, levelIdx):
+    """writes this process's checksums of level levelIdx, then records the level in the journal, so a resumed run
+    finds the checksums of every level it skips; collective"""
+    if checksumsQ:
+        checksumBuffers = [procInfo.levelChecksums, procInfo.levelSums, procInfo.levelSumSquares]
+        for (checksumDataset, checksumBuffer) in zip(procInfo.checksumDatasets, checksumBuffers):
+            writeHyperslab(checksumDataset, checksumBuffer[levelIdx:(levelIdx + 1), :], (levelIdx, procInfo.firstOutputCol + procInfo.outputColOffsets[rank]), False)
+    journal.recordLevel(datasetName, levelIdx)
+
+def writeLevelsPipelined(procInfo, rows, datasetName, journal, readFileBlock, levelName):
+    """converts the levels the journal is missing, a block of rows at a time (see levelBlocks), overlapping the reads of the upcoming
+    blocks (on a background thread), the redistribution of the current block to the writers, and the writes of the previous block
+    (in the collective output mode there is no redistribution, and the reads overlap the collective writes); the level, receive and
+    reassembly buffers are allocated once, for the largest block, and reused for all the levels"""
+
+    # netCDF4-format inputs are read through the HDF5 library, which is usually not built thread-safe,
+    # so then the reader thread and the writes take turns inside the library (the MPI transfers still overlap both)
+    ioLock = NoLock()
+    if not threadSafeHDF5 and any([fh.data_model.startswith("NETCDF4") for fh in procInfo.fileHandleList]):
+        ioLock = threading.Lock()
+
+    levelsToConvert = journal.levelsToConvert(datasetName)
+    if len(levelsToConvert) == 0:
+        return
+    blocks = levelBlocks(procInfo, levelsToConvert)
+    levelStartRows = np.hstack([[0], np.cumsum(procInfo.numObservationsPerLevel)[:-1]])
+    reader = LevelReader(blocks, procInfo.numLocalCols, lambda block, levelBuffer: loadLevel(procInfo, block[0], levelBuffer, block[3:], readFileBlock),
+            pipelineDepth, ioLock)
+    reader.start()
+
+    # the writers receive block N into one buffer while writing out block N-1 from the other
+    recvBuffers = allocateWriteBuffers(procInfo, blocks, 2)
+
+    # a level is recorded in the journal once the write of its last block is done
+    pendingWrite = None
+    pendingLevel = None
+    for blockIdx in xrange(len(blocks)):
+        (block, levelBuffer, curLevData) = reader.loadedBlocks.get()
+        if block is None:
+            traceback.print_exception(*curLevData)
+            sys.stdout.flush()
+            comm.Abort(1)
+        (levelIdx, startRow, endRow, startLat, endLat) = block
+        numLevelRows = procInfo.numObservationsPerLevel[levelIdx]
+        if endRow - startRow == numLevelRows:
+            report("Writing %s, %d observed grid points" % (levelName(procInfo, levelIdx), curLevData.shape[0]))
+        else:
+            report("Writing %s, observed grid points %d to %d of %d" % (levelName(procInfo, levelIdx), startRow, endRow, numLevelRows))
+        levelDoneQ = endLat == procInfo.gridShapes[procInfo.levels[levelIdx][0]][0]
+
+        if outputMode == "collective":
+            with ioLock:
+                writeLevelColumns(curLevData, levelStartRows[levelIdx] + startRow, rows, procInfo)
+                if levelDoneQ:
+                    recordLevel(procInfo, journal, datasetName, levelIdx)
+            reader.freeBuffers.put(levelBuffer)
+        else:
+            (request, curOutputRowChunk, curNumOutputRows, curOutputRowOffset) = \
+                    startRedistribution(curLevData, procInfo, recvBuffers[blockIdx % 2])
+            if pendingWrite is not None:
+                with ioLock:
+                    writeOutputRowChunks(*pendingWrite)
+                    if pendingLevel is not None:
+                        recordLevel(procInfo, journal, datasetName, pendingLevel)
+            waitStartTime = time.time()
+            request.Wait()
+            # only the time spent blocked on the redistribution counts, as the rest overlaps the writes
+            recordPhase("redistribute", time.time() - waitStartTime, curLevData.nbytes)
+            reader.freeBuffers.put(levelBuffer)
+            pendingWrite = (curOutputRowChunk, curNumOutputRows, levelStartRows[levelIdx] + startRow + curOutputRowOffset, rows, procInfo,
+                            journal.writtenChunks(datasetName, levelIdx))
+            pendingLevel = levelIdx if levelDoneQ else None
+
+    if pendingWrite is not None:
+        with ioLock:
+            writeOutputRowChunks(*pendingWrite)
+            if pendingLevel is not None:
+                recordLevel(procInfo, journal, datasetName, pendingLevel)
+    reader.join()
+
+def writeLevelsSequential(procInfo, rows, datasetName, journal, readFileBlock, levelName):
+    """converts the levels the journal is missing a block of rows at a time (see levelBlocks), one step after the other: each block is
+    loaded, then gathered at the writers (with the method chosen by redistributionMode) and written, or in the collective output mode
+    written by every process"""
+    levelStartRows = np.hstack([[0], np.cumsum(procInfo.numObservationsPerLevel)[:-1]])
+    # every block is loaded into the same level buffer, the one blockBytes counts when pipelineDepth is 0
+    blocks = levelBlocks(procInfo, journal.levelsToConvert(datasetName))
+    (recvBuffer,) = allocateWriteBuffers(procInfo, blocks, 1)
+    levelBuffer = np.empty((max([endRow - startRow for (levelIdx, startRow, endRow, startLat, endLat) in blocks] + [0]), procInfo.numLocalCols), dtype=np.float32)
+    for (levelIdx, startRow, endRow, startLat, endLat) in blocks:
+        reportBarrier("Loading data for %s, observed grid points %d to %d of %d" % (levelName(procInfo, levelIdx), startRow, endRow, procInfo.numObservationsPerLevel[levelIdx]))
+        curLevData = loadLevel(procInfo, levelIdx, levelBuffer, (startLat, endLat), readFileBlock)
+        reportBarrier("Done loading data for this level")
+
+        if outputMode == "collective":
+            reportBarrier("Writing data for this level directly from all processes")
+            writeLevelColumns(curLevData, levelStartRows[levelIdx] + startRow, rows, procInfo)
+        else:
+            reportBarrier("Gathering data for this level from processes to writers")
+            (curOutputRowChunk, curNumOutputRows, curOutputRowOffset) = gatherDataAtWriter(curLevData, procInfo, recvBuffer)
+            reportBarrier("Done gathering")
+
+            reportBarrier("Writing data for this level on writers")
+            writeOutputRowChunks(curOutputRowChunk, curNumOutputRows, levelStartRows[levelIdx] + startRow + curOutputRowOffset, rows, procInfo,
+                                 journal.writtenChunks(datasetName, levelIdx))
+        if endLat == procInfo.gridShapes[procInfo.levels[levelIdx][0]][0]:
+            recordLevel(procInfo, journal, datasetName, levelIdx)
+
+def convertLevels(procInfo, rows, datasetName, journal, readFileBlock=readFileBlock, levelName=levelName):
+    """converts the levels of the dataset rows that the journal is missing, in blocks of latitudes (see planBlocks): pipelined (see
+    writeLevelsPipelined), or with a pipelineDepth of 0 one step at a time (see writeLevelsSequential). The converter's readFileBlock hook
+    reads a block of a level from one of its files (see readFileBlock) and its levelName hook names a level in the reports; collective"""
+    planBlocks(procInfo, levelName)
+    if pipelineDepth > 0:
+        writeLevelsPipelined(procInfo, rows, datasetName, journal, readFileBlock, levelName)
+    else:
+        writeLevelsSequential(procInfo, rows, datasetName, journal, readFileBlock, levelName)
+
+### The conversion engine: the journal
+
+def conversionPlan(procInfo, fileNameList):
+    """summarizes everything that decides where each value lands in the output, so a resumed run can check that it matches the interrupted one"""
+    plan = {"numRows": procInfo.numRows, "numCols": procInfo.numCols,
+            "numObservationsPerLevel": map(int, procInfo.numObservationsPerLevel),
+            "colsPerProcess": map(int, procInfo.colsPerProcess),
+            "fileNames": hashlib.md5("\n".join(fileNameList)).hexdigest(),
+            "numWriters": numWriters, "outputMode": outputMode, "precision": procInfo.outputPrecision}
+    # round trip through json so the plan compares equal to one read back from the journal
+    return json.loads(json.dumps(plan, default=int))
+
+class ConversionJournal(object):
+    """an append-only record, kept next to the output file, of the (dataset, level, row chunk) units that have been
+    durably written; rank 0 keeps the file, every process keeps the same view of it. Without a file name nothing is
+    recorded, and every level of a dataset is converted"""
+
+    def __init__(self, fname, fout, resumeQ):
+        self.fname = fname
+        self.fout = fout
+        self.plans = {}
+        self.writtenUnits = set()
+        self.journalFile = None
+        (self.numFlushes, self.numSharedFlushes) = (0, 0)
+        if fname is None:
+            return
+
+        if resumeQ:
+            entries = None
+            if rank == 0:
+                entries = []
+                if isfile(fname):
+                    entries = [json.loads(line) for line in open(fname, "r") if line.strip()]
+            for entry in comm.bcast(entries, root=0):
+                if "plan" in entry:
+                    # a plan restarts its dataset
+                    self.plans[entry["dataset"]] = entry["plan"]
+                    self.writtenUnits = set([unit for unit in self.writtenUnits if unit[0] != entry["dataset"]])
+                else:
+                    self.writtenUnits.update([(entry["dataset"], entry["level"], chunkIdx) for chunkIdx in entry["chunks"]])
+        if rank == 0:
+            # an append keeps the record of the earlier runs
+            self.journalFile = open(fname, "a" if resumeQ or appendQ else "w")
+
+    def append(self, entry):
+        if self.journalFile is not None:
+            self.journalFile.write(json.dumps(entry) + "\n")
+            self.journalFile.flush()
+            fsync(self.journalFile.fileno())
+
+    def startDataset(self, datasetName, plan):
+        """records the plan of datasetName, or if it was already started by an interrupted run, checks that the plan is unchanged"""
+        if datasetName not in self.plans:
+            self.plans[datasetName] = plan
+            self.append({"dataset": datasetName, "plan": plan})
+        elif self.plans[datasetName] != plan:
+            report("Error: the conversion plan for %s differs from the one in the journal %s, so the run cannot be resumed" % (datasetName, self.fname))
+            sys.exit(1)
+
+    def writtenChunks(self, datasetName, levelIdx):
+        """the row chunks of this level that have already been written"""
+        return set([chunkIdx for chunkIdx in xrange(numWriters) if (datasetName, levelIdx, chunkIdx) in self.writtenUnits])
+
+    def levelsToConvert(self, datasetName):
+        """the levels of the started dataset datasetName that have row chunks left to write"""
+        numLevels = len(self.plans[datasetName]["numObservationsPerLevel"])
+        return [levelIdx for levelIdx in xrange(numLevels) if len(self.writtenChunks(datasetName, levelIdx)) < numWriters]
+
+    def recordLevel(self, datasetName, levelIdx):
+        """once every process has written its part of the level, makes it durable and records all of its row chunks. The flush is
+        collective over all the processes that opened the output (fileComm), so when they convert in groups the groups flush together,
+        see shareFlushes"""
+        if self.fname is None:
+            return
+        self.fout.flush()
+        self.numFlushes = self.numFlushes + 1
+        self.writtenUnits.update([(datasetName, levelIdx, chunkIdx) for chunkIdx in xrange(numWriters)])
+        self.append({"dataset": datasetName, "level": levelIdx, "chunks": range(numWriters)})
+
+    def shareFlushes(self, datasetName):
+        """when the processes convert in groups (see CESM_converter.py's concurrentQ), agrees with the other groups, before any level is
+        converted, on how many flushes every process takes part in: one for each level of the group with the most levels left to convert;
+        collective over fileComm"""
+        if self.fname is not None:
+            self.numSharedFlushes = fileComm.allreduce(len(self.levelsToConvert(datasetName)), op=MPI.MAX)
+
+    def finishSharedFlushes(self):
+        """once this group's levels are recorded, takes part in the flushes of the groups that still have levels to record"""
+        for flushIdx in xrange(self.numSharedFlushes - self.numFlushes):
+            self.fout.flush()
+        self.numFlushes = self.numSharedFlushes
@@ -1,7 +1,9 @@
 # Run to convert the dumped metadata for the ocean data into csv files that Spark can load
+#  python dump_CESM_metadata.py --outDir output [--format parquet] [--mpi]
+# see metadataExport.py for the options
 
 import numpy as np
-import csv
+from metadataExport import exportArguments, MetadataExporter
 
 # NOT ACCURATE: just copied from the CFSRO mapping
 """
@@ -13,51 +15,32 @@ depthLookupTable = { 5: 10, 15: 10, 25: 10, 35: 10, 45: 10, 55: 10, 65: 10, 75:
 497.5, 4478: 512 }
 """
 
-outDir = 'output'
-metadataFname = outDir + "/tempCESMMetadata.npz"
-observedLatFname = outDir + "/observedLatitudes.csv"
-observedDepthFname = outDir + "/observedDepths.csv"
-latListFname = outDir + "/latList.lst"
-lonListFname = outDir + "/lonList.lst"
-depthListFname = outDir + "/depthList.lst"
-observedLocationsFname = outDir + "/observedLocations.lst"
-observedTareaFname = outDir + "/observedTareas.lst"
-dateListFname = outDir + "/columnDates.lst"
-
-metadata = np.load(metadataFname)
+args = exportArguments("exports the CESM metadata into files that Spark can load", "tempCESMMetadata.npz")
+outDir = args.outDir
+metadataFname = args.metadata
+observedLatName = "observedLatitudes"
+observedDepthName = "observedDepths"
+latListName = "latList"
+lonListName = "lonList"
+depthListName = "depthList"
+observedLocationsName = "observedLocations"
+observedTareaName = "observedTareas"
+dateListName = "columnDates"
+
+metadata = np.load(metadataFname, allow_pickle=True)
 recordedLats = metadata["observedLatCoords"]
 recordedTareas = metadata["observedTareas"]
 recordedLevelIndices =  metadata["observedLevelDepths"]
 # this data is unknown for the CESM data
-#observedLevelDepths = map(lambda levelIdx: depthLookupTable[int(levelIdx)], recordedLevelIndices)
-
-def strLine(number):
-    return str(number) + "\n"
-
-with open(dateListFname, 'w') as fout:
-    timeStamps = [item for sublist in metadata["timeStamps"] for item in sublist]
-    fout.writelines( map( lambda str: str + "\n", map(lambda stamp: str(int(stamp)), timeStamps)))
-
-with open(latListFname, 'w') as fout:
-    fout.writelines( map(strLine, metadata["latList"]) )
-
-with open(lonListFname, 'w') as fout:
-    fout.writelines( map(strLine, metadata["lonList"]) )
-
-with open(observedLocationsFname, 'w') as fout:
-    fout.writelines( map(strLine, metadata["observedLocations"]) )
-
-with open(observedLatFname, 'w') as csvfile:
-    fieldnames = ['rowidx', 'latitude']
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-    for (idx, val) in enumerate(recordedLats):
-        writer.writerow({'rowidx' : idx, 'latitude' : val})
+#observedLevelDepths = np.array([depthLookupTable[int(levelIdx)] for levelIdx in recordedLevelIndices])
 
-with open(observedTareaFname, 'w') as csvfile:
-    fieldnames = ['rowidx', 'tarea']
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+exporter = MetadataExporter(outDir, args.format, args.blockRows, args.mpi)
 
-    for (idx, val) in enumerate(recordedTareas):
-        writer.writerow({'rowidx' : idx, 'tarea' : val})
+timeStamps = np.concatenate([np.asarray(sublist) for sublist in metadata["timeStamps"]])
+exporter.writeList(dateListName, timeStamps.astype(np.int64))
+exporter.writeList(latListName, metadata["latList"])
+exporter.writeList(lonListName, metadata["lonList"])
 
+exporter.writeRowTable(observedLocationsName, ["location"], [metadata["observedLocations"]], textIndexQ=False, textExtension="lst")
+exporter.writeRowTable(observedLatName, ["latitude"], [recordedLats])
+exporter.writeRowTable(observedTareaName, ["tarea"], [recordedTareas], textExtension="lst")
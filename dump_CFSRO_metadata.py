@@ -1,7 +1,9 @@
 # Run to convert the metadata for the ocean data into csv files that Spark can load
+#  python dump_CFSRO_metadata.py --outDir output [--format parquet] [--mpi]
+# see metadataExport.py for the options
 
 import numpy as np
-import csv
+from metadataExport import exportArguments, MetadataExporter
 
 # for the CFSRO dataset, maps level numbers from the input netcdf files into actual level depth in meters
 depthLookupTable = {
@@ -47,71 +49,37 @@ depthLookupTable = {
         4478: 512
 }
 
-#outDir = 'testOutputs'
-outDir = 'output'
-metadataFname = outDir + "/oceanMetadata.npz" # the file containing all the metadata collected during the conversion process
-observedLatFname = outDir + "/observedLatitudes.csv" # latitude of the measurements on each row of the matrix
-observedLonFname = outDir + "/observedLongitudes.csv" # longitude of the measurements on each row of the matrix
-observedLevelFname = outDir + "/observedLevelIndices.csv" # level indicator of the measurements on each row of the matrix
-#observedDepthFname = outDir + "/observedDepths.csv" # depths of the measurements on each row of the matrix
-observedLocationsFname = outDir + "/observedLocations.lst" # for each row of the matrix, indicates the corresponding grid point in the original 3D grid (flattened to a vector) of measurements
-latListFname = outDir + "/latList.lst" # the values of latitude sampled to form the original 3D grid of measurements
-lonListFname = outDir + "/lonList.lst" # the values of longitude sampled to form the original 3D grid of measurements
-depthListFname = outDir + "/depthList.lst" # the values of depths sampled to form the original 3D grid of measurements
-dateListFname = outDir + "/columnDates.lst" # the date/time for each column of the matrix
-
-metadata = np.load(metadataFname)
+args = exportArguments("exports the CFSRO metadata into files that Spark can load", "oceanMetadata.npz")
+outDir = args.outDir
+metadataFname = args.metadata # the file containing all the metadata collected during the conversion process
+observedLatName = "observedLatitudes" # latitude of the measurements on each row of the matrix
+observedLonName = "observedLongitudes" # longitude of the measurements on each row of the matrix
+observedLevelName = "observedLevelIndices" # level indicator of the measurements on each row of the matrix
+#observedDepthName = "observedDepths" # depths of the measurements on each row of the matrix
+observedLocationsName = "observedLocations" # for each row of the matrix, indicates the corresponding grid point in the original 3D grid (flattened to a vector) of measurements
+latListName = "latList" # the values of latitude sampled to form the original 3D grid of measurements
+lonListName = "lonList" # the values of longitude sampled to form the original 3D grid of measurements
+depthListName = "depthList" # the values of depths sampled to form the original 3D grid of measurements
+dateListName = "columnDates" # the date/time for each column of the matrix
+
+metadata = np.load(metadataFname, allow_pickle=True)
 recordedLats = metadata["observedLatCoords"]
 recordedLons = metadata["observedLonCoords"]
 recordedLevelIndices = metadata["observedLevelNumbers"]
 #recordedLevelIndices =  metadata["observedLevelDepths"]
 
 # convert the level indices to actual depths in meters
-#observedLevelDepths = map(lambda levelIdx: depthLookupTable[int(levelIdx)], recordedLevelIndices)
-
-def strLine(number):
-    return str(number) + "\n"
-
-with open(dateListFname, 'w') as fout:
-    fout.writelines( map( lambda str: str + "\n", map("".join, metadata["timeStamps"]) ) )
-
-with open(latListFname, 'w') as fout:
-    fout.writelines( map(strLine, metadata["latList"]) )
-
-with open(lonListFname, 'w') as fout:
-    fout.writelines( map(strLine, metadata["lonList"]) )
-
-with open(depthListFname, 'w') as fout:
-    fout.writelines( map(strLine, map(lambda levelIdx: depthLookupTable[levelIdx], metadata["depthList"])) )
-
-with open(observedLocationsFname, 'w') as fout:
-    fout.writelines( map(strLine, metadata["observedLocations"]) )
-
-with open(observedLevelFname, 'w') as csvfile:
-    fieldnames = ['rowidx', 'levelindex']
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-    for (idx, val) in enumerate(recordedLevelIndices):
-        writer.writerow({'rowidx' : idx, 'levelindex' : val})
-
-# with open(observedDepthFname, 'w') as csvfile:
-#     fieldnames = ['rowidx', 'thickness']
-#     writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-# 
-#     for (idx, val) in enumerate(observedLevelDepths):
-#         writer.writerow({'rowidx' : idx, 'thickness' : val})
-
-with open(observedLatFname, 'w') as csvfile:
-    fieldnames = ['rowidx', 'latitude']
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-    for (idx, val) in enumerate(recordedLats):
-        writer.writerow({'rowidx' : idx, 'latitude' : val})
+#observedLevelDepths = np.array([depthLookupTable[int(levelIdx)] for levelIdx in recordedLevelIndices])
 
-with open(observedLonFname, 'w') as csvfile:
-    fieldnames = ['rowidx', 'longitude']
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+exporter = MetadataExporter(outDir, args.format, args.blockRows, args.mpi)
 
-    for (idx, val) in enumerate(recordedLons):
-        writer.writerow({'rowidx' : idx, 'longitude' : val})
+exporter.writeList(dateListName, map("".join, metadata["timeStamps"]))
+exporter.writeList(latListName, metadata["latList"])
+exporter.writeList(lonListName, metadata["lonList"])
+exporter.writeList(depthListName, [depthLookupTable[levelIdx] for levelIdx in metadata["depthList"]])
 
+exporter.writeRowTable(observedLocationsName, ["location"], [metadata["observedLocations"]], textIndexQ=False, textExtension="lst")
+exporter.writeRowTable(observedLevelName, ["levelindex"], [recordedLevelIndices])
+#exporter.writeRowTable(observedDepthName, ["thickness"], [observedLevelDepths])
+exporter.writeRowTable(observedLatName, ["latitude"], [recordedLats])
+exporter.writeRowTable(observedLonName, ["longitude"], [recordedLons])
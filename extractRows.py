@@ -0,0 +1,233 @@
+# Extracts any subset of the rows of a converted dataset (by level, lat/lon box, or a land/sea or region mask over the grid)
+# into a new file, along with the matching metadata
+#
+# The selected rows are turned into runs of contiguous rows, and each process streams its share of the output rows in blocks
+# that fit in memoryBudget bytes, with collective reads and writes, so no process ever holds its whole slab
+# (which hit the 4GB h5py limit and the job memory limits when extractThermocline read everything at once)
+#
+# e.g. to keep levels 9 to 39 of the North Atlantic:
+#  srun -c 2 -n 512 -u python-mpi -u ./extractRows.py ocean.h5 northAtlantic.h5 --metadata oceanMetadata.npz \
+#       --metadataOut northAtlanticMetadata.npz --levels 9-39 --latRange 0 65 --lonRange 280 360
+# extractThermocline.py is the preset for the thermocline cut
+
+from mpi4py import MPI
+import h5py
+import numpy as np
+import argparse, sys
+
+from conversionHelpers import writeHyperslab
+
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+mpiInfo = MPI.Info.Create()
+numProcs = comm.Get_size()
+
+defaultMemoryBudget = 1024*1024*1024 # bytes of rows each process holds at a time
+maxTransferBytes = 2**31 - 1 # MPI-IO can't move more than this in one read or write
+
+### Row selections: each takes the metadata and returns a boolean mask over the rows
+
+def levelSelection(levels, levelField="observedLevelNumbers"):
+    """selects the rows on the given levels, as recorded in levelField (observedLevelDepths for the CESM data)"""
+    return lambda metadata: np.in1d(metadata[levelField], levels)
+
+def levelRangeSelection(levelRanges, levelField="observedLevelNumbers"):
+    """selects the rows whose value of levelField is in one of the (first, last) levelRanges, ends included; the values can be
+    level numbers, or depths such as the observedLevelDepths of the CESM data"""
+    def selectLevels(metadata):
+        levelValues = np.asarray(metadata[levelField])
+        return np.logical_or.reduce([(levelValues >= first) & (levelValues <= last) for (first, last) in levelRanges])
+    return selectLevels
+
+def gridIndices(metadata):
+    """the (lat index, lon index) of the grid point of each row"""
+    (numLats, numLongs) = (int(metadata["numLats"]), int(metadata["numLongs"]))
+    return np.unravel_index(metadata["observedLocations"] % (numLats*numLongs), (numLats, numLongs))
+
+def boxSelection(latRange, lonRange):
+    """selects the rows in a lat/lon box; a lonRange going past 360 or with its ends swapped wraps around the dateline"""
+    def selectBox(metadata):
+        (latIndices, lonIndices) = gridIndices(metadata)
+        lats = np.asarray(metadata["latList"])[latIndices]
+        lons = np.mod(np.asarray(metadata["lonList"])[lonIndices], 360)
+        (lonStart, lonEnd) = (lonRange[0] % 360, lonRange[1] % 360)
+        if lonRange[1] - lonRange[0] >= 360:
+            inLonRange = np.ones(lons.shape, dtype=np.bool_)
+        elif lonStart <= lonEnd:
+            inLonRange = (lons >= lonStart) & (lons <= lonEnd)
+        else:
+            inLonRange = (lons >= lonStart) | (lons <= lonEnd)
+        return (lats >= latRange[0]) & (lats <= latRange[1]) & inLonRange
+    return selectBox
+
+def gridMaskSelection(gridMask):
+    """selects the rows whose grid point is set in gridMask, a (lat x lon) boolean array such as a land/sea, coastal or basin mask"""
+    return lambda metadata: np.asarray(gridMask, dtype=np.bool_)[gridIndices(metadata)]
+
+def allOf(*rowSelections):
+    """selects the rows picked by every one of rowSelections"""
+    return lambda metadata: np.logical_and.reduce([rowSelection(metadata) for rowSelection in rowSelections])
+
+### Extraction
+
+def loadMetadata(fin, datasetName, metadataFname):
+    """the metadata of the rows of datasetName: from the npz file written by the converter, or if metadataFname is None,
+    from the metadata group that the converters store in the output file"""
+    if metadataFname is not None:
+        return np.load(metadataFname, allow_pickle=True)
+    group = fin["metadata/" + datasetName]
+    metadata = dict([(fieldName, group[fieldName][:]) for fieldName in group])
+    metadata.update(group.attrs.items())
+    return metadata
+
+def rowRuns(keepIndices):
+    """splits the sorted row indices into runs of contiguous rows, returning the first input row, first output row and length of each run"""
+    if len(keepIndices) == 0:
+        return (np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64))
+    runBreaks = np.nonzero(np.diff(keepIndices) != 1)[0] + 1
+    runInputStarts = keepIndices[np.hstack([[0], runBreaks])]
+    runLengths = np.diff(np.hstack([[0], runBreaks, [len(keepIndices)]]))
+    runOutputStarts = np.hstack([[0], np.cumsum(runLengths)[:-1]]).astype(np.int64)
+    return (runInputStarts, runOutputStarts, runLengths)
+
+def runPieces(runs, startOutputRow, endOutputRow):
+    """the (first input row, number of rows) pieces of the runs that make up the output rows [startOutputRow, endOutputRow)"""
+    (runInputStarts, runOutputStarts, runLengths) = runs
+    pieces = []
+    runIdx = max(0, np.searchsorted(runOutputStarts, startOutputRow, side="right") - 1)
+    while runIdx < len(runLengths) and runOutputStarts[runIdx] < endOutputRow:
+        pieceStart = max(startOutputRow, runOutputStarts[runIdx])
+        pieceEnd = min(endOutputRow, runOutputStarts[runIdx] + runLengths[runIdx])
+        if pieceEnd > pieceStart:
+            pieces.append((runInputStarts[runIdx] + pieceStart - runOutputStarts[runIdx], pieceEnd - pieceStart))
+        runIdx = runIdx + 1
+    return pieces
+
+def readRowRuns(dataset, pieces, out, collectiveQ):
+    """reads the rows in pieces, in order, into out with one (collective, if collectiveQ) read; every process has to call this
+    when collectiveQ, with no pieces if it has nothing to read"""
+    filespace = dataset.id.get_space()
+    memspace = h5py.h5s.create_simple(out.shape)
+    if len(pieces) > 0:
+        filespace.select_none()
+        for (inputStart, numRows) in pieces:
+            filespace.select_hyperslab((inputStart, 0), (numRows, dataset.shape[1]), op=h5py.h5s.SELECT_OR)
+    else:
+        filespace.select_none()
+        memspace.select_none()
+    dxpl = h5py.h5p.create(h5py.h5p.DATASET_XFER)
+    if collectiveQ:
+        dxpl.set_dxpl_mpio(h5py.h5fd.MPIO_COLLECTIVE)
+    dataset.id.read(memspace, filespace, out, dxpl=dxpl)
+
+def openParallelFile(fname, createQ):
+    propfaid = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+    propfaid.set_fapl_mpio(comm, mpiInfo)
+    if createQ:
+        return h5py.File(h5py.h5f.create(fname, flags=h5py.h5f.ACC_TRUNC, fapl=propfaid))
+    return h5py.File(h5py.h5f.open(fname, flags=h5py.h5f.ACC_RDONLY, fapl=propfaid))
+
+def subsetRowIndex(metadata, observedLocations):
+    """the row index (levelRowOffsets and gridRowIndex, see rowIndex in the converters) of the rows at observedLocations,
+    which are in increasing order like the rows of the converted dataset"""
+    gridSize = len(metadata["gridRowIndex"]) - 1
+    levelSize = int(metadata["numLats"])*int(metadata["numLongs"])
+    gridRowIndex = np.hstack([[0], np.cumsum(np.bincount(observedLocations, minlength=gridSize))]).astype(np.int64)
+    return (gridRowIndex[::levelSize].copy(), gridRowIndex)
+
+def writeMetadataSubset(metadataFnameOut, metadata, keepIndices):
+    """writes the metadata of the extracted rows: the per-row fields (the observed* ones) cut down to the kept rows, the row index
+    rebuilt for them, everything else as is, and sourceRows, the row of the input dataset each output row came from. Note observedLocations
+    still index the original (not subsetted!) grid, so keep this in mind when using this field to unfold from the matrix to the 3d grid"""
+    metadataOut = {"sourceRows": keepIndices}
+    for fieldName in metadata.keys():
+        if fieldName.startswith("observed"):
+            metadataOut[fieldName] = np.asarray(metadata[fieldName])[keepIndices]
+        elif fieldName not in ["levelRowOffsets", "gridRowIndex"]:
+            metadataOut[fieldName] = metadata[fieldName]
+    if "gridRowIndex" in metadata:
+        (metadataOut["levelRowOffsets"], metadataOut["gridRowIndex"]) = subsetRowIndex(metadata, metadataOut["observedLocations"])
+    np.savez(metadataFnameOut, **metadataOut)
+
+def extractRows(fnameIn, fnameOut, rowSelection, metadataFnameIn=None, metadataFnameOut=None, datasetName="rows", memoryBudget=defaultMemoryBudget):
+    """writes the rows of datasetName picked by rowSelection (see the selections above) to a dataset of the same name, type and
+    attributes in fnameOut, and their metadata to metadataFnameOut (unless it is None); collective"""
+    fin = openParallelFile(fnameIn, False)
+    rowsIn = fin[datasetName]
+    metadata = loadMetadata(fin, datasetName, metadataFnameIn)
+    keepIndices = np.nonzero(rowSelection(metadata))[0]
+    numRows = len(keepIndices)
+    numCols = rowsIn.shape[1]
+    runs = rowRuns(keepIndices)
+    if rank == 0:
+        print "Extracting %d of the %d rows of %s, in %d runs of contiguous rows" % (numRows, rowsIn.shape[0], datasetName, len(runs[2]))
+        if metadataFnameOut is not None:
+            writeMetadataSubset(metadataFnameOut, metadata, keepIndices)
+
+    # create the output file and dataset efficiently, keeping the on-disk type and precision attributes of the input dataset
+    fout = openParallelFile(fnameOut, True)
+    spaceid = h5py.h5s.create_simple((numRows, numCols))
+    plist = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+    plist.set_fill_time(h5py.h5d.FILL_TIME_NEVER)
+    rowsOut = h5py.Dataset(h5py.h5d.create(fout.id, datasetName, rowsIn.id.get_type(), spaceid, plist))
+    for (attrName, attrValue) in rowsIn.attrs.items():
+        rowsOut.attrs[attrName] = attrValue
+
+    # each process streams an even share of the output rows, a block at a time
+    outputBoundaries = (numRows*np.arange(numProcs + 1))/numProcs
+    (startOutputRow, endOutputRow) = (outputBoundaries[rank], outputBoundaries[rank + 1])
+    rowBytes = max(1, numCols*rowsIn.dtype.itemsize)
+    blockRows = max(1, min(memoryBudget, maxTransferBytes)/rowBytes)
+    numBlocks = comm.allreduce((endOutputRow - startOutputRow + blockRows - 1)/blockRows, op=MPI.MAX)
+    blockBuffer = np.empty((min(blockRows, endOutputRow - startOutputRow), numCols), dtype=rowsIn.dtype)
+    for blockNum in xrange(numBlocks):
+        blockStart = min(startOutputRow + blockNum*blockRows, endOutputRow)
+        blockEnd = min(blockStart + blockRows, endOutputRow)
+        block = blockBuffer[:(blockEnd - blockStart)]
+        readRowRuns(rowsIn, runPieces(runs, blockStart, blockEnd), block, True)
+        writeHyperslab(rowsOut, block, (blockStart, 0), True)
+        if rank == 0:
+            print "Wrote block %d of %d" % (blockNum + 1, numBlocks)
+
+    fin.close()
+    fout.close()
+    return numRows
+
+def parseLevels(levelsArg):
+    """turns e.g. "0,2,9-39" into the level ranges [(0, 0), (2, 2), (9, 39)] for levelRangeSelection; the levels are read as floats,
+    so they can also be depths, e.g. "500.0" or "0-1000", which are selected by value"""
+    levelRanges = []
+    for levelRange in levelsArg.split(","):
+        (first, sep, last) = levelRange.partition("-")
+        levelRanges.append((float(first), float(last if sep else first)))
+    return levelRanges
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="extracts the rows of a converted dataset that match all the given selections")
+    parser.add_argument("fnameIn")
+    parser.add_argument("fnameOut")
+    parser.add_argument("--dataset", default="rows")
+    parser.add_argument("--metadata", default=None, help="the metadata npz of the input; by default the metadata group in fnameIn is used")
+    parser.add_argument("--metadataOut", default=None)
+    parser.add_argument("--levels", default=None, help='levels to keep, e.g. "9-39" or "0,2,4", or with --levelField observedLevelDepths, depths such as "500.0" or "0-1000"')
+    parser.add_argument("--levelField", default="observedLevelNumbers")
+    parser.add_argument("--latRange", type=float, nargs=2, default=None)
+    parser.add_argument("--lonRange", type=float, nargs=2, default=None)
+    parser.add_argument("--gridMask", default=None, help="a .npy (lat x lon) boolean array; keeps the rows at grid points where it is set")
+    parser.add_argument("--invertGridMask", action="store_true", help="keep the rows at grid points where the grid mask is not set")
+    parser.add_argument("--memoryBudget", type=int, default=defaultMemoryBudget, help="bytes of rows each process holds at a time")
+    args = parser.parse_args()
+
+    rowSelections = []
+    if args.levels is not None:
+        rowSelections.append(levelRangeSelection(parseLevels(args.levels), args.levelField))
+    if args.latRange is not None or args.lonRange is not None:
+        rowSelections.append(boxSelection(args.latRange or (-90, 90), args.lonRange or (0, 360)))
+    if args.gridMask is not None:
+        gridMask = np.load(args.gridMask).astype(np.bool_)
+        rowSelections.append(gridMaskSelection(np.logical_not(gridMask) if args.invertGridMask else gridMask))
+    if len(rowSelections) == 0:
+        if rank == 0:
+            print "No selection given, see --help"
+        sys.exit(1)
+    extractRows(args.fnameIn, args.fnameOut, allOf(*rowSelections), args.metadata, args.metadataOut, args.dataset, args.memoryBudget)
@@ -0,0 +1,92 @@
+# Writes small synthetic datasets laid out like the CFSRO and CESM ocean data, so the converters can be
+# run and benchmarked on one machine (see benchmarkConverters.py)
+#
+# To run:
+#  python generateSyntheticData.py cfsro outputDir --files 16 --levels 10 --lats 36 --longs 72
+#  python generateSyntheticData.py cesm outputDir --files 4 --timesteps 12
+# the CESM datasets go into the TEMP and RHO subdirectories of outputDir
+
+from netCDF4 import Dataset
+import numpy as np
+from os import makedirs
+from os.path import isdir, join
+import argparse
+
+def landMask(numLevels, numLats, numLongs, seed):
+    """a fixed (level x lat x lon) land mask: each grid point has a random sea floor level, and every level
+    from the sea floor down is land, so the number of observed points shrinks with depth like in the real data"""
+    rng = np.random.RandomState(seed)
+    seaFloorLevels = rng.randint(0, numLevels + 1, size=(numLats, numLongs))
+    return np.arange(numLevels)[:, np.newaxis, np.newaxis] >= seaFloorLevels[np.newaxis, :, :]
+
+def syntheticValues(fileIdx, numTimeSlices, missingMask, seed):
+    """values that differ between files, time slices and grid points, so any misplaced value shows up in the check against the inputs"""
+    rng = np.random.RandomState(seed + fileIdx + 1)
+    values = 1000*fileIdx + np.arange(numTimeSlices)[:, np.newaxis, np.newaxis, np.newaxis] + \
+            rng.rand(numTimeSlices, *missingMask.shape)
+    return np.ma.masked_array(values.astype(np.float32), np.broadcast_to(missingMask, values.shape))
+
+def generateCFSRO(outDir, numFiles, numLevels, numLats, numLongs, maxTimeSlices=3, seed=0):
+    """writes numFiles CFSRO-like files, holding 1 to maxTimeSlices time slices of POT_L160_Avg_1 each"""
+    if not isdir(outDir):
+        makedirs(outDir)
+    missingMask = landMask(numLevels, numLats, numLongs, seed)
+    for fileIdx in xrange(numFiles):
+        numTimeSlices = 1 + fileIdx % maxTimeSlices
+        fout = Dataset(join(outDir, "ocnh01.gdas.%08d.grb2.nc" % fileIdx), "w", format="NETCDF3_64BIT")
+        fout.createDimension("time", numTimeSlices)
+        fout.createDimension("level0", numLevels)
+        fout.createDimension("lat", numLats)
+        fout.createDimension("lon", numLongs)
+        fout.createDimension("nchar", 10)
+        values = fout.createVariable("POT_L160_Avg_1", "f4", ("time", "level0", "lat", "lon"), fill_value=9.999e20)
+        values[:] = syntheticValues(fileIdx, numTimeSlices, missingMask, seed)
+        fout.createVariable("lat", "f4", ("lat",))[:] = np.linspace(-89.75, 89.75, numLats)
+        fout.createVariable("lon", "f4", ("lon",))[:] = np.linspace(0.25, 359.75, numLongs)
+        fout.createVariable("level0", "f4", ("level0",))[:] = 5 + 10*np.arange(numLevels)
+        timeStamps = fout.createVariable("ref_date_time", "S1", ("time", "nchar"))
+        timeStamps[:] = np.array([list("%010d" % (100*fileIdx + timeIdx)) for timeIdx in xrange(numTimeSlices)])
+        fout.close()
+
+def generateCESM(outDir, numFiles, numTimeSlices, numLevels, numLats, numLongs, seed=0):
+    """writes numFiles CESM-like files of numTimeSlices time slices each, for both TEMP and RHO (in the TEMP and RHO subdirectories)"""
+    missingMask = landMask(numLevels, numLats, numLongs, seed)
+    for (varIdx, varName) in enumerate(["TEMP", "RHO"]):
+        varDir = join(outDir, varName)
+        if not isdir(varDir):
+            makedirs(varDir)
+        for fileIdx in xrange(numFiles):
+            startYear = 1920 + 10*fileIdx
+            fname = "b.e11.B20TRC5CNBDRD.f09_g16.001.pop.h.%s.%04d01-%04d12.nc" % (varName, startYear, startYear + 9)
+            fout = Dataset(join(varDir, fname), "w", format="NETCDF4_CLASSIC")
+            fout.createDimension("time", numTimeSlices)
+            fout.createDimension("z_t", numLevels)
+            fout.createDimension("nlat", numLats)
+            fout.createDimension("nlon", numLongs)
+            values = fout.createVariable(varName, "f4", ("time", "z_t", "nlat", "nlon"), fill_value=9.96921e36)
+            values[:] = syntheticValues(fileIdx + 1000*varIdx, numTimeSlices, missingMask, seed)
+            (latGrid, lonGrid) = np.meshgrid(np.linspace(-79.5, 89.5, numLats), np.linspace(0.5, 359.5, numLongs), indexing="ij")
+            fout.createVariable("ULAT", "f8", ("nlat", "nlon"))[:] = latGrid
+            fout.createVariable("ULONG", "f8", ("nlat", "nlon"))[:] = lonGrid
+            fout.createVariable("TAREA", "f8", ("nlat", "nlon"))[:] = 1e12*np.cos(np.radians(latGrid))
+            fout.createVariable("z_t", "f4", ("z_t",))[:] = 500 + 1000*np.arange(numLevels)
+            fout.createVariable("dz", "f4", ("z_t",))[:] = 1000*np.ones(numLevels)
+            fout.createVariable("time", "f8", ("time",))[:] = 3650*fileIdx + 30*np.arange(numTimeSlices)
+            fout.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="writes a synthetic CFSRO-like or CESM-like ocean dataset")
+    parser.add_argument("layout", choices=["cfsro", "cesm"])
+    parser.add_argument("outDir")
+    parser.add_argument("--files", type=int, default=16)
+    parser.add_argument("--timesteps", type=int, default=12, help="time slices per file (CESM; CFSRO files have 1 to 3)")
+    parser.add_argument("--levels", type=int, default=10)
+    parser.add_argument("--lats", type=int, default=36)
+    parser.add_argument("--longs", type=int, default=72)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.layout == "cfsro":
+        generateCFSRO(args.outDir, args.files, args.levels, args.lats, args.longs, seed=args.seed)
+    else:
+        generateCESM(args.outDir, args.files, args.timesteps, args.levels, args.lats, args.longs, seed=args.seed)
@@ -0,0 +1,107 @@
+# Helpers for dump_CFSRO_metadata.py and dump_CESM_metadata.py: write the metadata arrays that Spark loads in large vectorized
+# blocks, either as the usual text files or (with pyarrow) as parquet files, which Spark can split and read without parsing text.
+# With --mpi, every process writes an even share of the per-row metadata to its own part file, e.g.
+#  srun -n 16 python-mpi ./dump_CFSRO_metadata.py --mpi --format parquet
+# and the per-row outputs become directories of part files (observedLatitudes.csv/part-00000.csv, ...), which Spark reads as one table
+
+import numpy as np
+from os import makedirs
+from os.path import isdir, join
+import argparse, sys
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+def exportArguments(description, defaultMetadataFname):
+    """parses the command line options shared by the dump scripts"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--outDir", default="output")
+    parser.add_argument("--metadata", default=None, help="the metadata npz written by the converter (default: %s in outDir)" % defaultMetadataFname)
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv",
+            help="csv writes the same text files as before; parquet writes one columnar file per table, with a row index column")
+    parser.add_argument("--blockRows", type=int, default=1000000, help="rows formatted and written at a time (one row group each in parquet)")
+    parser.add_argument("--mpi", action="store_true", help="split the per-row tables into one part file per MPI process")
+    args = parser.parse_args()
+    if args.metadata is None:
+        args.metadata = join(args.outDir, defaultMetadataFname)
+    if args.format == "parquet" and pyarrow is None:
+        sys.exit("--format parquet needs pyarrow")
+    return args
+
+def textValues(values):
+    """the values of a numpy array as strings, in the shortest form that reads back to the same value of its dtype, as str gives
+    for each of them (so the floats keep their .0, and float32 values are not padded out to float64 digits)"""
+    return values.astype(str)
+
+class MetadataExporter(object):
+    """writes tables for Spark into outDir in the given format; the per-row tables are split between the MPI processes when mpiQ"""
+
+    def __init__(self, outDir, fileFormat, blockRows, mpiQ):
+        self.outDir = outDir
+        self.fileFormat = fileFormat
+        self.blockRows = blockRows
+        self.mpiQ = mpiQ
+        if mpiQ:
+            from mpi4py import MPI
+            self.comm = MPI.COMM_WORLD
+            self.rank = self.comm.Get_rank()
+            self.numProcs = self.comm.Get_size()
+        else:
+            self.rank = 0
+            self.numProcs = 1
+        if self.rank == 0 and not isdir(outDir):
+            makedirs(outDir)
+        if mpiQ:
+            self.comm.Barrier()
+
+    def localRows(self, numRows):
+        """the range of rows written by this process: an even share of them, in rank order"""
+        rowBoundaries = np.linspace(0, numRows, self.numProcs + 1).astype(np.int64)
+        return (rowBoundaries[self.rank], rowBoundaries[self.rank + 1])
+
+    def partFname(self, name, extension):
+        """the file this process writes its part of the table name to: a part file inside the directory name.extension under --mpi"""
+        if not self.mpiQ:
+            return join(self.outDir, "%s.%s" % (name, extension))
+        partDir = join(self.outDir, "%s.%s" % (name, extension))
+        if self.rank == 0 and not isdir(partDir):
+            makedirs(partDir)
+        self.comm.Barrier()
+        return join(partDir, "part-%05d.%s" % (self.rank, extension))
+
+    def writeRowTable(self, name, fieldNames, columns, textIndexQ=True, textExtension="csv"):
+        """writes the per-row table name, with the given columns of equal length; in text formats, each line is the row index
+        (if textIndexQ) followed by the values, while parquet tables always start with a rowidx column"""
+        (startRow, endRow) = self.localRows(len(columns[0]))
+        if self.fileFormat == "parquet":
+            self.writeParquet(self.partFname(name, "parquet"), ["rowidx"] + fieldNames, columns, startRow, endRow)
+            return
+        with open(self.partFname(name, textExtension), "w") as fout:
+            for blockStart in xrange(startRow, endRow, self.blockRows):
+                blockEnd = min(blockStart + self.blockRows, endRow)
+                blockColumns = [np.asarray(column[blockStart:blockEnd]) for column in columns]
+                if textIndexQ:
+                    blockColumns = [np.arange(blockStart, blockEnd)] + blockColumns
+                # the csv module ends lines with \r\n, so keep doing that for the files it used to write
+                np.savetxt(fout, np.column_stack(map(textValues, blockColumns)), fmt="%s", delimiter=",", newline="\r\n" if textIndexQ else "\n")
+
+    def writeList(self, name, values):
+        """writes a short list (e.g. the grid coordinates or the column dates) as a text file with one value per line, from rank 0"""
+        if self.rank == 0:
+            with open(join(self.outDir, name + ".lst"), "w") as fout:
+                fout.writelines([str(value) + "\n" for value in values])
+
+    def writeParquet(self, fname, fieldNames, columns, startRow, endRow):
+        writer = None
+        for blockStart in xrange(startRow, endRow, self.blockRows):
+            blockEnd = min(blockStart + self.blockRows, endRow)
+            blockColumns = [np.arange(blockStart, blockEnd)] + [np.asarray(column[blockStart:blockEnd]) for column in columns]
+            table = pyarrow.Table.from_arrays(map(pyarrow.array, blockColumns), fieldNames)
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(fname, table.schema)
+            writer.write_table(table)
+        if writer is not None:
+            writer.close()
@@ -5,7 +5,49 @@
 
 import numpy as np
 from h5py import File
-from matplotlib import pyplot as plt
+
+# the chunk cache used when reading the matrix; only matters if it was written with a chunked layout
+chunkCacheBytes = 256*1024*1024
+chunkCacheSlots = 10007
+
+def unpack_values(matrix, values):
+    """ converts values read from the matrix back to floats when it was written with the packed int16 output precision """
+    if matrix.attrs.get("precision") == "int16":
+        return values*matrix.attrs["scale_factor"] + matrix.attrs["add_offset"]
+    return values
+
+def consecutive_runs(indices):
+    """ splits sorted indices into runs of consecutive values, returning the first and last index of each run """
+    indices = np.asarray(indices, dtype=np.int64)
+    breaks = np.nonzero(np.diff(indices) != 1)[0]
+    return (indices[np.hstack([[0], breaks + 1])], indices[np.hstack([breaks, [len(indices) - 1]])])
+
+def region_row_ranges(metadata, latindices, lonindices, levelindices):
+    """
+    uses the row index stored with the metadata (levelRowOffsets and gridRowIndex) to find the rows of a region without
+    scanning all the rows: every run of consecutive longitudes at a (level, lat) pair is a contiguous range of rows, and
+    ranges that touch are merged, so e.g. a whole level is a single range
+
+    latindices, lonindices, levelindices -- the indices into latList, lonList and the levels of the grid points to keep
+
+    starts, ends -- the [start, end) ranges of the rows of the region, in increasing order
+    """
+    if len(latindices) == 0 or len(lonindices) == 0 or len(levelindices) == 0:
+        return (np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64))
+    numLats = int(metadata["numLats"])
+    numLongs = int(metadata["numLongs"])
+    gridRowIndex = metadata["gridRowIndex"]
+    (firstLons, lastLons) = consecutive_runs(np.unique(np.asarray(lonindices, dtype=np.int64)))
+    levels = np.unique(np.asarray(levelindices, dtype=np.int64))
+    latStarts = (levels[:, np.newaxis]*numLats + np.unique(np.asarray(latindices, dtype=np.int64))[np.newaxis, :]).flatten()*numLongs
+    starts = gridRowIndex[(latStarts[:, np.newaxis] + firstLons[np.newaxis, :]).flatten()]
+    ends = gridRowIndex[(latStarts[:, np.newaxis] + lastLons[np.newaxis, :] + 1).flatten()]
+    nonempty = starts < ends
+    (starts, ends) = (starts[nonempty], ends[nonempty])
+    if len(starts) == 0:
+        return (starts, ends)
+    separate = np.hstack([[True], starts[1:] != ends[:-1]])
+    return (starts[separate], ends[np.hstack([separate[1:], [True]])])
 
 def extract_region(matrix, metadata, lats, lons, levelindices):
     """ 
@@ -21,13 +63,23 @@ def extract_region(matrix, metadata, lats, lons, levelindices):
     lons -- ditto for longitudes
     depths -- ditto for depths
     indices -- the indices of the rows in submat, in the original matrix
+
+    with the row index in the metadata, the rows are read as a few contiguous ranges; older metadata files without it
+    are handled by scanning the coordinates of every row
     """
 
-    keepQ = np.logical_and(np.in1d(metadata["observedLatCoords"], lats), np.in1d(metadata["observedLonCoords"], lons))
-    keepQ = np.logical_and(keepQ, np.in1d(metadata["observedLevelNumbers"], levelindices) )
-    indices = np.nonzero(keepQ)[0]
+    if "gridRowIndex" in metadata:
+        (starts, ends) = region_row_ranges(metadata, np.nonzero(np.in1d(metadata["latList"], lats))[0],
+                np.nonzero(np.in1d(metadata["lonList"], lons))[0], levelindices)
+        indices = np.concatenate([np.arange(start, end) for (start, end) in zip(starts, ends)] + [np.zeros((0,), dtype=np.int64)])
+        submat = np.concatenate([matrix[start:end, :] for (start, end) in zip(starts, ends)] + [np.zeros((0, matrix.shape[1]), dtype=matrix.dtype)])
+        submat = unpack_values(matrix, submat)
+    else:
+        keepQ = np.logical_and(np.in1d(metadata["observedLatCoords"], lats), np.in1d(metadata["observedLonCoords"], lons))
+        keepQ = np.logical_and(keepQ, np.in1d(metadata["observedLevelNumbers"], levelindices) )
+        indices = np.nonzero(keepQ)[0]
+        submat = unpack_values(matrix, matrix[indices, :])
 
-    submat = matrix[indices, :]
     lats = metadata["observedLatCoords"][indices]
     lons = metadata["observedLonCoords"][indices]
     depths = metadata["observedLevelNumbers"][indices]
@@ -39,28 +91,61 @@ def extract_depth(matrix, metadata, levelindex):
     result = extract_region(matrix, metadata, metadata["latList"], metadata["lonList"], [levelindex])
     return (result[0], result[1], result[2], result[4])
 
+def unfold_columns(metadata, columns, fillvalue=np.nan, indices=None):
+    """
+    scatters rows of the matrix back onto the (level, lat, lon) grid in one vectorized assignment, using observedLocations;
+    works for the CFSRO and CESM metadata, and for the metadata of extracted datasets
+
+    columns -- one column of the matrix (a vector), or a (rows x k) block of columns
+    fillvalue -- the value of the grid points without a measurement
+    indices -- the rows of the matrix that columns hold (as returned by extract_region), if not all of them
+
+    grids -- a (level x lat x lon) grid, or a (k x level x lat x lon) stack of grids for a block of columns
+    """
+    gridShape = (int(metadata["numLevels"]), int(metadata["numLats"]), int(metadata["numLongs"]))
+    locations = metadata["observedLocations"]
+    if indices is not None:
+        locations = locations[indices]
+    columns = np.asarray(columns)
+    grids = np.full((np.prod(columns.shape[1:], dtype=np.int64), np.prod(gridShape)), fillvalue, dtype=np.result_type(columns, fillvalue))
+    grids[:, locations] = columns.reshape(columns.shape[0], -1).T
+    return grids.reshape(columns.shape[1:] + gridShape)
+
+def unfold_column_batches(matrix, metadata, colindices=None, batchsize=64, fillvalue=np.nan):
+    """
+    reads the given columns of the matrix (all of them by default) a batch at a time and unfolds each batch onto the grid,
+    so e.g. animations over thousands of timesteps never hold more than batchsize grids; consecutive columns are read as one slice
+
+    yields (batchcolumns, grids) -- the column indices in the batch, and their (k x level x lat x lon) grids
+    """
+    if colindices is None:
+        colindices = np.arange(matrix.shape[1])
+    colindices = np.asarray(colindices)
+    for batchstart in xrange(0, len(colindices), batchsize):
+        batchcolumns = colindices[batchstart:(batchstart + batchsize)]
+        if np.all(np.diff(batchcolumns) == 1):
+            columns = matrix[:, batchcolumns[0]:(batchcolumns[-1] + 1)]
+        else:
+            columns = np.column_stack([matrix[:, colidx] for colidx in batchcolumns])
+        yield (batchcolumns, unfold_columns(metadata, unpack_values(matrix, columns), fillvalue))
+
 def visualize_depth(matrix, metadata, levelindex):
     """ Visualize the average temperatures on one level of the ocean; note that we need to account for some grid points that don't have corresponding measurements;
     this is just for sanity checking that the other functions are returning the correct data """
 
-    latList = metadata["latList"]
-    lonList = metadata["lonList"]
     (temps, lats, lons, indices) = extract_depth(matrix, metadata, levelindex)
     avgTemps = np.mean(temps, axis=1)
 
     fillvalue = -1
-    tempMat = fillvalue*np.ones((len(latList), len(lonList)))
-    for idx in xrange(len(avgTemps)):
-        rowCoord = np.where( np.in1d(latList, lats[idx]) )
-        colCoord = np.where( np.in1d(lonList, lons[idx]) )
-        tempMat[rowCoord, colCoord] = avgTemps[idx]
+    return unfold_columns(metadata, avgTemps, fillvalue, indices)[int(levelindex)]
 
-    return tempMat
+if __name__ == "__main__":
+    from matplotlib import pyplot as plt
 
-fin = File("/global/cscratch1/sd/gittens/conversion-code/CFSRO_conversion/output/ocean.h5", "r")
-md = np.load("/global/cscratch1/sd/gittens/conversion-code/CFSRO_conversion/output/oceanMetadata.npz")
+    fin = File("/global/cscratch1/sd/gittens/conversion-code/CFSRO_conversion/output/ocean.h5", "r", rdcc_nbytes=chunkCacheBytes, rdcc_nslots=chunkCacheSlots)
+    md = np.load("/global/cscratch1/sd/gittens/conversion-code/CFSRO_conversion/output/oceanMetadata.npz", allow_pickle=True)
 
-# remember the data is upside down: level 0 is the bottom of the ocean, level 39 is the surface
-result = visualize_depth(fin["rows"], md, 39)
-plt.imshow(result, interpolation="nearest")
-plt.show()
+    # remember the data is upside down: level 0 is the bottom of the ocean, level 39 is the surface
+    result = visualize_depth(fin["rows"], md, 39)
+    plt.imshow(result, interpolation="nearest")
+    plt.show()
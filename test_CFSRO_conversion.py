@@ -5,11 +5,17 @@
 # To run: first do a 
 #  module load python netcdf4-python h5py
 # then start ipython and run this code interactively
+#
+# this only samples a few columns; verifyConversion.py checks every column against the checksums stored during the conversion
 
 import numpy as np
 from netCDF4 import Dataset
 import h5py
 
+# the chunk cache used when reading the matrix; only matters if it was written with a chunked layout
+chunkCacheBytes = 256*1024*1024
+chunkCacheSlots = 10007
+
 # FOR QUICK SANITY CHECKING DURING DEVELOPMENT, RUN THIS BLOCK OF CODE
 fname = "/global/cscratch1/sd/nrcavana/CFSR_OCEAN/ocnh01.gdas.20071021-20071025.grb2.nc"
 varname = "POT_L160_Avg_1"
@@ -17,7 +23,7 @@ rawFin = Dataset(fname, "r")
 rawData = rawFin[varname][:].data
 rawMask = np.logical_not(rawFin[varname][:].mask)
 rawCol = rawData[0, rawMask[0, ...]]
-outputMat = h5py.File("ocean.h5", "r")["rows"]
+outputMat = h5py.File("ocean.h5", "r", rdcc_nbytes=chunkCacheBytes, rdcc_nslots=chunkCacheSlots)["rows"]
 convertedCol = outputMat[:, 0]
 np.linalg.norm(rawCol - convertedCol) # this should be zero on success
 
@@ -28,7 +34,7 @@ np.linalg.norm(rawCol - convertedCol) # this should be zero on success
 numColSamples = 20
 
 outputFname = "output/ocean.h5"
-outputMat = h5py.File(outputFname, "r")["rows"]
+outputMat = h5py.File(outputFname, "r", rdcc_nbytes=chunkCacheBytes, rdcc_nslots=chunkCacheSlots)["rows"]
 numCols = outputMat.shape[1]
 colIndices = np.sort(np.random.randint(numCols, size=numColSamples))
 sampledCols = outputMat[:, colIndices]
@@ -0,0 +1,60 @@
+# Checks that the verifyMaskQ check of the converters recognizes the missing points of the raw values by the same rule netCDF4 masks
+# them by when it reads them: missing_value and _FillValue (or the default fill value), NaN fills, and valid_min/valid_max/valid_range
+#
+# To run (one process; the file goes in a temporary directory under the current one):
+#  module load python mpi4py netcdf4-python
+#  python ./test_conversionHelpers.py
+
+import numpy as np
+from netCDF4 import Dataset
+import tempfile, shutil
+from os.path import join
+from conversionHelpers import maskingRule, missingPoints
+
+numValues = 40
+
+# (variable name, dtype, _FillValue, other attributes), with special values at the start of each variable
+variableCases = [("plain", "f4", None, {}, [9.969209968386869e36, 1.0]),
+        ("nanFill", "f4", np.nan, {}, [np.nan, 9.969209968386869e36]),
+        ("missingValues", "f8", -999.0, {"missing_value": [1e20, np.nan]}, [-999.0, 1e20, np.nan]),
+        ("validRange", "f4", 5.0, {"valid_range": [-2.0, 3.0]}, [5.0, np.nan, -2.0, 3.0, -2.5, 3.5]),
+        ("validMinMax", "i2", None, {"valid_min": -3, "valid_max": 4, "missing_value": 2}, [-32767, 2, -3, 4, -4, 5]),
+        ("byte", "i1", None, {}, [-127, 0]),
+        ("byteFill", "u1", 7, {"valid_max": 200}, [7, 200, 201]),
+        ("validMin", "f4", None, {"valid_min": 0.5}, [0.5, 0.4])]
+
+def writeCases(fname):
+    rng = np.random.RandomState(0)
+    fh = Dataset(fname, "w")
+    fh.createDimension("x", numValues)
+    for (varName, dtype, fillValue, attributes, specialValues) in variableCases:
+        variable = fh.createVariable(varName, dtype, ("x",), fill_value=fillValue)
+        for (attributeName, attributeValue) in attributes.items():
+            variable.setncattr(attributeName, np.array(attributeValue, dtype=dtype))
+        variable.set_auto_mask(False)
+        values = (rng.randn(numValues)*5).astype(dtype)
+        values[:len(specialValues)] = specialValues
+        variable[:] = values
+    fh.close()
+
+def test_missingPointsMatchNetCDF4(workDir):
+    fname = join(workDir, "maskingRules.nc")
+    writeCases(fname)
+    fh = Dataset(fname, "r")
+    for (varName, dtype, fillValue, attributes, specialValues) in variableCases:
+        variable = fh[varName]
+        with np.errstate(invalid="ignore"):
+            expected = np.ma.getmaskarray(variable[:])
+        variable.set_auto_mask(False)
+        rawValues = variable[:].reshape(1, -1)
+        assert np.array_equal(missingPoints(rawValues, maskingRule(variable))[0], expected), varName
+        variable.set_auto_mask(True)
+    fh.close()
+
+if __name__ == "__main__":
+    workDir = tempfile.mkdtemp(dir=".")
+    try:
+        test_missingPointsMatchNetCDF4(workDir)
+    finally:
+        shutil.rmtree(workDir)
+    print "test_conversionHelpers passed"
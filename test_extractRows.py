@@ -0,0 +1,100 @@
+# Checks that a dataset extracted with extractRows.py can be queried like a converted one: builds a small matrix laid out like the
+# converters' output (rows level by level, over the observed grid points only, with the row index in the metadata), extracts a few
+# levels of a lat/lon box, and compares the region queries of testDataExtraction.py on the extracted file with the same rows of the input
+#
+# To run (any number of processes; the files go in a temporary directory under the current one):
+#  module load python h5py-parallel mpi4py
+#  srun -n 4 python-mpi ./test_extractRows.py
+
+from mpi4py import MPI
+import h5py
+import numpy as np
+import tempfile, shutil
+from os.path import join
+from extractRows import extractRows, levelSelection, levelRangeSelection, parseLevels, boxSelection, allOf
+from testDataExtraction import extract_region
+
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+
+(numLevels, numLats, numLongs, numCols) = (4, 6, 8, 5)
+
+def syntheticMetadata():
+    """the metadata of a grid whose deeper levels have fewer observed points, as the converters write it"""
+    rng = np.random.RandomState(0)
+    observedMask = rng.rand(numLevels, numLats, numLongs) < np.linspace(0.9, 0.4, numLevels)[:, np.newaxis, np.newaxis]
+    observedLocations = np.nonzero(observedMask.flatten())[0]
+    (levelIndices, latIndices, lonIndices) = np.unravel_index(observedLocations, observedMask.shape)
+    latList = np.linspace(-75, 75, numLats)
+    lonList = np.linspace(0, 315, numLongs)
+    return {"observedLocations": observedLocations, "observedLatCoords": latList[latIndices], "observedLonCoords": lonList[lonIndices],
+            "observedLevelNumbers": levelIndices.astype(np.float64), "missingLocations": np.nonzero(np.logical_not(observedMask.flatten()))[0],
+            "latList": latList, "lonList": lonList, "numLevels": numLevels, "numLats": numLats, "numLongs": numLongs,
+            "levelRowOffsets": np.hstack([[0], np.cumsum(observedMask.sum(axis=(1, 2)))]).astype(np.int64),
+            "gridRowIndex": np.hstack([[0], np.cumsum(observedMask.flatten())]).astype(np.int64)}
+
+def test_queryExtractedRows(workDir):
+    metadata = syntheticMetadata()
+    numRows = len(metadata["observedLocations"])
+    rows = np.arange(numRows*numCols, dtype=np.float32).reshape(numRows, numCols)
+    if rank == 0:
+        with h5py.File(join(workDir, "in.h5"), "w") as fout:
+            fout["rows"] = rows
+        np.savez(join(workDir, "in.npz"), **metadata)
+    comm.Barrier()
+
+    levels = [1, 3]
+    latRange = (-40, 40)
+    numExtracted = extractRows(join(workDir, "in.h5"), join(workDir, "sub.h5"), allOf(levelSelection(levels), boxSelection(latRange, (0, 360))),
+            join(workDir, "in.npz"), join(workDir, "sub.npz"))
+    if rank != 0:
+        return
+
+    subRows = h5py.File(join(workDir, "sub.h5"), "r")["rows"]
+    subMetadata = np.load(join(workDir, "sub.npz"), allow_pickle=True)
+    assert subRows.shape == (numExtracted, numCols) and numExtracted < numRows
+    assert subMetadata["levelRowOffsets"][-1] == numExtracted and subMetadata["gridRowIndex"][-1] == numExtracted
+    # the extracted rows of each level are still contiguous
+    subLevels = subMetadata["observedLevelNumbers"]
+    for curLev in xrange(numLevels):
+        levelRows = np.nonzero(subLevels == curLev)[0]
+        assert np.array_equal(levelRows, np.arange(subMetadata["levelRowOffsets"][curLev], subMetadata["levelRowOffsets"][curLev + 1]))
+
+    # query regions of the extracted file with its row index, and check them against the same region of the input
+    inLats = (metadata["latList"] >= latRange[0]) & (metadata["latList"] <= latRange[1])
+    rng = np.random.RandomState(1)
+    for trial in xrange(50):
+        lats = metadata["latList"][rng.rand(numLats) < 0.6]
+        lons = metadata["lonList"][rng.rand(numLongs) < 0.6]
+        queryLevels = np.nonzero(rng.rand(numLevels) < 0.6)[0]
+        (submat, subLats, subLons, subDepths, indices) = extract_region(subRows, subMetadata, lats, lons, queryLevels)
+        expected = np.nonzero(np.in1d(metadata["observedLatCoords"], lats[np.in1d(lats, metadata["latList"][inLats])]) &
+                np.in1d(metadata["observedLonCoords"], lons) & np.in1d(metadata["observedLevelNumbers"], np.intersect1d(queryLevels, levels)))[0]
+        assert np.array_equal(submat, rows[expected]), trial
+        assert np.array_equal(subMetadata["sourceRows"][indices], expected), trial
+        assert np.array_equal(subLats, metadata["observedLatCoords"][expected]) and np.array_equal(subLons, metadata["observedLonCoords"][expected])
+        assert np.array_equal(subDepths, metadata["observedLevelNumbers"][expected]), trial
+        # the query by scanning the coordinates of every row, for metadata without the row index, finds the same rows
+        scanMetadata = dict([(fieldName, subMetadata[fieldName]) for fieldName in subMetadata.files if fieldName not in ["levelRowOffsets", "gridRowIndex"]])
+        assert np.array_equal(extract_region(subRows, scanMetadata, lats, lons, queryLevels)[4], indices), trial
+
+def test_parseLevels():
+    # level numbers, and depths that aren't whole numbers, as in the CESM data
+    metadata = {"observedLevelNumbers": np.array([0, 1, 2, 9, 10, 39, 40], dtype=np.float64),
+            "observedLevelDepths": np.array([5.0, 500.0, 500.5, 1000.0, 1500.0])}
+    assert parseLevels("0,2,9-39") == [(0, 0), (2, 2), (9, 39)]
+    assert np.array_equal(levelRangeSelection(parseLevels("0,2,9-39"))(metadata), [True, False, True, True, True, True, False])
+    assert np.array_equal(levelRangeSelection(parseLevels("500.0"), "observedLevelDepths")(metadata), [False, True, False, False, False])
+    assert np.array_equal(levelRangeSelection(parseLevels("400-1000"), "observedLevelDepths")(metadata), [False, True, True, True, False])
+
+if __name__ == "__main__":
+    workDir = comm.bcast(tempfile.mkdtemp(dir=".") if rank == 0 else None, root=0)
+    try:
+        test_parseLevels()
+        test_queryExtractedRows(workDir)
+    finally:
+        comm.Barrier()
+        if rank == 0:
+            shutil.rmtree(workDir)
+    if rank == 0:
+        print "test_extractRows passed"
@@ -0,0 +1,105 @@
+# Checks the metadata exporter used by dump_CFSRO_metadata.py and dump_CESM_metadata.py: the text files must match what the dump
+# scripts wrote with the csv module (str of every value, rowidx,value lines ending in \r\n), the part files written under --mpi must
+# add up to the same files, and the parquet tables (when pyarrow is installed) must hold the same values in their source dtypes
+#
+# To run (any number of processes; the files go in a temporary directory under the current one):
+#  module load python mpi4py
+#  srun -n 4 python-mpi ./test_metadataExport.py
+
+from mpi4py import MPI
+import numpy as np
+import tempfile, shutil, csv
+from os.path import join
+from metadataExport import MetadataExporter, pyarrow
+
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+numProcs = comm.Get_size()
+
+numRows = 103
+blockRows = 10
+
+def syntheticTables():
+    """per-row columns with the dtypes the converters write: float32 coordinates, float64 level numbers and int64 locations"""
+    rng = np.random.RandomState(0)
+    lats = (rng.rand(numRows)*180 - 90).astype(np.float32)
+    lats[:3] = [0, -73.431816101074219, 1e-5]
+    levels = np.floor(rng.rand(numRows)*40).astype(np.float64)
+    levels[0] = 0
+    locations = np.sort(rng.randint(0, 10**9, numRows)).astype(np.int64)
+    return (lats, levels, locations)
+
+def csvModuleText(workDir, fieldNames, values):
+    """the table as the dump scripts used to write it, one csv.DictWriter row at a time"""
+    fname = join(workDir, "reference.csv")
+    with open(fname, "w") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=["rowidx"] + fieldNames)
+        for (idx, val) in enumerate(values):
+            writer.writerow({"rowidx": idx, fieldNames[0]: val})
+    return open(fname).read()
+
+def partsText(dirName, extension):
+    return "".join([open(join(dirName, "part-%05d.%s" % (partIdx, extension))).read() for partIdx in xrange(numProcs)])
+
+def test_textMatchesCsvModule(workDir):
+    (lats, levels, locations) = syntheticTables()
+    if rank == 0:
+        exporter = MetadataExporter(join(workDir, "serial"), "csv", blockRows, False)
+        exporter.writeRowTable("observedLatitudes", ["latitude"], [lats])
+        exporter.writeRowTable("observedLevelIndices", ["levelindex"], [levels])
+        exporter.writeRowTable("observedLocations", ["location"], [locations], textIndexQ=False, textExtension="lst")
+        exporter.writeList("latList", np.unique(lats))
+        exporter.writeList("depthList", [10, 11.5, 52])
+
+        assert open(join(workDir, "serial", "observedLatitudes.csv")).read() == csvModuleText(workDir, ["latitude"], lats)
+        assert open(join(workDir, "serial", "observedLevelIndices.csv")).read() == csvModuleText(workDir, ["levelindex"], levels)
+        assert open(join(workDir, "serial", "observedLocations.lst")).read() == "".join([str(location) + "\n" for location in locations])
+        assert open(join(workDir, "serial", "latList.lst")).read() == "".join([str(lat) + "\n" for lat in np.unique(lats)])
+        assert open(join(workDir, "serial", "depthList.lst")).read() == "10\n11.5\n52\n"
+        # the floats are the shortest strings that read back to the same value of their own dtype
+        latLines = open(join(workDir, "serial", "observedLatitudes.csv")).read().split("\r\n")
+        assert latLines[:3] == ["0,0.0", "1,-73.431816", "2,1e-05"]
+        assert open(join(workDir, "serial", "observedLevelIndices.csv")).read().startswith("0,0.0\r\n")
+        assert np.array_equal(np.array([line.split(",")[1] for line in latLines[:-1]], dtype=np.float32), lats)
+
+def test_mpiPartsMatchSerial(workDir):
+    (lats, levels, locations) = syntheticTables()
+    exporter = MetadataExporter(join(workDir, "mpi"), "csv", blockRows, True)
+    exporter.writeRowTable("observedLatitudes", ["latitude"], [lats])
+    exporter.writeRowTable("observedLocations", ["location"], [locations], textIndexQ=False, textExtension="lst")
+    comm.Barrier()
+    if rank == 0:
+        assert partsText(join(workDir, "mpi", "observedLatitudes.csv"), "csv") == open(join(workDir, "serial", "observedLatitudes.csv")).read()
+        assert partsText(join(workDir, "mpi", "observedLocations.lst"), "lst") == open(join(workDir, "serial", "observedLocations.lst")).read()
+
+def test_parquetTables(workDir):
+    if pyarrow is None:
+        if rank == 0:
+            print "test_metadataExport: pyarrow is not installed, skipping the parquet checks"
+        return
+    (lats, levels, locations) = syntheticTables()
+    exporter = MetadataExporter(join(workDir, "parquet"), "parquet", blockRows, True)
+    exporter.writeRowTable("observedLatitudes", ["latitude"], [lats])
+    exporter.writeRowTable("observedLevelIndices", ["levelindex"], [levels])
+    comm.Barrier()
+    if rank == 0:
+        for (name, fieldName, values) in [("observedLatitudes", "latitude", lats), ("observedLevelIndices", "levelindex", levels)]:
+            parts = [pyarrow.parquet.read_table(join(workDir, "parquet", name + ".parquet", "part-%05d.parquet" % partIdx))
+                    for partIdx in xrange(numProcs)]
+            assert all([part.schema.types[part.schema.names.index(fieldName)] == pyarrow.from_numpy_dtype(values.dtype) for part in parts])
+            partColumns = [part.to_pydict() for part in parts]
+            assert sum([partColumn["rowidx"] for partColumn in partColumns], []) == range(numRows)
+            assert np.array_equal(np.array(sum([partColumn[fieldName] for partColumn in partColumns], []), dtype=values.dtype), values)
+
+if __name__ == "__main__":
+    workDir = comm.bcast(tempfile.mkdtemp(dir=".") if rank == 0 else None, root=0)
+    try:
+        test_textMatchesCsvModule(workDir)
+        test_mpiPartsMatchSerial(workDir)
+        test_parquetTables(workDir)
+    finally:
+        comm.Barrier()
+        if rank == 0:
+            shutil.rmtree(workDir)
+    if rank == 0:
+        print "test_metadataExport passed"
@@ -0,0 +1,136 @@
+# Checks a converted file against the checksums the converters computed from the raw NetCDF values as they read them
+# (stored in /checksums, see recordChecksums in the converters), with a single read pass over the matrix: every process
+# streams an even share of the rows in blocks, recomputes the checksum, sum and sum of squares of each column on each level,
+# and rank 0 compares the totals with the stored ones and reports the mismatched columns
+#
+#  srun -n 64 -u python-mpi -u ./verifyConversion.py ocean.h5
+#  srun -n 64 -u python-mpi -u ./verifyConversion.py cesm.h5 --datasets temp rho
+# exits with a nonzero status if any column doesn't match
+
+from mpi4py import MPI
+import numpy as np
+import argparse, sys
+from extractRows import openParallelFile, readRowRuns, defaultMemoryBudget, maxTransferBytes
+
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+numProcs = comm.Get_size()
+
+maxReportedMismatches = 20 # the (level, column) pairs listed in detail
+
+def blockChecksums(block, firstRow):
+    """the checksum (the sum over the rows r of (2r + 1) times the bits of the stored value, modulo 2**64), sum and sum of squares
+    of each column of block, whose first row is row firstRow of the dataset"""
+    rowWeights = np.uint64(2)*np.arange(firstRow, firstRow + block.shape[0], dtype=np.uint64) + np.uint64(1)
+    blockBits = block.view("u%d" % block.dtype.itemsize).astype(np.uint64)
+    return (np.dot(rowWeights, blockBits), block.sum(axis=0, dtype=np.float64), np.einsum("ij,ij->j", block, block, dtype=np.float64))
+
+def computeChecksums(rows, levelRowOffsets, memoryBudget):
+    """recomputes the (level x column) checksums, sums and sums of squares of rows, each process reading an even share of the rows
+    with collective reads; the totals end up on rank 0"""
+    (numRows, numCols) = rows.shape
+    numLevels = len(levelRowOffsets) - 1
+    checksums = np.zeros((numLevels, numCols), dtype=np.uint64)
+    sums = np.zeros((numLevels, numCols), dtype=np.float64)
+    sumSquares = np.zeros((numLevels, numCols), dtype=np.float64)
+
+    rowBoundaries = (numRows*np.arange(numProcs + 1))/numProcs
+    (startRow, endRow) = (rowBoundaries[rank], rowBoundaries[rank + 1])
+    # the stored values and their bits as uint64 are both in memory at once
+    rowBytes = max(1, numCols*(rows.dtype.itemsize + 8))
+    blockRows = max(1, min(memoryBudget/rowBytes, maxTransferBytes/max(1, numCols*rows.dtype.itemsize)))
+    numBlocks = comm.allreduce((endRow - startRow + blockRows - 1)/blockRows, op=MPI.MAX)
+    blockBuffer = np.empty((min(blockRows, endRow - startRow), numCols), dtype=rows.dtype)
+    for blockNum in xrange(numBlocks):
+        blockStart = min(startRow + blockNum*blockRows, endRow)
+        blockEnd = min(blockStart + blockRows, endRow)
+        block = blockBuffer[:(blockEnd - blockStart)]
+        readRowRuns(rows, [(blockStart, blockEnd - blockStart)] if blockEnd > blockStart else [], block, True)
+        # split the block at the level boundaries
+        firstLevel = np.searchsorted(levelRowOffsets, blockStart, side="right") - 1
+        for curLev in xrange(firstLevel, numLevels):
+            pieceStart = max(blockStart, levelRowOffsets[curLev])
+            pieceEnd = min(blockEnd, levelRowOffsets[curLev + 1])
+            if pieceStart >= blockEnd:
+                break
+            if pieceEnd > pieceStart:
+                (pieceChecksums, pieceSums, pieceSumSquares) = blockChecksums(block[(pieceStart - blockStart):(pieceEnd - blockStart)], pieceStart)
+                checksums[curLev] += pieceChecksums
+                sums[curLev] += pieceSums
+                sumSquares[curLev] += pieceSumSquares
+
+    for localValues in [checksums, sums, sumSquares]:
+        if rank == 0:
+            comm.Reduce(MPI.IN_PLACE, localValues, op=MPI.SUM, root=0)
+        else:
+            comm.Reduce(localValues, None, op=MPI.SUM, root=0)
+    return (checksums, sums, sumSquares)
+
+def compareChecksums(stored, computed, levelRowOffsets):
+    """the (level x column) mask of the mismatches between the stored and recomputed checksums, sums and sums of squares; the
+    checksums have to match exactly, the sums only up to the rounding of the float64 additions, which happen in a different order"""
+    (storedChecksums, storedSums, storedSumSquares) = stored
+    (checksums, sums, sumSquares) = computed
+    numLevelRows = np.diff(levelRowOffsets)[:, np.newaxis]
+    # |sum of values| <= sqrt(number of values * sum of squares), which bounds the rounding errors
+    sumTolerance = 1e-9*np.sqrt(numLevelRows*np.maximum(storedSumSquares, 0)) + 1e-300
+    return (storedChecksums != checksums) | (np.abs(storedSums - sums) > sumTolerance) | \
+            (np.abs(storedSumSquares - sumSquares) > 1e-9*np.abs(storedSumSquares) + 1e-300)
+
+def describeColumn(metadataGroup, colIdx):
+    """the input file and time slice a column was converted from, if the output has a metadata group"""
+    if metadataGroup is None or "fileIndices" not in metadataGroup:
+        return ""
+    fileName = metadataGroup["fileNames"][metadataGroup["fileIndices"][colIdx]]
+    return " (%s, time slice %d)" % (fileName, metadataGroup["timeSliceOffsets"][colIdx])
+
+def verifyDataset(fin, datasetName, memoryBudget):
+    """checks datasetName against its stored checksums, reporting the mismatches from rank 0; returns whether everything matched; collective"""
+    if ("checksums/" + datasetName) not in fin:
+        if rank == 0:
+            print "%s: no checksums stored (converted with checksumsQ off?)" % datasetName
+        return False
+    metadataGroup = fin["metadata/" + datasetName] if ("metadata/" + datasetName) in fin else None
+    if metadataGroup is None or "levelRowOffsets" not in metadataGroup:
+        if rank == 0:
+            print "%s: the metadata group has no levelRowOffsets, so the rows can't be split into levels" % datasetName
+        return False
+    levelRowOffsets = metadataGroup["levelRowOffsets"][:]
+    rows = fin[datasetName]
+    computed = computeChecksums(rows, levelRowOffsets, memoryBudget)
+
+    matchQ = True
+    if rank == 0:
+        checksumGroup = fin["checksums/" + datasetName]
+        stored = [checksumGroup[fieldName][:] for fieldName in ["checksum", "sum", "sumOfSquares"]]
+        mismatches = compareChecksums(stored, computed, levelRowOffsets)
+        mismatchedCols = np.nonzero(np.any(mismatches, axis=0))[0]
+        matchQ = len(mismatchedCols) == 0
+        print "%s: %d rows x %d columns, %d mismatched columns" % (datasetName, rows.shape[0], rows.shape[1], len(mismatchedCols))
+        (mismatchedLevels, mismatchedLevelCols) = np.nonzero(mismatches)
+        for (curLev, colIdx) in zip(mismatchedLevels, mismatchedLevelCols)[:maxReportedMismatches]:
+            print "  level %d, column %d%s: stored sum %g, recomputed %g" % (curLev, colIdx, describeColumn(metadataGroup, colIdx),
+                    stored[1][curLev, colIdx], computed[1][curLev, colIdx])
+        if len(mismatchedLevels) > maxReportedMismatches:
+            print "  ... and %d more mismatched (level, column) pairs" % (len(mismatchedLevels) - maxReportedMismatches)
+        sys.stdout.flush()
+    return comm.bcast(matchQ, root=0)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="checks a converted file against the checksums stored in it during the conversion")
+    parser.add_argument("fname")
+    parser.add_argument("--datasets", nargs="+", default=None, help="the datasets to check (default: all the ones with checksums)")
+    parser.add_argument("--memoryBudget", type=int, default=defaultMemoryBudget, help="bytes of rows each process holds at a time")
+    args = parser.parse_args()
+
+    fin = openParallelFile(args.fname, False)
+    datasetNames = args.datasets
+    if datasetNames is None:
+        datasetNames = sorted(fin["checksums"].keys()) if "checksums" in fin else []
+    if len(datasetNames) == 0 and rank == 0:
+        print "No checksums stored in %s" % args.fname
+    allMatchQ = len(datasetNames) > 0
+    for datasetName in datasetNames:
+        allMatchQ = verifyDataset(fin, datasetName, args.memoryBudget) and allMatchQ
+    fin.close()
+    sys.exit(0 if allMatchQ else 1)